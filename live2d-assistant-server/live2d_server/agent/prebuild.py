@@ -1,15 +1,35 @@
 """提供一些预定义的Agent."""
 
 import logging
-from langchain.tools.searx_search.tool import SearxSearchResults
-from live2d_server.search.searx import searx_search_wrapper
+from langchain_core.tools import StructuredTool
+from live2d_server.search import searx, fetcher
 
 logger = logging.getLogger(__name__)
 
+
+async def searx_search(query: str) -> list[dict]:
+    """使用searx搜索网络"""
+    # 每次调用时读取模块中的全局客户端，配置更新后使用新的客户端
+    return [result.to_dict() for result in await searx.searx_client.search(query)]
+
+
+async def read_web_pages(urls: list[str]) -> list[dict]:
+    """读取网页的正文，可以一次传入多个URL"""
+    pages = []
+    for url, result in zip(urls, await fetcher.page_fetcher.read_many(urls)):
+        if isinstance(result, BaseException):
+            pages.append({"url": url, "error": str(result)})
+        else:
+            pages.append(result.to_dict())
+    return pages
+
+
 # 预定义的工具集，可以直接使用
-searx_tool = SearxSearchResults(name="searx", description="使用searx搜索网络", wrapper=searx_search_wrapper)
+searx_tool = StructuredTool.from_function(coroutine=searx_search, name="searx", description="使用searx搜索网络")
+web_page_tool = StructuredTool.from_function(coroutine=read_web_pages, name="web_page", description="读取网页的正文，可以一次传入多个URL，适合在搜索之后阅读搜索结果的原文")
 
 
 prebuild_tools = {
-    "searx": searx_tool
-}
\ No newline at end of file
+    "searx": searx_tool,
+    "web_page": web_page_tool,
+}
@@ -12,6 +12,7 @@ from live2d_server.mcp_tool_helper import new_convert_mcp_tool_to_langchain_tool
 from live2d_server.agent.model import AgentConfig, MessagesState, ToolResouce
 from live2d_server.agent.tools_loader import load_tools_from_local_file, load_tools_from_python_code
 from live2d_server.agent.prebuild import prebuild_tools
+from live2d_server import memory
 
 logger = logging.getLogger(__name__)
 
@@ -55,7 +56,8 @@ class SingleAgent:
         tools = await self.mcp_client.list_tools(mcp_server)
         converted_tools = []
         for tool_ in tools.tools:
-            t = new_convert_mcp_tool_to_langchain_tool(session=await self.mcp_client.get_client_session(mcp_server), tool=tool_)
+            # 服务器断线重连后会话会变化，调用时才获取会话
+            t = new_convert_mcp_tool_to_langchain_tool(get_session=lambda: self.mcp_client.get_client_session(mcp_server), tool=tool_)
             converted_tools.append(t)
             self.mcp_tools[tool_.name] = (tool_, mcp_server)
         return converted_tools
@@ -124,6 +126,8 @@ class SingleAgent:
 
     async def call_model(self, state: MessagesState) -> Command[Literal["call_tools", "__end__"]]:
         messages = state["messages"]
+        # 较早的历史只保留与当前问题相关的轮次
+        messages, _ = await memory.recall(f"agentic:{state['thread_id']}" if state.get("thread_id") else None, messages)
         if self.system_prompt:
             messages = [{"role": "system", "content": self.system_prompt}] + messages
 
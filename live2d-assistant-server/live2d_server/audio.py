@@ -0,0 +1,76 @@
+"""音频格式相关的工具函数"""
+
+import io
+import struct
+import wave
+
+import numpy as np
+
+# 流式WAV头中未知长度字段使用的值
+STREAM_DATA_SIZE = 0xFFFFFFFF - 36
+
+
+def wav_header(sample_rate: int, data_size: int = STREAM_DATA_SIZE, channels: int = 1, sample_width: int = 2) -> bytes:
+    '''
+    生成16位PCM的WAV头，流式输出时长度未知，使用最大值占位
+    '''
+    byte_rate = sample_rate * channels * sample_width
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", data_size + 36, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8,
+        b"data", data_size,
+    )
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int) -> bytes:
+    return wav_header(sample_rate, len(pcm)) + pcm
+
+
+def wav_to_pcm(data: bytes) -> tuple[bytes, int]:
+    '''
+    从完整的WAV数据中取出PCM数据和采样率
+    '''
+    with wave.open(io.BytesIO(data), "rb") as f:
+        return f.readframes(f.getnframes()), f.getframerate()
+
+
+def split_frames(pcm: bytes, frame_bytes: int) -> list[bytes]:
+    return [pcm[i:i + frame_bytes] for i in range(0, len(pcm), frame_bytes)]
+
+
+def mouth_envelope(pcm: bytes, sample_rate: int, fps: int = 30, floor_db: float = -50, ceil_db: float = -12) -> bytes:
+    '''
+    计算口型包络：按 fps 把16位PCM切成等长窗口，求每个窗口的RMS能量，
+    在 floor_db 到 ceil_db 之间线性映射为 0-255，每个字节对应一帧嘴巴张开的程度
+    '''
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    if len(samples) == 0:
+        return b''
+    window = max(1, sample_rate // fps)
+    count = -(-len(samples) // window)
+    frames = np.zeros(count * window, dtype=np.float32)
+    frames[:len(samples)] = samples / 32768
+    rms = np.sqrt(np.mean(frames.reshape(count, window) ** 2, axis=1))
+    db = 20 * np.log10(np.maximum(rms, 1e-6))
+    level = np.clip((db - floor_db) / (ceil_db - floor_db), 0, 1)
+    return np.round(level * 255).astype(np.uint8).tobytes()
+
+
+# 压缩格式对应的 torchaudio 保存参数和 Content-Type
+COMPRESSED_FORMATS = {
+    "opus": ("opus", "audio/ogg; codecs=opus"),
+}
+
+
+def encode_audio(pcm: bytes, sample_rate: int, audio_format: str) -> bytes:
+    '''
+    将16位PCM编码为压缩格式，需要 torchaudio 的 ffmpeg 后端；
+    只在请求压缩格式时才导入 torch，避免主进程常驻加载
+    '''
+    import torch
+    import torchaudio
+    samples = torch.from_numpy(np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768).unsqueeze(0)
+    buffer = io.BytesIO()
+    torchaudio.save(buffer, samples, sample_rate, format=COMPRESSED_FORMATS[audio_format][0])
+    return buffer.getvalue()
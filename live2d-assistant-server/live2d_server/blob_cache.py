@@ -0,0 +1,176 @@
+"""两级LRU缓存
+
+内存中使用按字节数限制的LRU；配置了磁盘目录时写入的条目同时写入磁盘，重启后仍然可以命中，
+磁盘同样按总大小淘汰最旧的文件。
+TTS音频和网页正文的缓存都基于它，键由使用者计算。
+"""
+
+import asyncio
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class BlobCache:
+    """两级缓存，每个条目是若干段字节数据"""
+
+    def __init__(self, memory_bytes: int, cache_dir: str | None = None, disk_bytes: int = 0):
+        self.memory_bytes = memory_bytes
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+        self._memory: OrderedDict[str, list[bytes]] = OrderedDict()
+        self._memory_size = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # 目录在第一次写入磁盘时才创建
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            self._load_disk_index()
+
+    async def get(self, key: str) -> list[bytes] | None:
+        with self._lock:
+            chunks = self._memory.get(key)
+            if chunks is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return chunks
+            on_disk = key in self._disk
+        if on_disk:
+            chunks = await asyncio.to_thread(self._read_disk, key)
+            if chunks is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                await self.put(key, chunks)
+                return chunks
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def put(self, key: str, chunks: list[bytes]):
+        size = sum(len(data) for data in chunks)
+        # 新条目同时写入磁盘，重启后不会丢失内存中的热点条目；从内存淘汰的条目通常已经在磁盘上，不需要再写
+        pending = [(key, chunks)]
+        if size <= self.memory_bytes:
+            # 单条超过内存预算时只写入磁盘
+            with self._lock:
+                if key in self._memory:
+                    self._memory_size -= sum(len(data) for data in self._memory.pop(key))
+                self._memory[key] = chunks
+                self._memory_size += size
+                while self._memory_size > self.memory_bytes:
+                    old_key, old_data = self._memory.popitem(last=False)
+                    self._memory_size -= sum(len(data) for data in old_data)
+                    pending.append((old_key, old_data))
+        if self.cache_dir:
+            with self._lock:
+                pending = [(key, chunks) for key, chunks in pending if key not in self._disk]
+            if pending:
+                await asyncio.to_thread(self._spill, pending)
+
+    def contains(self, key: str) -> bool:
+        '''
+        是否有这条缓存，不读取内容也不计入命中统计
+        '''
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    async def delete(self, key: str):
+        '''
+        删除一条缓存，用于内容会更新的条目（磁盘上已有的条目不会被再次写入）
+        '''
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= sum(len(data) for data in self._memory.pop(key))
+            on_disk = key in self._disk
+            if on_disk:
+                self._disk_size -= self._disk.pop(key)
+        if on_disk:
+            try:
+                await asyncio.to_thread(os.remove, self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size,
+            }
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".bin")
+
+    def _load_disk_index(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".bin"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        logger.info(f"{type(self).__name__} loaded {len(self._disk)} entries from {self.cache_dir}")
+
+    def _read_disk(self, key: str) -> list[bytes] | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._disk_size -= self._disk.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        chunks = []
+        offset = 0
+        while offset < len(content):
+            (length,) = struct.unpack_from("<I", content, offset)
+            offset += 4
+            chunks.append(content[offset:offset + length])
+            offset += length
+        return chunks
+
+    def _spill(self, entries: list[tuple[str, list[bytes]]]):
+        for key, chunks in entries:
+            with self._lock:
+                if key in self._disk:
+                    continue
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            content = b"".join(struct.pack("<I", len(data)) + data for data in chunks)
+            # 同一个键可能在多个线程中同时写入，临时文件不能共用
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+            with self._lock:
+                if key not in self._disk:
+                    self._disk[key] = len(content)
+                    self._disk_size += len(content)
+        while self._disk_size > self.disk_bytes and self._disk:
+            with self._lock:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
@@ -0,0 +1,83 @@
+"""客户端断开时取消上游的工作
+
+流式接口在两次输出之间可能很久不向客户端写数据（等待大模型、调用工具），
+只靠写入失败发现断开太晚。until_disconnected 同时监听 http.disconnect，
+断开后立即取消正在等待的上游生成器，取消沿调用链传到大模型流、MCP工具调用和TTS任务，
+各处在被取消时记录到 cancel_stats。
+"""
+
+import asyncio
+import logging
+import threading
+from typing import AsyncGenerator, AsyncIterator
+
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+
+class CancelStats:
+    """统计因客户端断开（以及超时、同一轮的工具调用出错）而取消的工作"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {
+            "requests": 0, # 客户端断开的流式请求
+            "llm_streams": 0, # 提前关闭的大模型流
+            "tool_calls": 0, # 被取消的MCP工具调用
+            "tool_timeouts": 0, # 超时后取消的MCP工具调用
+            "tool_siblings": 0, # 同一轮的其他工具调用出错而取消的MCP工具调用
+            "tts_sentences": 0, # 还没有合成完成就被丢弃的句子
+            "tts_jobs": 0, # 排队中被跳过、没有交给工作进程的合成任务
+            "abandoned": 0, # 断开后客户端没有重新连接而取消的生成
+        }
+
+    def add(self, kind: str, count: int = 1):
+        if count <= 0:
+            return
+        with self._lock:
+            self.counts[kind] += count
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+
+cancel_stats = CancelStats()
+
+
+async def _next(iterator: AsyncIterator):
+    return await anext(iterator)
+
+
+async def _wait_disconnect(request: Request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def until_disconnected(request: Request, frames: AsyncIterator) -> AsyncGenerator:
+    '''
+    转发 frames 的输出，客户端断开时取消上游并正常结束
+    '''
+    iterator = aiter(frames)
+    disconnected = asyncio.create_task(_wait_disconnect(request))
+    try:
+        while True:
+            frame = asyncio.create_task(_next(iterator))
+            await asyncio.wait({frame, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not frame.done():
+                frame.cancel()
+                await asyncio.gather(frame, return_exceptions=True)
+                cancel_stats.add("requests")
+                logger.info(f"client disconnected from {request.url.path}, upstream work cancelled")
+                break
+            try:
+                yield frame.result()
+            except StopAsyncIteration:
+                break
+    finally:
+        disconnected.cancel()
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
@@ -1,15 +1,20 @@
 from typing import Optional, abstractmethod,  Literal, AsyncGenerator, overload
 from contextlib import AsyncExitStack
+from contextvars import ContextVar
 from mcp import ClientSession, StdioServerParameters, ListToolsResult
 from mcp.client.stdio import stdio_client
 from mcp.client.sse import sse_client
-from mcp.types import CallToolResult
-from live2d_server.chat_response import ChatResponse
-from live2d_server.openai_adapter import OpenAIAdapter
+from mcp.shared.message import SessionMessage
+from mcp.types import CallToolResult, CancelledNotification, CancelledNotificationParams, ClientNotification, JSONRPCRequest, ServerNotification, ToolListChangedNotification
+from live2d_server.chat_response import ChatResponse, ToolCall
+from live2d_server.openai_adapter import OpenAIAdapter, openai_tools
+import asyncio
 import logging
 import json
+import time
 from pydantic import BaseModel, Field
-from live2d_server.model import Tool, ToolFunction
+from live2d_server.model import Tool, ToolFunction, ToolList
+from live2d_server.cancellation import cancel_stats
 
 logger = logging.getLogger(__name__)
 
@@ -30,26 +35,259 @@ class LLMConfig(BaseModel):
 class MCPClientConfig(BaseModel):
     mcp_servers: list[MCPServerConfig]
     llm: LLMConfig
+    connect_timeout: float = 10 # 初始化时等待每个服务器连接的时间，超时的服务器在后台继续连接，单位秒
+    handshake_timeout: float = 60 # 单次连接尝试（启动进程、初始化会话、获取工具列表）的超时时间，超时后重试，单位秒
+    retry_delay: float = 2 # 连接失败后第一次重试的等待时间，之后每次翻倍，单位秒
+    retry_max_delay: float = 60 # 重试等待时间的上限，单位秒
+    tool_concurrency: int = 1 # 每个服务器同时执行的工具调用数量上限，不同服务器的调用总是并发执行；默认按调用顺序逐个执行，浏览器、文件系统等有状态的服务器的调用之间可能有先后依赖，确认服务器的工具互不影响时才调大
+    tool_timeout: float = 60 # 单次工具调用的超时时间（不包括排队），超时后把超时信息作为工具结果返回给大模型，0 表示不限制，单位秒
+    ping_interval: float = 30 # 连接建立后 ping 服务器的间隔，没有响应时断开重连，0 表示只在传输层关闭时重连，单位秒
+
+# 保存后台任务的引用，避免任务在完成前被回收
+_background_tasks: set[asyncio.Task] = set()
+
+# 同一轮的某个工具调用出错时，取消其余调用使用的消息
+SIBLING_FAILED = "sibling tool call failed"
+# 连接断开时取消尚未返回的工具调用使用的消息
+CONNECTION_LOST = "connection lost"
+
+class _WatchedReadStream:
+    """传输层读取流的包装，会话的接收循环退出（服务器退出或连接断开）时设置 closed"""
+
+    def __init__(self, stream, closed: asyncio.Event):
+        self._stream = stream
+        self._closed = closed
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._closed.set()
+        return await self._stream.__aexit__(*exc_info)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._stream.__anext__()
+
+# 当前任务通过会话发出的请求ID，由 Client.call 设置
+_sent_requests: ContextVar[list | None] = ContextVar("_sent_requests", default=None)
+
+class _RecordingWriteStream:
+    """传输层写入流的包装，请求写入传输层后记下它的ID，取消或超时时用来通知服务器"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self._stream.__aexit__(*exc_info)
+
+    async def send(self, message: SessionMessage):
+        await self._stream.send(message)
+        sent = _sent_requests.get()
+        if sent is not None and isinstance(message.message.root, JSONRPCRequest):
+            sent.append(message.message.root.id)
 
 class Client:
+    """
+    一个MCP服务器的连接
+
+    连接在单独的后台任务中建立和关闭（传输层使用的 anyio 取消域必须在进入它的同一个任务中退出），
+    连接失败或超时后按指数退避在后台重试，不阻塞其他服务器和初始化；
+    连接建立后服务器退出、连接断开或者 ping 没有响应时同样回到重试流程
+    """
     config: MCPServerConfig
     session: Optional[ClientSession] = None
-    exit_stack: AsyncExitStack
     server_name: str
 
     def __init__(self, config: MCPServerConfig):
         self.config = config
         self.session: Optional[ClientSession] = None
-        self.exit_stack = AsyncExitStack()
         self.server_name = config.name
-    
+        self.handshake_timeout = 60
+        self.retry_delay = 2
+        self.retry_max_delay = 60
+        self.tool_timeout = 60
+        self.ping_interval = 30
+        self.concurrency = 1
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        # 连接时获取的工具列表，服务器通知工具列表变化时刷新
+        self.tools: list[Tool] | None = None
+        self.tools_raw: ListToolsResult | None = None
+        self.on_tools_changed = None
+        self._refresh_task: asyncio.Task | None = None
+        # 连接状态：connecting / connected / failed / closed
+        self.status = "connecting"
+        self.attempts = 0
+        self.connect_time: float | None = None # 最近一次成功连接的耗时，秒
+        self.error: str | None = None
+        self._task: asyncio.Task | None = None
+        self._connected = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._closed = asyncio.Event() # 当前会话的传输层已经关闭
+        self._calls: set[asyncio.Task] = set() # 正在等待服务器返回的工具调用
+
+    def apply(self, options: MCPClientConfig):
+        '''
+        更新重试和工具调用的参数，不影响已经建立的会话
+        '''
+        self.handshake_timeout = options.handshake_timeout
+        self.retry_delay = options.retry_delay
+        self.retry_max_delay = options.retry_max_delay
+        self.tool_timeout = options.tool_timeout
+        self.ping_interval = options.ping_interval
+        concurrency = max(1, options.tool_concurrency)
+        if concurrency != self.concurrency:
+            # 正在执行和排队的调用继续使用原来的信号量
+            self.concurrency = concurrency
+            self.semaphore = asyncio.Semaphore(concurrency)
+
     @abstractmethod
-    async def connect(self):
+    async def open(self, exit_stack: AsyncExitStack):
+        '''
+        建立传输层和会话，进入的上下文都放到 exit_stack 中
+        '''
         ...
 
-    async def list_tools(self):
+    def _create_session(self, read_stream, write_stream) -> ClientSession:
+        return ClientSession(_WatchedReadStream(read_stream, self._closed), _RecordingWriteStream(write_stream), message_handler=self.handle_message)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def connect(self, timeout: float | None = None) -> bool:
+        '''
+        开始连接并最多等待 timeout 秒，超时后返回 False，连接在后台继续进行
+        '''
+        self.start()
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _run(self):
+        failures = 0 # 连续失败的次数，决定重试的等待时间
+        while not self._stop.is_set():
+            self.attempts += 1
+            self.status = "connecting"
+            self._closed = asyncio.Event()
+            start = time.perf_counter()
+            try:
+                async with AsyncExitStack() as exit_stack:
+                    async with asyncio.timeout(self.handshake_timeout):
+                        await self.open(exit_stack)
+                        await self.session.initialize()
+                        await self.refresh_tools()
+                    self.connect_time = time.perf_counter() - start
+                    self.status = "connected"
+                    self.error = None
+                    self._connected.set()
+                    logger.info(f"Connected to server {self.server_name} in {self.connect_time:.3f}s (attempt {self.attempts})")
+                    failures = 0
+                    await self._watch()
+            except Exception as e:
+                connected = self.status == "connected"
+                self.status = "failed"
+                failures += 1
+                # 传输层的错误被 anyio 包在多层 ExceptionGroup 中，只记录最里面的错误
+                while isinstance(e, BaseExceptionGroup) and len(e.exceptions) == 1:
+                    e = e.exceptions[0]
+                if connected:
+                    self.error = "ping timeout" if isinstance(e, TimeoutError) else repr(e)
+                    logger.error(f"Lost connection to server {self.server_name}: {self.error}")
+                else:
+                    self.error = "connect timeout" if isinstance(e, TimeoutError) else repr(e)
+                    logger.error(f"Failed to connect to server {self.server_name} (attempt {self.attempts}): {self.error}")
+            finally:
+                self.session = None
+                self._connected.clear()
+                for task in self._calls:
+                    # 旧会话的响应不会再到达
+                    task.cancel(CONNECTION_LOST)
+                if self.tools is not None:
+                    # 断开的服务器的工具不再提供给大模型
+                    self.tools = None
+                    self.tools_raw = None
+                    if self.on_tools_changed is not None:
+                        self.on_tools_changed()
+            if self._stop.is_set():
+                break
+            delay = min(self.retry_max_delay, self.retry_delay * 2 ** min(failures - 1, 16))
+            try:
+                await asyncio.wait_for(self._stop.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        self.status = "closed"
+
+    async def _watch(self):
+        '''
+        连接建立后一直等到关闭；传输层关闭或者 ping 超时时抛出异常
+        '''
+        stop = asyncio.create_task(self._stop.wait())
+        closed = asyncio.create_task(self._closed.wait())
+        try:
+            while True:
+                done, _ = await asyncio.wait({stop, closed}, timeout=self.ping_interval or None, return_when=asyncio.FIRST_COMPLETED)
+                if stop in done:
+                    return
+                if closed in done:
+                    raise ConnectionError("transport closed")
+                async with asyncio.timeout(self.handshake_timeout):
+                    await self.session.send_ping()
+        finally:
+            stop.cancel()
+            closed.cancel()
+
+    async def close(self, timeout: float = 5):
+        '''
+        关闭会话和传输层（stdio 服务器的子进程随之退出）
+        '''
+        self._stop.set()
+        if self._task is None:
+            self.status = "closed"
+            return
+        await asyncio.wait({self._task}, timeout=timeout)
+        if not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def report(self) -> dict:
+        return {
+            "name": self.server_name,
+            "transport": self.config.transport,
+            "status": self.status,
+            "attempts": self.attempts,
+            "connect_ms": round(self.connect_time * 1000, 1) if self.connect_time is not None else None,
+            "error": self.error,
+            "tools": len(self.tools) if self.tools is not None else 0,
+        }
+
+    async def list_tools(self) -> list[Tool]:
+        await self.wait_refresh()
+        if self.tools is None:
+            await self.refresh_tools()
+        return self.tools
+
+    async def list_tools_raw(self) -> ListToolsResult:
+        await self.wait_refresh()
+        if self.tools_raw is None:
+            await self.refresh_tools()
+        return self.tools_raw
+
+    async def refresh_tools(self):
+        if self.session is None:
+            raise RuntimeError(f"MCP服务器 {self.server_name} 未连接: {self.error or self.status}")
         response = await self.session.list_tools()
-        return [
+        self.tools_raw = response
+        self.tools = [
             Tool(
                 type="function",
                 function=ToolFunction(
@@ -61,42 +299,90 @@ class Client:
             )
             for tool in response.tools
         ]
-    
-    async def list_tools_raw(self) -> ListToolsResult:
-        return await self.session.list_tools()
+        logger.info(f"Tools of {self.server_name}: {[tool.name for tool in response.tools]}")
+        if self.on_tools_changed is not None:
+            self.on_tools_changed()
+
+    async def wait_refresh(self):
+        '''
+        等待正在进行的工具列表刷新，刷新失败时保留旧的列表
+        '''
+        if self._refresh_task is not None:
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+
+    async def handle_message(self, message):
+        '''
+        ClientSession 的消息回调，在会话的接收循环中执行，不能在这里等待服务器的响应，只在后台刷新工具列表
+        '''
+        if isinstance(message, ServerNotification) and isinstance(message.root, ToolListChangedNotification):
+            logger.info(f"Tool list of {self.server_name} changed")
+            self._refresh_task = asyncio.create_task(self.refresh_tools())
+            _background_tasks.add(self._refresh_task)
+            self._refresh_task.add_done_callback(_background_tasks.discard)
 
     async def call(self, tool_name: str, args: dict | str):
+        '''
+        调用工具，同一个服务器最多同时执行 concurrency 个调用，超过 tool_timeout 时抛出 TimeoutError
+        '''
         if isinstance(args, str):
             args = json.loads(args)
-        return await self.session.call_tool(tool_name, args)
+        async with self.semaphore:
+            if self.session is None or self._closed.is_set():
+                raise RuntimeError(f"MCP服务器 {self.server_name} 未连接: {self.error or self.status}")
+            session = self.session
+            sent = []
+            token = _sent_requests.set(sent)
+            task = asyncio.current_task()
+            self._calls.add(task)
+            try:
+                async with asyncio.timeout(self.tool_timeout or None):
+                    return await session.call_tool(tool_name, args)
+            except (asyncio.CancelledError, TimeoutError) as e:
+                if isinstance(e, asyncio.CancelledError) and e.args and e.args[0] == CONNECTION_LOST:
+                    task.uncancel()
+                    raise ConnectionError(f"MCP服务器 {self.server_name} 连接已断开") from None
+                if isinstance(e, TimeoutError):
+                    kind, reason = "tool_timeouts", "timeout"
+                elif e.args and e.args[0] == SIBLING_FAILED:
+                    kind, reason = "tool_siblings", SIBLING_FAILED
+                else:
+                    kind, reason = "tool_calls", "client disconnected"
+                cancel_stats.add(kind)
+                if sent:
+                    # 请求还没有写入传输层时服务器不知道这个请求，不需要通知
+                    notify = asyncio.create_task(self.notify_cancelled(sent[0], reason))
+                    _background_tasks.add(notify)
+                    notify.add_done_callback(_background_tasks.discard)
+                raise
+            finally:
+                _sent_requests.reset(token)
+                self._calls.discard(task)
+
+    async def notify_cancelled(self, request_id: int, reason: str = "client disconnected"):
+        '''
+        发送 notifications/cancelled，让服务器停止执行已经取消的请求
+        '''
+        try:
+            await self.session.send_notification(ClientNotification(CancelledNotification(
+                method="notifications/cancelled",
+                params=CancelledNotificationParams(requestId=request_id, reason=reason),
+            )))
+        except Exception as e:
+            logger.warning(f"Failed to notify {self.server_name} of cancelled request {request_id}: {e}")
 
 class SSEClient(Client):
-    def __init__(self, config: MCPServerConfig):
-        super().__init__(config)
 
-    async def connect(self):
+    async def open(self, exit_stack: AsyncExitStack):
         if not self.config.url:
             raise ValueError("url is required")
-        try: 
-            url = self.config.url
-            sse_transport = await self.exit_stack.enter_async_context(sse_client(url))
-            self.stdio, self.write = sse_transport
-            self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-            await self.session.initialize()
-            # List available tools
-            response = await self.session.list_tools()
-            tools = response.tools
-            logger.info(f"Connected to server with tools: {[tool.name for tool in tools]}")
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            logger.error(f"Failed to connect to server {self.config.name}: {e}")
+        url = self.config.url
+        sse_transport = await exit_stack.enter_async_context(sse_client(url))
+        self.stdio, self.write = sse_transport
+        self.session = await exit_stack.enter_async_context(self._create_session(self.stdio, self.write))
 
 class STDIOClient(Client):
-    def __init__(self, config: MCPServerConfig):
-        super().__init__(config)
 
-    async def connect(self):
+    async def open(self, exit_stack: AsyncExitStack):
         if not self.config.command:
             raise ValueError("command is required")
         
@@ -108,14 +394,34 @@ class STDIOClient(Client):
             args=args,
             env=env
         )
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))        
+        stdio_transport = await exit_stack.enter_async_context(stdio_client(server_params))        
         self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-        await self.session.initialize()
-        # List available tools
-        response = await self.session.list_tools()
-        tools = response.tools
-        logger.info(f"Connected to server with tools: {[tool.name for tool in tools]}")
+        self.session = await exit_stack.enter_async_context(self._create_session(self.stdio, self.write))
+
+class ToolRegistry:
+    """
+    所有服务器的工具列表、预先转换好的 OpenAI 格式和工具名到服务器的索引
+    只在某个服务器的工具列表变化（连接、重新连接、收到 tools/list_changed）后重新合并，查询时不需要访问服务器
+    """
+
+    def __init__(self):
+        self._tools: ToolList | None = None
+        self._index: dict[str, str] | None = None
+        self.builds = 0
+
+    def invalidate(self):
+        self._tools = None
+        self._index = None
+
+    def get(self, clients: list[Client]) -> tuple[ToolList | None, dict[str, str] | None]:
+        if self._tools is None:
+            tools = [tool for client in clients if client.tools is not None for tool in client.tools]
+            self._tools = ToolList(tools, openai_tools(tools))
+            self._index = {tool.function.name: tool.server_name for tool in tools}
+            self.builds += 1
+        if len(self._index) == 0:
+            return None, None
+        return self._tools, self._index
 
 class MCPClient:
     __clients: dict[str, Client] = {}
@@ -126,30 +432,90 @@ class MCPClient:
         self.__clients = {}
         self.__config = None
         self.__llm_adapter = None
+        self.__registry = ToolRegistry()
 
     async def init(self, config: MCPClientConfig):
+        '''
+        应用新的配置，只重新连接新增或配置变化的服务器，其余服务器的会话和工具列表保持不变
+        '''
+        previous = self.__config
         self.__config = config
-        self.__llm_adapter = OpenAIAdapter('', config.llm.api_key, config.llm.base_url)
-        await self.connect_to_servers()
+        if previous is None or self.__llm_adapter is None or previous.llm != config.llm:
+            self.__llm_adapter = OpenAIAdapter('', config.llm.api_key, config.llm.base_url)
+        await self.connect_to_servers(full=False)
         logger.info(f"MCPClient initialized with config: {config}")
 
-    async def connect_to_servers(self):
-        del self.__clients
-        self.__clients = {}
-        for server in self.__config.mcp_servers:
+    async def connect_to_servers(self, full: bool = True):
+        '''
+        并发连接服务器，最多等待 connect_timeout，没有连上的服务器在后台继续重试
+        full 为 False 时只关闭删除或配置变化的服务器，只连接新增或配置变化的服务器
+        '''
+        start = time.perf_counter()
+        servers = {server.name: server for server in self.__config.mcp_servers}
+        old_clients = self.__clients
+        removed = [
+            client for name, client in old_clients.items()
+            if full or name not in servers or client.config != servers[name]
+        ]
+        clients: dict[str, Client] = {}
+        added: list[Client] = []
+        for name, server in servers.items():
+            client = old_clients.get(name)
+            if client is not None and client not in removed:
+                client.apply(self.__config)
+                clients[name] = client
+                continue
             try:
-                if server.transport == "stdio":
-                    client = STDIOClient(server)
-                    await client.connect()
-                    self.__clients[server.name] = client
-                elif server.transport == "sse":
-                    client = SSEClient(server)
-                    await client.connect()
-                    self.__clients[server.name] = client
-                else:
-                    raise ValueError("Invalid transport")
-            except Exception as e:
-                logger.error(f"Failed to connect to server {server.name}: {e}")
+                client = self.__create_client(server)
+            except ValueError as e:
+                logger.error(f"Failed to connect to server {name}: {e}")
+                continue
+            clients[name] = client
+            added.append(client)
+        self.__clients = clients
+        if not removed and not added:
+            logger.info("MCP servers unchanged")
+            return
+        self.__registry.invalidate()
+        for client in added:
+            client.start()
+        # 关闭旧连接和等待新连接同时进行，stdio 服务器的子进程随连接一起退出
+        await asyncio.gather(
+            *[client.close() for client in removed],
+            *[client.connect(self.__config.connect_timeout) for client in added],
+        )
+        logger.info(
+            f"Reconfigured MCP servers in {time.perf_counter() - start:.3f}s: "
+            f"closed {[client.server_name for client in removed]}, connected {[client.report() for client in added]}, "
+            f"kept {[name for name, client in clients.items() if client not in added]}"
+        )
+
+    def __create_client(self, server: MCPServerConfig) -> Client:
+        if server.transport == "stdio":
+            client = STDIOClient(server)
+        elif server.transport == "sse":
+            client = SSEClient(server)
+        else:
+            raise ValueError("Invalid transport")
+        client.apply(self.__config)
+        # 服务器连接（包括后台重试成功）或工具列表变化时重新合并工具
+        client.on_tools_changed = self.__registry.invalidate
+        return client
+
+    async def close(self):
+        '''
+        关闭所有服务器的连接，并停止后台重试
+        '''
+        clients = list(self.__clients.values())
+        self.__clients = {}
+        self.__registry.invalidate()
+        await asyncio.gather(*[client.close() for client in clients])
+
+    def connection_report(self) -> list[dict]:
+        '''
+        每个服务器的连接状态、尝试次数和连接耗时
+        '''
+        return [client.report() for client in self.__clients.values()]
     
     async def process_query(self, model: str, query: str, history: list[dict] = None):
         '''
@@ -160,61 +526,115 @@ class MCPClient:
             messages = messages + [ message for message in history]
         messages.append({"role": "user", "content": query})
         tools, tool_name2server_name = await self.list_all_tools()
-        response: ChatResponse = await self.chat(model=model, messages=messages, tools=tools, stream=False)
+        response: ChatResponse = await self.chat(model=model, messages=await self.compact(model, messages), tools=tools, stream=False)
         logger.info(f"Response: {response}")
         while response.tool_calls:
             # 只要还有工具调用，就继续调用工具
-            for tool_call in response.tool_calls:
-                tool_response = await self.__call_tool(tool_name2server_name, tool_call.name, tool_call.arguments, tool_call.id)
+            results = [None] * len(response.tool_calls)
+            async for index, tool_response in self.__call_tools(tool_name2server_name, response.tool_calls):
+                results[index] = tool_response
+            for tool_call, tool_response in zip(response.tool_calls, results):
                 messages.append(self.__llm_adapter.tool_call_process(response, tool_call))
                 messages.append(tool_response)
-            response: ChatResponse = await self.chat(model=model, messages=messages, tools=tools, stream=False)
+            response: ChatResponse = await self.chat(model=model, messages=await self.compact(model, messages), tools=tools, stream=False)
         history = messages[1:]
         history.append({"role": "assistant", "content": response.content})
         return response.content, history
 
-    async def stream_process_query(self, model: str, query: str, history: list[dict] = None):
+    async def stream_process_query(self, model: str, query: str, history: list[dict] = None, transcript: list[dict] = None, chat_id: str = None, question: str = None):
         '''
         流式处理用户的问题
+        transcript 不为空时，正常结束后把本轮产生的消息（工具调用、工具结果、最终回答）追加到其中
+        chat_id 不为空且启用了长期记忆时，较早的历史只保留与 question（默认为 query）相关的轮次
         '''
         messages = []
         if history is not None:
             messages = messages + [message for message in history]
         messages.append({"role": "user", "content": query})
+        # configuration 依赖本模块，使用时才导入，避免循环导入
+        from live2d_server import memory
+        messages, report = await memory.recall(chat_id, messages, question)
+        if report is not None:
+            yield {"type": "memory", "content": report.to_dict()}
+        start = len(messages)
+        answer = []
         tools, tool_name2server_name = await self.list_all_tools()
 
         while True:
-            resp = await self.chat(model, messages, tools, stream=True)
-            async for chunk in resp:
-                logger.info(f"stream_process_query chunk: {chunk}")
-                if chunk.tool_calls:
-                    # 处理工具调用
-                    tool_call_resp = []
-                    for tool_call in chunk.tool_calls:
-                        tool_response = await self.__call_tool(tool_name2server_name, tool_call.name, tool_call.arguments, tool_call.id)
-                        messages.append(self.__llm_adapter.tool_call_process(chunk, tool_call))
-                        messages.append(tool_response)
-                        call = tool_call.model_dump()
-                        call['response'] = tool_response['content']
-                        tool_call_resp.append(call)
-                    yield {"type": "tool_calls", "content": tool_call_resp}
-                    break
+            resp = await self.chat(model, await self.compact(model, messages), tools, stream=True)
+            try:
+                async for chunk in resp:
+                    logger.debug(f"stream_process_query chunk: {chunk}")
+                    if chunk.tool_calls:
+                        # 处理工具调用，每个结果返回后立即推送，写入消息时仍按调用顺序
+                        results = [None] * len(chunk.tool_calls)
+                        async for index, tool_response in self.__call_tools(tool_name2server_name, chunk.tool_calls):
+                            results[index] = tool_response
+                            call = chunk.tool_calls[index].model_dump()
+                            call['response'] = tool_response['content']
+                            yield {"type": "tool_calls", "content": [call]}
+                        for tool_call, tool_response in zip(chunk.tool_calls, results):
+                            messages.append(self.__llm_adapter.tool_call_process(chunk, tool_call))
+                            messages.append(tool_response)
+                        break
+                    else:
+                        answer.append(chunk.content or "")
+                        yield {"type": "text", "content": chunk.content}
                 else:
-                    yield {"type": "text", "content": chunk.content}
-            else:
-                # 没有 tool_calls，正常结束
-                break
+                    # 没有 tool_calls，正常结束
+                    if transcript is not None:
+                        transcript.extend(messages[start:])
+                        transcript.append({"role": "assistant", "content": "".join(answer)})
+                    break
+            finally:
+                # 拿到工具调用后提前结束，或者调用方被取消时，关闭大模型的流
+                await resp.aclose()
+
+    async def compact(self, model: str, messages: list[dict]) -> list[dict]:
+        '''
+        按token预算压缩消息，较早的对话由同一个模型总结成摘要
+        '''
+        # configuration 依赖本模块，使用时才导入，避免循环导入
+        from live2d_server import compaction
+        return await compaction.history_compactor.prepare(messages, lambda prompt: self.__llm_adapter.generate(model, prompt))
+
+    async def __call_tools(self, tool_name2server_name: dict, tool_calls: list[ToolCall]) -> AsyncGenerator[tuple[int, dict], None]:
+        '''
+        并发执行一次回复中的所有工具调用，按完成的先后返回 (调用序号, 工具结果)
+        同一个服务器的调用受 tool_concurrency 限制，按调用顺序排队；某个调用出错时取消其余的调用
+        '''
+        tasks = {
+            asyncio.create_task(self.__call_tool(tool_name2server_name, tool_call.name, tool_call.arguments, tool_call.id)): index
+            for index, tool_call in enumerate(tool_calls)
+        }
+        pending = set(tasks)
+        failed = False
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=tasks.get):
+                    try:
+                        result = task.result()
+                    except Exception:
+                        failed = True
+                        raise
+                    yield tasks[task], result
+        finally:
+            for task in pending:
+                # 区分调用出错和客户端断开，服务器和统计中记录不同的原因
+                task.cancel(SIBLING_FAILED if failed else None)
+            await asyncio.gather(*pending, return_exceptions=True)
 
     async def __call_tool(self, tool_name2server_name: dict, name: str, args: dict, call_id: str) -> dict:
-        tool: Client = self.__clients[tool_name2server_name[name]]
-        tool_response: CallToolResult = await tool.call(args=args, tool_name=name)
-        logger.info(f"Tool {name} called with args: {args} and response: {tool_response}")
-        response_content = "\n".join([content.text for content in tool_response.content])
-        return {"role": "tool", "content": response_content, "tool_call_id": call_id}
+        return await self.call_tool(name, args, call_id, tool_name2server_name[name])
     
     async def call_tool(self, name: str, args: dict, call_id: str, server_name: str) -> dict:
         tool: Client = self.__clients[server_name]
-        tool_response: CallToolResult = await tool.call(args=args, tool_name=name)
+        try:
+            tool_response: CallToolResult = await tool.call(args=args, tool_name=name)
+        except TimeoutError:
+            logger.warning(f"Tool {name} timed out after {tool.tool_timeout}s")
+            return {"role": "tool", "content": f"工具 {name} 调用超时（{tool.tool_timeout}秒）", "tool_call_id": call_id}
         logger.info(f"Tool {name} called with args: {args} and response: {tool_response}")
         response_content = "\n".join([content.text for content in tool_response.content])
         return {"role": "tool", "content": response_content, "tool_call_id": call_id}
@@ -238,28 +658,35 @@ class MCPClient:
 
     async def __chat_stream(self, model: str, messages: list[dict], tools: list[Tool]) -> AsyncGenerator[ChatResponse, None]:
         resp = await self.__llm_adapter.chat(model=model, messages=messages, tools=tools, stream=True)
-        async for chunk in resp:
-            logger.info(f"chunk: {chunk}")
-            yield chunk
+        try:
+            async for chunk in resp:
+                logger.debug(f"chunk: {chunk}")
+                yield chunk
+        finally:
+            await resp.aclose()
 
     async def __chat_none_stream(self, model: str, messages: list[dict], tools: list[Tool]) -> ChatResponse:
         response: ChatResponse = await self.__llm_adapter.chat(model=model, messages=messages, tools=tools, stream=False)
         return response
 
-    async def list_all_tools(self) -> tuple[list[dict], dict]:
-        tools = []
-        for client in self.__clients.values():
-            tools.extend(await client.list_tools())
-        tool_name2server_name = {tool.function.name: tool.server_name for tool in tools}
-        if len(tool_name2server_name) == 0:
-            return None, None
-        return tools, tool_name2server_name
+    async def list_all_tools(self) -> tuple[ToolList, dict]:
+        '''
+        所有服务器的工具和工具名到服务器的索引，使用缓存的工具列表
+        '''
+        clients = list(self.__clients.values())
+        for client in clients:
+            # 只有服务器刚通知工具列表变化时才需要等待
+            await client.wait_refresh()
+        return self.__registry.get(clients)
 
     async def list_tools(self, name: str) -> ListToolsResult:
         return await self.__clients[name].list_tools_raw()
     
     async def get_client_session(self, name: str) -> ClientSession:
-        return self.__clients[name].session
+        client = self.__clients[name]
+        if client.session is None:
+            raise RuntimeError(f"MCP服务器 {name} 未连接: {client.error or client.status}")
+        return client.session
     
     async def get_server_details(self, name: str) -> dict:
         if name not in self.__clients:
@@ -299,3 +726,7 @@ def get_mcp_client() -> MCPClient:
 async def init_mcp_client(config: MCPClientConfig):
     global client
     await client.init(config)
+
+async def shutdown_mcp_client():
+    global client
+    await client.close()
@@ -0,0 +1,244 @@
+"""按token预算压缩发送给大模型的消息
+
+每次调用大模型前，消息总token数超过预算时，把较早的对话折叠成一段滚动摘要，只保留最近的几轮原文；
+过长的工具结果按预算截断。
+
+- 每条消息的token数按消息内容缓存，工具调用循环中重复发送的历史不会重新计算
+- 摘要按被折叠的消息前缀缓存，前缀变长时在上一次的摘要基础上只总结新增的消息
+- 已有摘要能让剩余消息满足预算时直接复用，不会每一轮都重新总结，只有剩余消息再次超出预算时
+  才把保留部分压缩到预算的 compactRatio，因此生成摘要的调用间隔较长，提示词长度和延迟保持稳定
+"""
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from live2d_server.configuration import ContextConfig
+from live2d_server.tokens import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """请把下面的对话总结成一段简洁的摘要，供之后继续对话时参考。
+保留用户的身份和偏好、已经确认的事实和结论、工具调用得到的关键结果以及尚未完成的事项，不要编造内容，不超过{max_tokens}个字。
+{previous}
+对话内容：
+{dialogue}
+
+只输出摘要本身。"""
+
+SUMMARY_MESSAGE = "以下是之前对话的摘要：\n{summary}"
+
+# 每条消息除内容外的格式开销
+MESSAGE_OVERHEAD = 4
+
+
+def _content(message: dict) -> str:
+    content = message.get("content")
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    return json.dumps(content, ensure_ascii=False)
+
+
+def _key(message: dict) -> tuple:
+    # 字符串对象会缓存自己的哈希值，同一条消息重复计算键的开销很小
+    content = message.get("content")
+    tool_calls = message.get("tool_calls") or ()
+    return (
+        message.get("role"),
+        hash(content) if isinstance(content, str) else hash(_content(message)),
+        message.get("tool_call_id"),
+        tuple(call.get("id") for call in tool_calls),
+    )
+
+
+def _put(cache: OrderedDict, key, value, size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+
+class HistoryCompactor:
+
+    def __init__(self, config: ContextConfig):
+        self.config = config
+        self._tokens: OrderedDict[tuple, int] = OrderedDict()
+        self._truncated: OrderedDict[tuple, dict] = OrderedDict()
+        # 被折叠的消息前缀（链式哈希）-> 摘要
+        self._summaries: OrderedDict[int, str] = OrderedDict()
+        self.counts = {
+            "prompts": 0, # 处理的提示词数量
+            "compacted": 0, # 超出预算被压缩的提示词数量
+            "summaries": 0, # 生成摘要的次数
+            "summary_failures": 0, # 生成摘要失败或超时、直接丢弃旧消息的次数
+            "truncated_tools": 0, # 被截断的工具结果数量
+            "tokens_in": 0, # 压缩前的token数
+            "tokens_out": 0, # 压缩后的token数
+        }
+
+    def message_tokens(self, message: dict) -> int:
+        key = _key(message)
+        tokens = self._tokens.get(key)
+        if tokens is None:
+            tokens = estimate_tokens(_content(message)) + MESSAGE_OVERHEAD
+            if message.get("tool_calls"):
+                tokens += estimate_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+            _put(self._tokens, key, tokens, self.config.cacheSize)
+        else:
+            self._tokens.move_to_end(key)
+        return tokens
+
+    async def prepare(self, messages: list[dict], summarize: Callable[[str], Awaitable[str]]) -> list[dict]:
+        '''
+        返回满足token预算的消息列表，不修改传入的消息
+        summarize 接收总结用的提示词，返回摘要
+        '''
+        if self.config.maxTokens <= 0:
+            return messages
+        self.counts["prompts"] += 1
+        messages = [self._truncate_tool(message) for message in messages]
+        # 开头的系统提示词总是保留
+        start = 0
+        while start < len(messages) and messages[start].get("role") == "system":
+            start += 1
+        head, body = messages[:start], messages[start:]
+        tokens = [self.message_tokens(message) for message in body]
+        total = sum(tokens)
+        self.counts["tokens_in"] += total
+        if total <= self.config.maxTokens:
+            self.counts["tokens_out"] += total
+            return head + body
+
+        self.counts["compacted"] += 1
+        chain = self._chain(body)
+        # suffix[i] 为 body[i:] 的token数
+        suffix = [0] * (len(body) + 1)
+        for index in range(len(body) - 1, -1, -1):
+            suffix[index] = suffix[index + 1] + tokens[index]
+        summary_budget = self.config.summaryTokens + MESSAGE_OVERHEAD
+
+        # 优先复用已有的摘要
+        cut, summary = self._cached_cut(body, chain, suffix, summary_budget)
+        if summary is None:
+            cut = self._choose_cut(body, suffix, summary_budget)
+            summary = await self._summarize(body, chain, cut, summarize)
+
+        result = list(head)
+        if summary:
+            result.append({"role": "system", "content": SUMMARY_MESSAGE.format(summary=summary)})
+        result.extend(body[cut:])
+        self.counts["tokens_out"] += suffix[cut] + (estimate_tokens(summary) + MESSAGE_OVERHEAD if summary else 0)
+        logger.info(f"history compacted: {total} -> {suffix[cut]} tokens, {cut} messages folded into summary")
+        return result
+
+    def _truncate_tool(self, message: dict) -> dict:
+        limit = self.config.toolOutputTokens
+        if message.get("role") != "tool" or limit <= 0 or self.message_tokens(message) <= limit + MESSAGE_OVERHEAD:
+            return message
+        key = _key(message)
+        truncated = self._truncated.get(key)
+        if truncated is None:
+            content = truncate_to_tokens(_content(message), limit)
+            truncated = {**message, "content": content + "\n……（内容过长，已截断）"}
+            _put(self._truncated, key, truncated, self.config.cacheSize)
+            self.counts["truncated_tools"] += 1
+        return truncated
+
+    def _chain(self, body: list[dict]) -> list[int]:
+        '''
+        chain[i] 标识前缀 body[:i]
+        '''
+        chain = [0]
+        for message in body:
+            chain.append(hash((chain[-1], _key(message))))
+        return chain
+
+    @staticmethod
+    def _boundaries(body: list[dict]) -> list[int]:
+        # 只在用户消息之前切分，不会把工具调用和对应的工具结果分开；最后一条用户消息必须保留原文
+        return [index for index, message in enumerate(body) if message.get("role") == "user"]
+
+    def _cached_cut(self, body: list[dict], chain: list[int], suffix: list[int], summary_budget: int) -> tuple[int, str | None]:
+        for cut in reversed(self._boundaries(body)):
+            if cut == 0:
+                break
+            summary = self._summaries.get(chain[cut])
+            if summary is not None:
+                if suffix[cut] + summary_budget > self.config.maxTokens:
+                    # 更早的摘要留下的消息只会更多
+                    break
+                self._summaries.move_to_end(chain[cut])
+                return cut, summary
+        return 0, None
+
+    def _choose_cut(self, body: list[dict], suffix: list[int], summary_budget: int) -> int:
+        '''
+        保留部分压缩到预算的 compactRatio，为之后的几轮留出空间
+        '''
+        boundaries = self._boundaries(body)
+        if not boundaries:
+            return 0
+        target = max(0, self.config.maxTokens * self.config.compactRatio - summary_budget)
+        for cut in boundaries:
+            if suffix[cut] <= target:
+                return cut
+        # 最后一轮本身就超出目标时只保留最后一轮
+        return boundaries[-1]
+
+    async def _summarize(self, body: list[dict], chain: list[int], cut: int, summarize: Callable[[str], Awaitable[str]]) -> str:
+        if cut == 0:
+            return ""
+        if chain[cut] in self._summaries:
+            return self._summaries[chain[cut]]
+        # 找到最长的已经总结过的前缀，只总结之后新增的消息
+        start, previous = 0, ""
+        for index in range(cut - 1, 0, -1):
+            summary = self._summaries.get(chain[index])
+            if summary is not None:
+                start, previous = index, summary
+                break
+        dialogue = "\n".join(self._format(message) for message in body[start:cut])
+        prompt = SUMMARY_PROMPT.format(
+            max_tokens=self.config.summaryTokens,
+            previous=f"之前的摘要：\n{previous}\n" if previous else "",
+            dialogue=truncate_to_tokens(dialogue, self.config.maxTokens),
+        )
+        try:
+            summary = await asyncio.wait_for(summarize(prompt), self.config.summaryTimeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 生成摘要失败时退回到之前的摘要，中间的消息直接丢弃
+            logger.warning(f"history summary failed: {e!r}")
+            self.counts["summary_failures"] += 1
+            return previous
+        summary = truncate_to_tokens((summary or "").strip(), self.config.summaryTokens)
+        _put(self._summaries, chain[cut], summary, self.config.cacheSize)
+        self.counts["summaries"] += 1
+        return summary
+
+    def _format(self, message: dict) -> str:
+        role = message.get("role")
+        content = truncate_to_tokens(_content(message), self.config.toolOutputTokens or self.config.maxTokens)
+        if message.get("tool_calls"):
+            functions = [call.get("function", {}) for call in message["tool_calls"]]
+            calls = ", ".join(f"{function.get('name')}({function.get('arguments')})" for function in functions)
+            return f"{role}: {content} 调用工具 {calls}"
+        return f"{role}: {content}"
+
+    def stats(self) -> dict:
+        return {**self.counts, "cached_messages": len(self._tokens), "cached_summaries": len(self._summaries)}
+
+
+history_compactor = HistoryCompactor(ContextConfig())
+
+
+def configure(config: ContextConfig):
+    global history_compactor
+    if config == history_compactor.config:
+        return
+    history_compactor = HistoryCompactor(config)
@@ -1,7 +1,12 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Literal
 from pydantic import BaseModel
 from live2d_server.client import LLMConfig, MCPServerConfig
 
+class VoiceConfig(BaseModel):
+    name: str
+    promptPath: str
+    promptText: str
+
 class TTSConfig(BaseModel):
     enabled: bool = False
     modulePath: str = ""
@@ -9,6 +14,96 @@ class TTSConfig(BaseModel):
     promptText: str = ""
     sampleRate: int = 16000
     cosyvoiceInstallPath: str = ""
+    backend: Literal["eager", "jit", "onnx", "int8"] = "eager" # 推理后端，可用 tts_benchmark 比较各后端在当前机器上的速度
+    intraOpThreads: int = 0 # 算子内线程数，0表示使用默认值；多个工作进程时建议设为 CPU核数/工作进程数
+    workers: int = 1 # TTS工作进程数量
+    queueSize: int = 32 # 等待合成的任务队列长度，队列满时提交任务会等待
+    cacheEnabled: bool = True # 是否缓存合成结果
+    cacheMemoryBytes: int = 64 * 1024 * 1024 # 内存缓存的字节数上限
+    cacheDir: str = "cache/tts" # 磁盘缓存目录，为空时不使用磁盘缓存
+    cacheDiskBytes: int = 1024 * 1024 * 1024 # 磁盘缓存的字节数上限
+    lookahead: int = 4 # 每次回复最多同时合成的句子数
+    stream: bool = False # 聊天时是否使用流式合成，逐帧输出PCM数据
+    streamFrameSize: int = 2400 # 流式合成时每帧的采样点数
+    lipSync: bool = True # 是否在服务端计算口型包络，随音频一起下发
+    lipSyncFps: int = 30 # 口型包络的帧率，应与Live2D模型的渲染帧率一致
+    httpCacheMaxAge: int = 7 * 24 * 3600 # /api/tts 响应的 Cache-Control max-age，单位秒
+    voices: List[VoiceConfig] = [] # 额外预加载的音色，可在请求中按名称选择
+    defaultVoice: str = "default" # 未指定音色时使用的音色，promptPath/promptText 对应的音色名为 default
+
+    def all_voices(self) -> List[VoiceConfig]:
+        voices = list(self.voices)
+        if self.promptPath:
+            voices.insert(0, VoiceConfig(name="default", promptPath=self.promptPath, promptText=self.promptText))
+        return voices
+
+class SearchConfig(BaseModel):
+    searxHost: str = "http://localhost:8080" # SearxNG 服务地址，需要在 settings.yml 中开启 json 格式
+    engines: List[str] = ["bing", "duckduckgo", "baidu"] # 并发请求的搜索引擎
+    engineTimeout: float = 5.0 # 单个搜索引擎的超时时间，单位秒，超时的引擎不参与结果合并
+    resultCount: int = 5 # 合并后返回的结果数量
+    maxConnections: int = 10 # 连接池的最大连接数
+    cacheTtl: float = 600 # 搜索结果的缓存时间，单位秒
+    cacheSize: int = 256 # 最多缓存的查询数量
+
+class FetchConfig(BaseModel):
+    httpTimeout: float = 10.0 # 直接HTTP请求页面的超时时间，单位秒
+    maxConnections: int = 10 # HTTP连接池的最大连接数
+    userAgent: str = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+    minTextChars: int = 200 # HTTP获取的页面可见文本少于该长度时，认为内容由JavaScript生成，改用浏览器渲染
+    browserPoolSize: int = 2 # 无头浏览器实例数量，即同时渲染的页面数，0表示不使用浏览器
+    browserWarmUp: bool = False # 是否在服务启动时预先启动所有浏览器实例，否则在第一次使用时启动
+    browserTimeout: float = 15.0 # 浏览器等待页面就绪的最长时间，单位秒
+    networkIdle: float = 0.5 # 浏览器在这段时间内没有新的资源请求时认为页面加载完成，单位秒
+    maxTokens: int = 3000 # 提取的正文超过该token数时截断
+    cacheTtl: float = 3600 # 正文缓存的有效期，单位秒，过期后带 ETag/Last-Modified 重新验证
+    cacheMemoryBytes: int = 16 * 1024 * 1024 # 正文内存缓存的字节数上限
+    cacheDir: str = "cache/pages" # 正文磁盘缓存目录，为空时不使用磁盘缓存
+    cacheDiskBytes: int = 256 * 1024 * 1024 # 正文磁盘缓存的字节数上限
+
+class RetrievalConfig(BaseModel):
+    webSearchTimeout: float = 8.0 # 网络搜索（含构建搜索词）的超时时间，单位秒，超时后不使用该检索源的结果
+    ragTimeout: float = 5.0 # 知识库检索（含构建搜索词）的超时时间，单位秒
+    queryBuilder: Literal["auto", "keywords", "llm"] = "auto" # 搜索词构建方式，auto 表示仅在问题有歧义时使用大模型改写
+    keywordMethod: Literal["tfidf", "textrank"] = "tfidf" # 本地关键词提取算法
+    keywordTopK: int = 8 # 搜索词中最多包含的关键词数量
+    keywordHistoryTurns: int = 2 # 关键词不足时，从最近几条历史消息中补充
+    ambiguousMinChars: int = 6 # 有对话历史时，短于该长度的追问视为有歧义
+    ambiguousWords: List[str] = [
+        "它", "他", "她", "这个", "那个", "这些", "那些", "这里", "那里", "上面", "刚才", "之前", "继续", "还有呢",
+        "it", "this", "that", "they", "them",
+    ] # 包含这些指代词时视为有歧义
+
+class SseConfig(BaseModel):
+    coalesceWindowMs: float = 15 # 合并连续文本增量的时间窗口，单位毫秒，0表示每个增量单独发送
+    coalesceBytes: int = 256 # 合并的文本达到该字节数时立即发送
+    replayBufferBytes: int = 1024 * 1024 # 每个聊天的回放缓冲区大小，超出后淘汰最早的事件
+    replayTtl: float = 300 # 生成结束后回放缓冲区保留的时间，单位秒
+    replayMaxStreams: int = 100 # 最多保留的回放缓冲区数量
+    resumeGrace: float = 30 # 客户端断开后等待重新连接的时间，超时后取消生成，单位秒
+
+class ContextConfig(BaseModel):
+    maxTokens: int = 8000 # 发送给大模型的消息（不含系统提示词）的token预算，超出时把较早的对话折叠成摘要，0表示不限制
+    compactRatio: float = 0.5 # 压缩时保留的原文占预算的比例，剩余空间留给之后的几轮对话
+    toolOutputTokens: int = 2000 # 单个工具结果的token上限，超出部分截断，0表示不截断
+    summaryTokens: int = 400 # 摘要的token上限
+    summaryTimeout: float = 20 # 生成摘要的超时时间，超时后直接丢弃较早的消息，单位秒
+    cacheSize: int = 4096 # 缓存的消息token数和摘要的数量
+
+class MemoryConfig(BaseModel):
+    enabled: bool = False # 是否启用长期记忆，启用后会加载知识库使用的嵌入模型
+    recentTurns: int = 3 # 保留原文的最近轮数（不含当前这一轮）
+    topK: int = 3 # 从较早的轮次中找回的最大轮数
+    minScore: float = 0.35 # 余弦相似度低于该值的轮次不放回提示词
+    minHistoryTokens: int = 800 # 较早的轮次少于该token数时不检索，直接发送完整历史
+    crossChat: bool = False # 是否同时检索其他会话中的内容
+    maxTurnChars: int = 2000 # 每一轮用于向量化的最大字符数
+    collection: str = "conversation_memory" # Milvus 集合名称
+
+class ConversationConfig(BaseModel):
+    enabled: bool = True # 是否在服务端保存会话，开启后请求可以只发送新的消息
+    path: str = "data/conversations.db" # SQLite 数据库文件
+    cacheChats: int = 64 # 在内存中保留最近使用的会话数量
 
 class ServerConfig(BaseModel):
     pythonExec: str = ""
@@ -17,6 +112,13 @@ class ServerConfig(BaseModel):
     host: str = '0.0.0.0'
     staticPath: str = ''
     tts: TTSConfig = TTSConfig()
+    search: SearchConfig = SearchConfig()
+    fetch: FetchConfig = FetchConfig()
+    retrieval: RetrievalConfig = RetrievalConfig()
+    sse: SseConfig = SseConfig()
+    conversation: ConversationConfig = ConversationConfig()
+    context: ContextConfig = ContextConfig()
+    memory: MemoryConfig = MemoryConfig()
     mcp_servers: List[MCPServerConfig] = []
     llm: LLMConfig | None = None
     
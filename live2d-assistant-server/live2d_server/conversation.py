@@ -0,0 +1,179 @@
+"""服务端的会话存储
+
+按 chat_id 保存每一轮对话的消息（用户消息、带工具调用的助手消息、工具结果、最终回答），
+使用 WAL 模式的 SQLite，消息只追加不修改。客户端只需要发送新的一轮消息，
+历史消息由服务端补全；仍然发送完整历史的客户端以客户端为准，客户端没有工具调用和工具结果，
+只比较用户和助手的文本，从第一条不一致的消息开始用客户端的消息替换，一致时不需要写入。
+最近使用的会话在内存中保留解码后的消息列表，避免每次请求都重新读取和解析。
+推理模型回答中的思考过程（<think>…</think>）不保存，前端保存的回答也不一定带有思考过程，比较时同样去掉。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from live2d_server.configuration import ConversationConfig
+
+logger = logging.getLogger(__name__)
+
+_THINK = re.compile(r"<think>.*?</think>\s*", re.S)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID
+"""
+
+
+class ConversationStore:
+
+    def __init__(self, config: ConversationConfig):
+        self.config = config
+        directory = os.path.dirname(config.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(config.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 不会损坏数据库，只可能丢失掉电前最后几次提交
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        self._lock = threading.RLock()
+        self._cache: OrderedDict[str, list[dict]] = OrderedDict()
+
+    async def history(self, chat_id: str) -> list[dict]:
+        '''
+        会话中已保存的所有消息，返回的是副本，可以直接修改
+        '''
+        return list(await asyncio.to_thread(self._history, chat_id))
+
+    async def append(self, chat_id: str, messages: list[dict]):
+        if messages:
+            await asyncio.to_thread(self._append, chat_id, [_strip_think(message) for message in messages])
+
+    async def sync(self, chat_id: str, history: list[dict]):
+        '''
+        客户端发送了完整历史时调用：客户端编辑或删除了消息、存储启用前的会话等与存储不一致时以客户端为准
+        '''
+        await asyncio.to_thread(self._sync, chat_id, history)
+
+    async def delete(self, chat_id: str):
+        await asyncio.to_thread(self._delete, chat_id)
+
+    def _history(self, chat_id: str) -> list[dict]:
+        with self._lock:
+            messages = self._cache.get(chat_id)
+            if messages is None:
+                rows = self._conn.execute("SELECT message FROM turns WHERE chat_id = ? ORDER BY seq", (chat_id,)).fetchall()
+                messages = [json.loads(row[0]) for row in rows]
+                self._remember(chat_id, messages)
+            else:
+                self._cache.move_to_end(chat_id)
+            return messages
+
+    def _append(self, chat_id: str, messages: list[dict]):
+        with self._lock:
+            history = self._history(chat_id)
+            self._write(chat_id, len(history), messages)
+            history.extend(messages)
+
+    def _sync(self, chat_id: str, history: list[dict]):
+        with self._lock:
+            stored = self._history(chat_id)
+            # (存储中的序号, 消息)，工具调用和工具结果只在服务端保存，不参与比较
+            visible = [(index, message) for index, message in enumerate(stored) if _is_text(message)]
+            client = [_strip_think(message) for message in history if _is_text(message)]
+            same = 0
+            for (_, message), other in zip(visible, client):
+                if message.get("role") != other.get("role") or _strip_think(message).get("content") != other.get("content"):
+                    break
+                same += 1
+            if same == len(visible) and same == len(client):
+                return
+            # 从第一条不一致的文本消息所在的位置开始替换，之前的工具调用和工具结果保留
+            start = visible[same - 1][0] + 1 if same > 0 else 0
+            added = client[same:]
+            self._write(chat_id, start, added, truncate=same < len(visible))
+            del stored[start:]
+            stored.extend(added)
+        logger.info(f"conversation {chat_id}: replaced {len(visible) - same} stored messages with {len(added)} from client")
+
+    def _delete(self, chat_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE chat_id = ?", (chat_id,))
+            self._cache.pop(chat_id, None)
+
+    def _write(self, chat_id: str, start: int, messages: list[dict], truncate: bool = False):
+        '''
+        在一个事务中从序号 start 开始写入消息，truncate 时先删除该会话序号不小于 start 的消息
+        '''
+        now = time.time()
+        rows = [
+            (chat_id, start + index, message.get("role", ""), json.dumps(message, ensure_ascii=False), now)
+            for index, message in enumerate(messages)
+        ]
+        self._conn.execute("BEGIN")
+        try:
+            if truncate:
+                self._conn.execute("DELETE FROM turns WHERE chat_id = ? AND seq >= ?", (chat_id, start))
+            self._conn.executemany("INSERT INTO turns (chat_id, seq, role, message, created) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _remember(self, chat_id: str, messages: list[dict]):
+        self._cache[chat_id] = messages
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.config.cacheChats:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _is_text(message: dict) -> bool:
+    return message.get("role") in ("user", "assistant") and not message.get("tool_calls")
+
+
+def _strip_think(message: dict) -> dict:
+    '''
+    去掉助手消息中的思考过程，返回新的消息，不修改原消息
+    '''
+    content = message.get("content")
+    if message.get("role") != "assistant" or not isinstance(content, str) or "<think>" not in content:
+        return message
+    return {**message, "content": _THINK.sub("", content)}
+
+
+conversation_store: ConversationStore | None = None
+
+
+def configure(config: ConversationConfig):
+    '''
+    按配置打开会话存储，未启用时为 None
+    '''
+    global conversation_store
+    if conversation_store is not None and conversation_store.config == config:
+        return
+    if conversation_store is not None:
+        conversation_store.close()
+    conversation_store = ConversationStore(config) if config.enabled else None
+
+
+def shutdown():
+    global conversation_store
+    if conversation_store is not None:
+        conversation_store.close()
+        conversation_store = None
@@ -1,6 +1,6 @@
 import asyncio
 import threading
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 from langchain_core.tools import BaseTool, StructuredTool
 from langchain_mcp_adapters.tools import NonTextContent, _convert_call_tool_result
@@ -27,7 +27,7 @@ def run_async(coro):  # coro is a couroutine, see example
     return future.result()
 
 def new_convert_mcp_tool_to_langchain_tool(
-    session: ClientSession,
+    get_session: Callable[[], Awaitable[ClientSession]],
     tool: MCPTool,
 ) -> BaseTool:
     """Convert an MCP tool to a LangChain tool.
@@ -35,7 +35,9 @@ def new_convert_mcp_tool_to_langchain_tool(
     NOTE: this tool can be executed only in a context of an active MCP client session.
 
     Args:
-        session: MCP client session
+        get_session: returns the current MCP client session, called on every tool call
+            so that a reconnected server is used instead of the session that was open
+            when the tool was converted
         tool: MCP tool to convert
 
     Returns:
@@ -46,6 +48,7 @@ def new_convert_mcp_tool_to_langchain_tool(
         **arguments: dict[str, Any],
     ) -> tuple[str | list[str], list[NonTextContent] | None]:
         print(f"调用工具 {tool.name} 参数 {arguments}")
+        session = await get_session()
         call_tool_result = await session.call_tool(tool.name, arguments)
         print(f"工具 {tool.name} 返回结果 {call_tool_result}")
         return _convert_call_tool_result(call_tool_result)
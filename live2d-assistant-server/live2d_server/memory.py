@@ -0,0 +1,276 @@
+"""基于检索的长期会话记忆
+
+长对话不再把所有历史原样发给大模型：最近的 recentTurns 轮保留原文，更早的每一轮
+（用户消息和随后的助手消息、工具结果）向量化后存入 Milvus，只把与当前问题相关的几轮按原来的顺序放回提示词。
+
+- 复用 MilvusRAGSystem 已经加载的嵌入模型和 Milvus 客户端，记忆保存在单独的集合中
+- 每一轮只向量化一次，id 中带有内容摘要，客户端修改历史后会作为新的一轮重新索引
+- 仍在最近窗口中的轮次在后台提前索引，之后移出窗口时不需要在请求中等待向量化
+- 每次请求报告历史消息的token数和因此少发送的token数
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+
+from live2d_server.configuration import MemoryConfig
+from live2d_server.rag.rag import get_rag_system
+from live2d_server.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# LangChain 消息的 type 与 OpenAI 消息 role 的对应关系
+_ROLES = {"human": "user", "ai": "assistant", "tool": "tool", "system": "system"}
+
+# 保存到 Milvus 的文本长度上限（VARCHAR 字段的限制）
+MAX_TEXT_LENGTH = 65535
+
+
+def _role(message) -> str:
+    if isinstance(message, dict):
+        return message.get("role", "")
+    return _ROLES.get(getattr(message, "type", ""), "")
+
+
+def _text(message) -> str:
+    content = message.get("content") if isinstance(message, dict) else getattr(message, "content", "")
+    if content is None:
+        return ""
+    return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+
+
+def split_turns(messages: list) -> tuple[list, list[list]]:
+    '''
+    把消息分成开头的系统消息和若干轮，每一轮从一条用户消息开始
+    '''
+    start = 0
+    while start < len(messages) and _role(messages[start]) == "system":
+        start += 1
+    turns: list[list] = []
+    for message in messages[start:]:
+        if _role(message) == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return messages[:start], turns
+
+
+@dataclass
+class Turn:
+    id: str
+    text: str
+    messages: list
+    tokens: int
+
+
+@dataclass
+class RecallReport:
+    turns: int = 0 # 较早的轮数
+    recalled: int = 0 # 放回提示词的轮数
+    history_tokens: int = 0 # 较早的轮次的token数
+    recalled_tokens: int = 0 # 放回提示词的token数
+    embedded: int = 0 # 本次请求中等待向量化的轮数
+    elapsed: float = 0.0 # 秒
+    cross_chat: list[str] = field(default_factory=list) # 其他会话中相关的内容
+
+    @property
+    def avoided_tokens(self) -> int:
+        return self.history_tokens - self.recalled_tokens
+
+    def to_dict(self) -> dict:
+        return {
+            "turns": self.turns,
+            "recalled": self.recalled,
+            "history_tokens": self.history_tokens,
+            "avoided_tokens": self.avoided_tokens,
+            "embedded": self.embedded,
+            "elapsed_ms": round(self.elapsed * 1000, 1),
+        }
+
+
+class ConversationMemory:
+
+    def __init__(self, config: MemoryConfig):
+        self.config = config
+        self._ready = False
+        # 每个会话已经索引的轮次 id
+        self._indexed: dict[str, set[str]] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._background: set[asyncio.Task] = set()
+        self.counts = {"requests": 0, "recalled": 0, "embedded": 0, "history_tokens": 0, "avoided_tokens": 0}
+
+    async def recall(self, key: str, messages: list, question: str | None = None) -> tuple[list, RecallReport | None]:
+        '''
+        返回只包含相关历史的消息列表，消息可以是 OpenAI 格式的字典或 LangChain 消息；
+        历史不够长、不需要检索时原样返回，报告为 None
+        '''
+        head, turns = split_turns(messages)
+        recent_count = max(1, self.config.recentTurns + 1) # 加上当前这一轮
+        if len(turns) <= recent_count:
+            return messages, None
+        start = time.perf_counter()
+        old = [self._turn(key, index, turn) for index, turn in enumerate(turns[:-recent_count])]
+        recent = turns[-recent_count:]
+        report = RecallReport(turns=len(old), history_tokens=sum(turn.tokens for turn in old))
+        if report.history_tokens < self.config.minHistoryTokens:
+            return messages, None
+        if question is None:
+            question = _text(recent[-1][0])
+
+        try:
+            report.embedded = await self._index(key, old)
+            hits = await self._search(key, question)
+        except Exception as e:
+            # 记忆不可用时退回到发送完整历史
+            logger.warning(f"memory recall for {key} failed: {e!r}")
+            return messages, None
+        ids = {hit["id"] for hit in hits if hit["chat_id"] == key}
+        selected = [turn for turn in old if turn.id in ids][-self.config.topK:]
+        report.recalled = len(selected)
+        report.recalled_tokens = sum(turn.tokens for turn in selected)
+        report.cross_chat = [hit["text"] for hit in hits if hit["chat_id"] != key]
+
+        result = list(head)
+        if report.cross_chat:
+            result.append({"role": "system", "content": "其他对话中可能相关的内容：\n" + "\n\n".join(report.cross_chat)})
+        for turn in selected:
+            result.extend(turn.messages)
+        for turn in recent:
+            result.extend(turn)
+        report.elapsed = time.perf_counter() - start
+
+        # 最近窗口中已经完成的轮次提前在后台索引，当前这一轮还没有回答
+        pending = [self._turn(key, len(old) + index, turn) for index, turn in enumerate(recent[:-1])]
+        if pending:
+            task = asyncio.create_task(self._index(key, pending))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+        self.counts["requests"] += 1
+        self.counts["recalled"] += report.recalled
+        self.counts["history_tokens"] += report.history_tokens
+        self.counts["avoided_tokens"] += report.avoided_tokens
+        logger.info(f"memory {key}: recalled {report.recalled}/{report.turns} turns, avoided {report.avoided_tokens} tokens")
+        return result, report
+
+    def _turn(self, key: str, index: int, messages: list) -> Turn:
+        lines = []
+        for message in messages:
+            text = _text(message)
+            if _role(message) == "tool":
+                text = text[:self.config.maxTurnChars // 4]
+            if text:
+                lines.append(f"{_role(message)}: {text}")
+        text = "\n".join(lines)[:self.config.maxTurnChars]
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+        return Turn(id=f"{key}:{index}:{digest}", text=text, messages=messages, tokens=sum(estimate_tokens(_text(message)) for message in messages))
+
+    async def _index(self, key: str, turns: list[Turn]) -> int:
+        '''
+        向量化还没有索引的轮次，返回新索引的数量
+        '''
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            await self._ensure_collection()
+            indexed = self._indexed.get(key)
+            if indexed is None:
+                indexed = self._indexed[key] = await self._run(self._existing_ids, key)
+            missing = [turn for turn in turns if turn.id not in indexed and turn.text]
+            if not missing:
+                return 0
+            rag = get_rag_system()
+            vectors = await self._run(rag.embeddings.embed_documents, [turn.text for turn in missing])
+            rows = [
+                {"id": turn.id, "chat_id": key, "text": turn.text[:MAX_TEXT_LENGTH], "embedding": vector}
+                for turn, vector in zip(missing, vectors)
+            ]
+            await self._run(rag.client.insert, collection_name=self.config.collection, data=rows)
+            indexed.update(turn.id for turn in missing)
+            self.counts["embedded"] += len(missing)
+            return len(missing)
+
+    async def _search(self, key: str, question: str) -> list[dict]:
+        rag = get_rag_system()
+        vector = await self._run(rag.embeddings.embed_query, question)
+        results = await self._run(
+            rag.client.search,
+            collection_name=self.config.collection,
+            data=[vector],
+            anns_field="embedding",
+            search_params={"metric_type": "COSINE"},
+            # 最近的轮次也可能已经索引，多取几条，保证较早的轮次有 topK 条候选
+            limit=self.config.topK + self.config.recentTurns,
+            filter=None if self.config.crossChat else f'chat_id == "{_escape(key)}"',
+            output_fields=["chat_id", "text"],
+        )
+        return [
+            {"id": result["id"], "chat_id": result["entity"]["chat_id"], "text": result["entity"]["text"]}
+            for result in results[0]
+            if result["distance"] >= self.config.minScore
+        ]
+
+    def _existing_ids(self, key: str) -> set[str]:
+        rows = get_rag_system().client.query(
+            collection_name=self.config.collection,
+            filter=f'chat_id == "{_escape(key)}"',
+            output_fields=["id"],
+        )
+        return {row["id"] for row in rows}
+
+    async def _ensure_collection(self):
+        if self._ready:
+            return
+        # 第一次使用时才加载嵌入模型，加载比较慢，不阻塞事件循环
+        rag = await asyncio.to_thread(get_rag_system)
+        if not await self._run(rag.client.has_collection, self.config.collection):
+            dimension = len(await self._run(rag.embeddings.embed_query, "维度"))
+            await self._run(self._create_collection, dimension)
+        self._ready = True
+
+    def _create_collection(self, dimension: int):
+        from pymilvus import DataType
+        client = get_rag_system().client
+        schema = client.create_schema(auto_id=False, enable_dynamic_field=False)
+        schema.add_field(field_name="id", datatype=DataType.VARCHAR, max_length=512, is_primary=True)
+        schema.add_field(field_name="chat_id", datatype=DataType.VARCHAR, max_length=256)
+        schema.add_field(field_name="text", datatype=DataType.VARCHAR, max_length=MAX_TEXT_LENGTH)
+        schema.add_field(field_name="embedding", datatype=DataType.FLOAT_VECTOR, dim=dimension)
+        index_params = client.prepare_index_params()
+        # 每个会话的轮数不多，使用精确检索
+        index_params.add_index(field_name="embedding", index_type="FLAT", metric_type="COSINE")
+        client.create_collection(collection_name=self.config.collection, schema=schema, index_params=index_params)
+        logger.info(f"Created collection {self.config.collection}")
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        # 嵌入模型和 Milvus 客户端都是同步的，放到RAG系统的线程池中执行
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_rag_system().executor, lambda: func(*args, **kwargs))
+
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+conversation_memory: ConversationMemory | None = None
+
+
+def configure(config: MemoryConfig):
+    '''
+    按配置启用长期记忆，未启用时为 None
+    '''
+    global conversation_memory
+    if conversation_memory is not None and conversation_memory.config == config:
+        return
+    conversation_memory = ConversationMemory(config) if config.enabled else None
+
+
+async def recall(key: str | None, messages: list, question: str | None = None) -> tuple[list, RecallReport | None]:
+    if conversation_memory is None or not key:
+        return messages, None
+    return await conversation_memory.recall(key, messages, question)
@@ -11,3 +11,10 @@ class Tool(BaseModel):
     function: ToolFunction
     server_name: str
     instance: Any | None = None
+
+class ToolList(list):
+    """工具列表，同时保存预先转换好的 OpenAI 格式，列表不变时每次调用大模型都直接复用"""
+
+    def __init__(self, tools: list[Tool], openai_tools: list[dict] | None):
+        super().__init__(tools)
+        self.openai_tools = openai_tools
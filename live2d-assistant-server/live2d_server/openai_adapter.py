@@ -1,10 +1,12 @@
 from openai import AsyncOpenAI
+import asyncio
 from typing import AsyncGenerator, Literal, overload
 from live2d_server.chat_response import ChatResponse, ToolCall
 import json
 # from typing_extensions import overload
 import logging
-from live2d_server.model import Tool
+from live2d_server.model import Tool, ToolList
+from live2d_server.cancellation import cancel_stats
 
 logger = logging.getLogger(__name__)
 
@@ -41,38 +43,45 @@ class OpenAIAdapter():
 
     async def _chat_stream(self, model: str, messages: list[dict], tools: list[Tool]) -> AsyncGenerator[ChatResponse, None]:
         resp = await self.openai_client.chat.completions.create(model=model, messages=messages, tools=self.tool_to_openai_tool(tools), stream=True)
-        tool_calls = {}
-        async for chunk in resp:
-            if len(chunk.choices) > 0:
-                if chunk.choices[0].delta.tool_calls is not None:
-                    # 如果有工具调用，在这里等待工具调用完了之后再返回
-                    for tool_call in chunk.choices[0].delta.tool_calls:
-                        id = tool_call.id
-                        index = tool_call.index
-                        name = tool_call.function.name
-                        arguments = tool_call.function.arguments
-                        previous_tool_call = tool_calls.get(index)
-                        if previous_tool_call is None:
-                            tool_calls[index] = ToolCall(id=id, name=name, arguments=arguments)
-                        else:
-                            tool_calls[index].arguments +=  arguments if arguments is not None else ''
-                            tool_calls[index].name += name if name is not None else ''
-                            tool_calls[index].id += id if id is not None else ''
-                if chunk.choices[0].delta.content is not None:
-                    # 如果content不为空，则返回
-                    yield ChatResponse(
-                        model=chunk.model,
-                        role=chunk.choices[0].delta.role if chunk.choices[0].delta.role is not None else 'assistant',
-                        content=chunk.choices[0].delta.content if chunk.choices[0].delta.content is not None else ''
-                    )
-                if len(tool_calls) > 0 and chunk.choices[0].delta.tool_calls is None:
-                    # 如果工具调用完了，则返回
-                    yield ChatResponse(
-                        model=chunk.model,
-                        role=chunk.choices[0].delta.role if chunk.choices[0].delta.role is not None else 'assistant',
-                        content=chunk.choices[0].delta.content if chunk.choices[0].delta.content is not None else '',
-                        tool_calls=list(tool_calls.values())
-                    )
+        try:
+            tool_calls = {}
+            async for chunk in resp:
+                if len(chunk.choices) > 0:
+                    if chunk.choices[0].delta.tool_calls is not None:
+                        # 如果有工具调用，在这里等待工具调用完了之后再返回
+                        for tool_call in chunk.choices[0].delta.tool_calls:
+                            id = tool_call.id
+                            index = tool_call.index
+                            name = tool_call.function.name
+                            arguments = tool_call.function.arguments
+                            previous_tool_call = tool_calls.get(index)
+                            if previous_tool_call is None:
+                                tool_calls[index] = ToolCall(id=id, name=name, arguments=arguments)
+                            else:
+                                tool_calls[index].arguments +=  arguments if arguments is not None else ''
+                                tool_calls[index].name += name if name is not None else ''
+                                tool_calls[index].id += id if id is not None else ''
+                    if chunk.choices[0].delta.content is not None:
+                        # 如果content不为空，则返回
+                        yield ChatResponse(
+                            model=chunk.model,
+                            role=chunk.choices[0].delta.role if chunk.choices[0].delta.role is not None else 'assistant',
+                            content=chunk.choices[0].delta.content if chunk.choices[0].delta.content is not None else ''
+                        )
+                    if len(tool_calls) > 0 and chunk.choices[0].delta.tool_calls is None:
+                        # 如果工具调用完了，则返回
+                        yield ChatResponse(
+                            model=chunk.model,
+                            role=chunk.choices[0].delta.role if chunk.choices[0].delta.role is not None else 'assistant',
+                            content=chunk.choices[0].delta.content if chunk.choices[0].delta.content is not None else '',
+                            tool_calls=list(tool_calls.values())
+                        )
+        except asyncio.CancelledError:
+            cancel_stats.add("llm_streams")
+            raise
+        finally:
+            # 调用方提前停止（客户端断开或已经拿到工具调用）时关闭连接，让服务端停止生成
+            await resp.close()
 
     async def generate(self, model: str, prompt: str, format: dict = None) -> str:
         response = await self.openai_client.chat.completions.create(model=model, messages=[{"role": "user", "content": prompt}], response_format=format)
@@ -83,16 +92,21 @@ class OpenAIAdapter():
         return {'role': response.role, 'content': response.content, 'function_call': None, 'tool_calls': [{'id': tool_call.id, 'function': {'arguments': json.dumps(tool_call.arguments), 'name': tool_call.name}, 'type': 'function'}]}
     
     def tool_to_openai_tool(self, tools: list[Tool]) -> list[dict]:
-        if tools is None or len(tools) == 0:
-            return None
-        return [
-            {
-                "type": "function",
-                "function": {
-                    "name": tool.function.name,
-                    "description": tool.function.description,
-                    "parameters": tool.function.parameters,
-                },
-            }
-            for tool in tools
-        ]
\ No newline at end of file
+        if isinstance(tools, ToolList):
+            return tools.openai_tools
+        return openai_tools(tools)
+
+def openai_tools(tools: list[Tool]) -> list[dict] | None:
+    if tools is None or len(tools) == 0:
+        return None
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": tool.function.name,
+                "description": tool.function.description,
+                "parameters": tool.function.parameters,
+            },
+        }
+        for tool in tools
+    ]
@@ -0,0 +1,254 @@
+"""可续传的SSE流
+
+每次聊天的生成在后台任务中运行，输出的每一帧带上单调递增的 id 写入该聊天的回放缓冲区，
+HTTP 响应只是缓冲区的一个订阅者。连接中断不会停止生成，客户端带上 Last-Event-ID 重新连接时
+只需要从缓冲区读出错过的帧，再继续跟随仍在进行的生成，不需要重新调用大模型和工具。
+
+缓冲区按字节数淘汰最早的帧，但只淘汰所有在线订阅者都已经读过的帧；缓冲区已满而订阅者还没读完时
+暂停生成，和直接写响应时一样由慢速的客户端产生背压。最后一个订阅者断开后仍然按它读到的位置保留，
+等待它在 grace 秒内重新连接，期间缓冲区满了同样暂停生成。生成结束的流保留 ttl 秒；没有订阅者超过 grace 秒的
+生成会被取消，这样客户端彻底离开后仍然能停止上游的工作。
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator
+
+from live2d_server.cancellation import cancel_stats
+from live2d_server.configuration import SseConfig
+from live2d_server.sse import encode_event
+
+logger = logging.getLogger(__name__)
+
+
+def parse_event_id(value: str | None) -> int | None:
+    if value is None:
+        return None
+    try:
+        return int(value.strip())
+    except ValueError:
+        return None
+
+
+class ReplayStream:
+    """一次生成的输出和它的回放缓冲区"""
+
+    def __init__(self, key: str, first_id: int, max_bytes: int, grace: float, counts: dict, turn: str | None = None):
+        self.key = key
+        self.turn = turn # 触发这次生成的用户消息的标识，用于区分重连和新的一轮
+        self.start_id = first_id
+        self.next_id = first_id
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.done = False
+        self.finished_at = 0.0
+        self.subscribers = 0
+        self.counts = counts
+        self.size = 0
+        self._events: deque[tuple[int, bytes]] = deque()
+        self._changed = asyncio.Event()
+        # 每个在线订阅者下一帧的 id
+        self._positions: dict[object, int] = {}
+        # 最后一个断开的订阅者，它的位置保留到有新的订阅者或生成被取消
+        self._departed: object | None = None
+        self._read = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._abandon_handle: asyncio.TimerHandle | None = None
+
+    def start(self, frames: AsyncIterator[bytes]):
+        self._task = asyncio.create_task(self._produce(frames))
+        self._schedule_abandon()
+
+    async def _produce(self, frames: AsyncIterator[bytes]):
+        iterator = aiter(frames)
+        try:
+            async for frame in iterator:
+                self._append(frame)
+                while not self._evict():
+                    # 最早的帧还有在线的订阅者没有读到，等它读完再继续生成
+                    self._read.clear()
+                    await self._read.wait()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception(f"stream {self.key} failed")
+            self._append(encode_event({'type': 'error', 'content': str(e)}))
+        finally:
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def _append(self, frame: bytes):
+        frame = f"id: {self.next_id}\n".encode("utf-8") + frame
+        self._events.append((self.next_id, frame))
+        self.size += len(frame)
+        self.next_id += 1
+        self._notify()
+
+    def _evict(self) -> bool:
+        '''
+        淘汰所有订阅者（包括等待重连的）都已经读过的最早的帧，至少保留最新的一帧；
+        返回 False 表示缓冲区仍然超出上限，并且最早的帧还有订阅者没有读到
+        '''
+        floor = min(self._positions.values(), default=self.next_id)
+        while self.size > self.max_bytes and len(self._events) > 1 and self._events[0][0] < floor:
+            _, dropped = self._events.popleft()
+            self.size -= len(dropped)
+        return self.size <= self.max_bytes or self._events[0][0] < floor
+
+    def resumable(self, last_id: int) -> bool:
+        '''
+        last_id 属于这次生成，并且还有没收到的帧，或者生成还在进行
+        '''
+        if last_id < self.start_id - 1 or last_id >= self.next_id:
+            return False
+        return last_id < self.next_id - 1 or not self.done
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self, last_id: int | None = None) -> AsyncGenerator[bytes, None]:
+        '''
+        从 last_id 之后的帧开始输出，直到生成结束；last_id 为空时从头输出
+        '''
+        position = self.start_id if last_id is None else max(last_id + 1, self.start_id)
+        resumed = last_id is not None
+        token = object()
+        self.subscribers += 1
+        self._cancel_abandon()
+        if self._departed is not None:
+            self._positions.pop(self._departed, None)
+            self._departed = None
+        try:
+            while True:
+                if self._events and position < self._events[0][0]:
+                    # 错过的帧已经被淘汰，无法续传，客户端需要重新发起请求
+                    logger.warning(f"stream {self.key}: events {position}-{self._events[0][0] - 1} evicted")
+                    yield encode_event({'type': 'error', 'content': 'replay buffer exceeded'})
+                    return
+                self._positions[token] = position
+                changed = self._changed
+                while self._events and position < self.next_id:
+                    _, frame = self._events[position - self._events[0][0]]
+                    position += 1
+                    self._positions[token] = position
+                    self._read.set()
+                    if resumed:
+                        self.counts["replayed_events"] += 1
+                    yield frame
+                resumed = False
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            if self.subscribers == 1 and not self.done:
+                # 客户端可能只是断线，继续按它的位置保留未读的帧
+                self._departed = token
+            else:
+                self._positions.pop(token, None)
+            self._read.set()
+            if self.done:
+                # 生成已经结束，不会再有新的帧触发淘汰
+                self._evict()
+            self.subscribers -= 1
+            self._schedule_abandon()
+
+    def _schedule_abandon(self):
+        if self.done or self.subscribers > 0 or self._abandon_handle is not None:
+            return
+        self._abandon_handle = asyncio.get_running_loop().call_later(self.grace, self._abandon)
+
+    def _cancel_abandon(self):
+        if self._abandon_handle is not None:
+            self._abandon_handle.cancel()
+            self._abandon_handle = None
+
+    def _abandon(self):
+        self._abandon_handle = None
+        if self.done or self.subscribers > 0:
+            return
+        logger.info(f"stream {self.key}: no client for {self.grace}s, generation cancelled")
+        cancel_stats.add("abandoned")
+        self.cancel()
+
+    def cancel(self):
+        self._cancel_abandon()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def expired(self, ttl: float, now: float) -> bool:
+        return self.done and self.subscribers == 0 and now - self.finished_at > ttl
+
+
+class ReplayRegistry:
+    """按聊天保存最近一次生成的回放缓冲区"""
+
+    def __init__(self, config: SseConfig):
+        self.config = config
+        self._streams: dict[str, ReplayStream] = {}
+        self.counts = {"reconnects": 0, "replayed_events": 0}
+
+    def start(self, key: str, frames: AsyncIterator[bytes], turn: str | None = None) -> ReplayStream:
+        '''
+        开始新的生成，同一个聊天仍在进行的上一次生成会被取消，事件 id 接着上一次继续递增
+        '''
+        self._evict()
+        previous = self._streams.get(key)
+        if previous is not None:
+            previous.cancel()
+        stream = ReplayStream(
+            key,
+            previous.next_id if previous is not None else 1,
+            self.config.replayBufferBytes,
+            self.config.resumeGrace,
+            self.counts,
+            turn,
+        )
+        self._streams[key] = stream
+        stream.start(frames)
+        return stream
+
+    def get(self, key: str) -> ReplayStream | None:
+        self._evict()
+        return self._streams.get(key)
+
+    def resume(self, key: str, last_id: int | None, turn: str | None = None) -> AsyncGenerator[bytes, None] | None:
+        '''
+        客户端重新连接，返回 last_id 之后的帧；没有可续传的生成时返回 None。
+        turn 不为空时只续传由同一条用户消息触发的生成，last_id 不属于这次生成或者已经收到全部的帧时也不续传
+        '''
+        self._evict()
+        stream = self._streams.get(key)
+        if stream is None:
+            return None
+        if turn is not None and stream.turn != turn:
+            return None
+        if last_id is not None and not stream.resumable(last_id):
+            return None
+        self.counts["reconnects"] += 1
+        logger.info(f"stream {key}: client resumed after event {last_id}")
+        return stream.subscribe(last_id)
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, stream in self._streams.items() if stream.expired(self.config.replayTtl, now)]:
+            del self._streams[key]
+        # 超出数量上限时先淘汰最早结束的流
+        finished = sorted((stream for stream in self._streams.values() if stream.done and stream.subscribers == 0), key=lambda stream: stream.finished_at)
+        for stream in finished[:max(0, len(self._streams) - self.config.replayMaxStreams)]:
+            del self._streams[stream.key]
+
+    def stats(self) -> dict:
+        streams = list(self._streams.values())
+        return {
+            "streams": len(streams),
+            "running": sum(1 for stream in streams if not stream.done),
+            "subscribers": sum(stream.subscribers for stream in streams),
+            "buffered_bytes": sum(stream.size for stream in streams),
+            **self.counts,
+        }
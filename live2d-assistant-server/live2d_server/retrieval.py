@@ -0,0 +1,120 @@
+"""对话前的检索阶段
+
+网络搜索、知识库等检索源并发执行，每个检索源有独立的超时时间，
+结果合并成一段上下文，整体耗时取决于最慢的检索源而不是所有检索源之和。
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from live2d_server.configuration import RetrievalConfig
+from live2d_server.openai_adapter import OpenAIAdapter
+from live2d_server.rag.rag import search_knowledge_base
+from live2d_server.search.searx import search
+from live2d_server.search.query_builder import BuiltQuery, QueryBuilder
+
+logger = logging.getLogger(__name__)
+
+WEB_SEARCH_PROMPT = """
+你是一个搜索专家，请根据用户的历史对话内容和当前的问题构建搜索词并返回，你应该仅返回搜索词，不要返回任何其他内容。
+用户的问题是：{question}
+用户的对话历史是：{history}
+当前时间是：{now}
+"""
+
+RAG_PROMPT = """
+你是一个搜索专家，请根据用户的历史对话内容和当前的问题构建RAG搜索词并返回，你应该仅返回搜索词，不要返回任何其他内容。
+用户的问题是：{question}
+用户的对话历史是：{history}
+当前时间是：{now}
+"""
+
+SOURCE_TITLES = {
+    "web_search": "网络搜索结果",
+    "rag": "知识库检索结果",
+}
+
+
+@dataclass
+class RetrievalResult:
+    source: str
+    content: str = ""
+    status: str = "ok" # ok / timeout / error
+    latency: float = 0.0 # 秒
+    error: str | None = None
+    query: BuiltQuery | None = None
+
+    def report(self) -> dict:
+        report = {
+            "source": self.source,
+            "status": self.status,
+            "latency_ms": round(self.latency * 1000),
+            "error": self.error,
+        }
+        if self.query is not None:
+            report["query_path"] = self.query.path
+            report["query_ms"] = round(self.query.elapsed * 1000, 1)
+            report["saved_ms"] = None if self.query.saved is None else round(self.query.saved * 1000)
+        return report
+
+
+class Retriever:
+    """并发执行所有启用的检索源"""
+
+    def __init__(self, llm_adapter: OpenAIAdapter, model: str, config: RetrievalConfig):
+        self.config = config
+        self.query_builder = QueryBuilder(llm_adapter, model, config)
+
+    async def retrieve(self, messages: list[dict], web_search: bool, rag: bool) -> list[RetrievalResult]:
+        sources: dict[str, tuple[Callable[[list[dict], RetrievalResult], Awaitable[str]], float]] = {}
+        if web_search:
+            sources["web_search"] = (self._web_search, self.config.webSearchTimeout)
+        if rag:
+            sources["rag"] = (self._rag, self.config.ragTimeout)
+        results = await asyncio.gather(*[
+            self._run(name, func, timeout, messages) for name, (func, timeout) in sources.items()
+        ])
+        logger.info(f"retrieval: {[result.report() for result in results]}")
+        return list(results)
+
+    async def _run(self, name: str, func: Callable[[list[dict], RetrievalResult], Awaitable[str]], timeout: float, messages: list[dict]) -> RetrievalResult:
+        result = RetrievalResult(source=name)
+        start = time.perf_counter()
+        try:
+            result.content = await asyncio.wait_for(func(messages, result), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"retrieval source {name} timed out after {timeout}s")
+            result.status = "timeout"
+        except Exception as e:
+            logger.error(f"retrieval source {name} failed: {e}")
+            result.status = "error"
+            result.error = str(e)
+        result.latency = time.perf_counter() - start
+        return result
+
+    async def _web_search(self, messages: list[dict], result: RetrievalResult) -> str:
+        result.query = await self.query_builder.build(WEB_SEARCH_PROMPT, messages)
+        return await search(result.query.query)
+
+    async def _rag(self, messages: list[dict], result: RetrievalResult) -> str:
+        result.query = await self.query_builder.build(RAG_PROMPT, messages)
+        docs = await search_knowledge_base(result.query.query)
+        return "\n\n".join(doc["text"] for doc in docs)
+
+
+def merge_context(results: list[RetrievalResult], question: str) -> str:
+    '''
+    将各检索源的结果合并到用户的问题中，没有任何结果时原样返回问题
+    '''
+    blocks = [
+        f"[{SOURCE_TITLES.get(result.source, result.source)}]\n{result.content}"
+        for result in results
+        if result.status == "ok" and result.content
+    ]
+    if not blocks:
+        return question
+    context = "\n\n".join(blocks)
+    return f"使用如下的信息回答用户的问题：\n{context}\n\n用户的问题是：{question}"
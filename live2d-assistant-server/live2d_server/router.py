@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Request, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Request, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, Response
 import os
 import requests
 import base64
+import hashlib
+import itertools
 import json
 import asyncio
-from typing import List, Optional, AsyncGenerator
+from contextlib import aclosing
+from typing import List, Literal, Optional, AsyncGenerator
 from pydantic import BaseModel
 from live2d_server.configuration import Config
 from live2d_server.client import get_mcp_client, MCPClientConfig, init_mcp_client
@@ -16,9 +19,17 @@ from langgraph.types import Command
 from langchain_core.messages import ToolMessage
 from live2d_server.agent.agent import Agent
 from live2d_server.agent.model import AgentConfig
-from live2d_server.search.searx import search
-from datetime import datetime
-from live2d_server.rag.rag import search_knowledge_base
+from live2d_server.retrieval import Retriever, merge_context
+from live2d_server.search.query_builder import query_stats
+from live2d_server.search import searx, fetcher
+from live2d_server import conversation, compaction, memory
+from live2d_server.tts_pipeline import TtsPipeline
+from live2d_server.tts_engine import TtsEngine
+from live2d_server.audio import COMPRESSED_FORMATS
+from live2d_server.sse import SseWriter
+from live2d_server.cancellation import until_disconnected, cancel_stats
+from live2d_server.replay import ReplayRegistry, parse_event_id
+from live2d_server.websocket import AudioFlowControl, pack_audio_frame, AUDIO_KIND_STREAM, AUDIO_KIND_WAV, DEFAULT_AUDIO_WINDOW
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +43,10 @@ class ChatRequest(BaseModel):
     web_search: Optional[bool] = False
     rag: Optional[bool] = False
     tts_enabled: Optional[bool] = False
+    voice: Optional[str] = None
     agents: Optional[List[AgentConfig]] = None
+    # full: messages 是完整的历史（兼容旧的客户端）；delta: messages 只有新的消息，历史从服务端的会话存储中读取
+    history_mode: Literal['full', 'delta'] = 'full'
 
 class ChatResponse(BaseModel):
     message: str
@@ -40,118 +54,362 @@ class ChatResponse(BaseModel):
 
 class TTSRequest(BaseModel):
     text: str
+    voice: Optional[str] = None
+    format: Literal['wav', 'opus'] = 'wav'
 
 # 全局变量
-config = None
-tts_server = None
+config = Config()
+tts_engine: TtsEngine | None = None
 llm_adapter = None
 # 一个agent缓存，用于处理agent再入的问题
 agents = {}
+# 流式聊天的回放缓冲区，断线重连时从这里续传
+replay_registry = ReplayRegistry(config.server.sse)
 
 def set_config(_config: Config):
     global config
     logger.info(f"set_config: {_config}")
     config = _config
+    searx.configure(config.server.search)
+    fetcher.configure(config.server.fetch)
+    conversation.configure(config.server.conversation)
+    compaction.configure(config.server.context)
+    memory.configure(config.server.memory)
+    replay_registry.config = config.server.sse
 
 def get_config():
     global config
     logger.info(f"get_config: {config}")
     return config
 
-def get_tts_server():
-    return tts_server
+def get_tts_engine():
+    return tts_engine
 
 def get_llm_adapter():
     return llm_adapter
 
-def init_tts_if_needed(config: Config, tts_server=None):
-    """初始化TTS服务"""
-    if config.server.tts.enabled and tts_server is None:
-        from tts import tts_init, TtsServer
-        cosyvoice, prompt_speech_16k = tts_init(
-            config.server.tts.cosyvoiceInstallPath,
-            config.server.tts.modulePath,
-            config.server.tts.promptPath,
-            config.server.tts.sampleRate,
-            config.server.tts.promptText
-        )
-        return TtsServer(cosyvoice, prompt_speech_16k, config.server.tts.promptText)
-    return tts_server
+def init_tts_if_needed(config: Config) -> TtsEngine | None:
+    """初始化TTS服务，工作进程只会启动一次"""
+    global tts_engine
+    if config.server.tts.enabled and tts_engine is None:
+        tts_engine = TtsEngine(config.server.tts)
+        tts_engine.start()
+    return tts_engine
 
-async def stream_chat_response(
+async def shutdown_tts():
+    """关闭TTS工作进程"""
+    global tts_engine
+    if tts_engine is not None:
+        await tts_engine.shutdown()
+        tts_engine = None
+
+AUDIO_EVENTS = ('audio', 'audio_stream')
+
+def audio_event(tts_pipeline: TtsPipeline, data: bytes, mouth: bytes) -> dict:
+    '''
+    mouth 为口型包络，每个字节是一帧（帧率为 mouth_fps）嘴巴张开的程度，0-255
+    '''
+    event = {'type': 'audio_stream' if tts_pipeline.stream else 'audio', 'content': data}
+    if tts_pipeline.mouth_fps > 0:
+        event['mouth'] = mouth
+        event['mouth_fps'] = tts_pipeline.mouth_fps
+    return event
+
+async def merge_sources(sources: dict[str, AsyncGenerator]) -> AsyncGenerator[tuple[str, object], None]:
+    '''
+    并发读取多个异步生成器，按到达的顺序输出 (名称, 数据)，每个生成器结束时输出 (名称, None)。
+    每次只转发一项，调用方没有取走之前各个生成器都会暂停；任一生成器出错时取消其余的并抛出该异常
+    '''
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def forward(name: str, source: AsyncGenerator):
+        try:
+            async for item in source:
+                await queue.put((name, item, None))
+            await queue.put((name, None, None))
+        except Exception as e:
+            await queue.put((name, None, e))
+
+    tasks = [asyncio.create_task(forward(name, source)) for name, source in sources.items()]
+    try:
+        running = len(tasks)
+        while running:
+            name, item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is None:
+                running -= 1
+            yield name, item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def chat_events(
     request: ChatRequest,
-    config: Config = Depends(get_config),
-    llm_adapter = Depends(get_llm_adapter),
-    tts_server = Depends(get_tts_server)
-) -> AsyncGenerator[str, None]:
-    """生成流式聊天响应"""
+    config: Config,
+    tts_engine: TtsEngine | None = None
+) -> AsyncGenerator[dict, None]:
+    '''
+    生成聊天事件，音频事件（audio/audio_stream）的 content 为原始字节，由具体的传输方式决定如何编码。
+    非流式时 audio 事件是一段完整的WAV，流式时 audio_stream 事件依次拼接成一个WAV流
+    '''
+    tts_pipeline = None
     try:
-        if request.web_search:
-            # 由大模型构建搜索词之后进行搜索
-            # yield f"data: {json.dumps({'type': 'text', 'content': '正在搜索中，请稍等...'})}\n\n"
-            search_query = await get_mcp_client().get_llm_adapter().generate(model=request.model, prompt=f"""
-            你是一个搜索专家，请根据用户的历史对话内容和当前的问题构建搜索词并返回，你应该仅返回搜索词，不要返回任何其他内容。
-            用户的问题是：{request.messages[-1]['content']}
-            用户的对话历史是：{request.messages[1:]}
-            当前时间是：{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-            """)
-            logger.info(f"search query: {search_query}")
-            search_result = search(search_query)
-            # 替换掉最后一个消息的content
-            request.messages[-1]['content'] = f"使用如下的信息回答用户的问题：{search_result}，用户的问题是：{request.messages[-1]['content']}"
-        if request.rag:
-            # 使用RAG进行查询            
-            search_query = await get_mcp_client().get_llm_adapter().generate(model=request.model, prompt=f"""
-            你是一个搜索专家，请根据用户的历史对话内容和当前的问题构建RAG搜索词并返回，你应该仅返回搜索词，不要返回任何其他内容。
-            用户的问题是：{request.messages[-1]['content']}
-            用户的对话历史是：{request.messages[1:]}
-            当前时间是：{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-            """)
-            logger.info(f"search query: {search_query}")
-            search_result = await search_knowledge_base(search_query)
-            logger.info(f"search result: {search_result}")
-            request.messages[-1]['content'] = f"使用如下的信息回答用户的问题：{search_result}，用户的问题是：{request.messages[-1]['content']}"
-        async for chunk in get_mcp_client().stream_process_query(request.model, request.messages[-1]['content'], request.messages[:-1]):
-            logger.info(f"stream_chat_response: {chunk}")
-            yield f"data: {json.dumps(chunk)}\n\n"
-            await asyncio.sleep(0)  # 让出控制权给其他协程
-        
-        # 如果需要TTS，生成音频数据c
+        store = conversation.conversation_store
+        messages = await conversation_messages(request, store)
+        question = messages[-1]['content']
+        if request.web_search or request.rag:
+            # 所有启用的检索源并发执行，结果合并后作为本轮的问题，保存到会话中的仍然是原始问题
+            retriever = Retriever(get_mcp_client().get_llm_adapter(), request.model, config.server.retrieval)
+            results = await retriever.retrieve(messages, request.web_search, request.rag)
+            yield {'type': 'retrieval', 'content': [result.report() for result in results]}
+            question = merge_context(results, question)
+        # 如果需要TTS，文本边输出边按句合成语音
         if request.tts_enabled:
-            tts_server = init_tts_if_needed(config, tts_server)
-            wav_data = tts_server.tts(chunk)
-            for data in wav_data:
-                base64_wave = base64.b64encode(data).decode('utf-8')
-                yield f"data: {json.dumps({'type': 'audio', 'content': base64_wave})}\n\n"
-                await asyncio.sleep(0)
-        
+            tts_engine = init_tts_if_needed(config)
+        if request.tts_enabled and tts_engine is None:
+            # 服务端没有启用TTS，只返回文本
+            logger.warning("tts is disabled in the server config, reply without audio")
+        elif request.tts_enabled:
+            tts_pipeline = TtsPipeline(
+                tts_engine,
+                request.voice,
+                stream=config.server.tts.stream,
+                mouth_fps=config.server.tts.lipSyncFps if config.server.tts.lipSync else 0,
+                lookahead=config.server.tts.lookahead
+            )
+        transcript = []
+        stream = get_mcp_client().stream_process_query(
+            request.model, question, messages[:-1], transcript,
+            chat_id=request.chat_id, question=messages[-1]['content'],
+        )
+        # 大模型输出和合成好的语音分别由两个任务转发，语音不必等到下一段文本到达才发送
+        sources = {'llm': stream}
+        if tts_pipeline is not None:
+            sources['audio'] = tts_pipeline.drain()
+        async with aclosing(merge_sources(sources)) as merged:
+            async for source, item in merged:
+                if source == 'audio':
+                    if item is not None:
+                        yield audio_event(tts_pipeline, *item)
+                elif item is not None:
+                    logger.debug(f"chat_events: {item}")
+                    yield item
+                    if tts_pipeline is not None and item['type'] == 'text':
+                        tts_pipeline.feed(item['content'])
+                else:
+                    # 大模型输出结束
+                    if store is not None:
+                        # 只保存完整结束的一轮，中途取消或出错时客户端会重新发送
+                        await store.append(request.chat_id, [messages[-1]] + transcript)
+                    if tts_pipeline is not None:
+                        tts_pipeline.flush()
+
         # 发送完成信号
-        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+        yield {'type': 'done'}
         
     except Exception as e:
         import traceback
         traceback.print_exc()
-        logger.error(f"Error in stream_chat_response: {str(e)}")
-        yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+        logger.error(f"Error in chat_events: {str(e)}")
+        yield {'type': 'error', 'content': str(e)}
+    finally:
+        if tts_pipeline is not None:
+            tts_pipeline.cancel()
+
+async def conversation_messages(request: ChatRequest, store: conversation.ConversationStore | None) -> list[dict]:
+    '''
+    本轮对话的完整消息列表，最后一个是用户的新消息
+    '''
+    if request.history_mode == 'delta':
+        if store is None:
+            raise ValueError("会话存储未启用，请发送完整的历史消息")
+        # 存储中没有系统消息，客户端放在最前面的系统消息仍然放在历史之前
+        system = list(itertools.takewhile(lambda message: message.get('role') == 'system', request.messages))
+        return system + await store.history(request.chat_id) + request.messages[len(system):]
+    if store is not None:
+        await store.sync(request.chat_id, request.messages[:-1])
+    return request.messages
+
+def sse_writer(config: Config) -> SseWriter:
+    return SseWriter(config.server.sse.coalesceWindowMs / 1000, config.server.sse.coalesceBytes)
+
+async def sse_chat_events(
+    request: ChatRequest,
+    config: Config,
+    tts_engine: TtsEngine | None = None
+) -> AsyncGenerator[dict, None]:
+    async for event in chat_events(request, config, tts_engine):
+        if event['type'] in AUDIO_EVENTS:
+            # SSE 只能传输文本，音频使用base64编码
+            event = {**event, 'content': base64.b64encode(event['content']).decode('utf-8')}
+            if 'mouth' in event:
+                event['mouth'] = base64.b64encode(event['mouth']).decode('utf-8')
+        yield event
+
+async def stream_chat_response(
+    request: ChatRequest,
+    config: Config = Depends(get_config),
+    llm_adapter = Depends(get_llm_adapter),
+    tts_engine: TtsEngine | None = Depends(get_tts_engine)
+) -> AsyncGenerator[bytes, None]:
+    """生成流式聊天响应，连续的文本增量合并后发送"""
+    writer = sse_writer(config)
+    async for frame in writer.stream(sse_chat_events(request, config, tts_engine)):
+        yield frame
+    logger.info(f"chat {request.chat_id}: {writer.events} events in {writer.frames} frames")
+
+def stream_key(chat_id: str, agentic: bool = False) -> str:
+    return f"agentic:{chat_id}" if agentic else chat_id
+
+def turn_key(request: ChatRequest) -> str:
+    """本轮用户消息的标识，客户端重发同一个请求时相同，发送新的一轮时不同"""
+    turn = [request.history_mode, request.is_resume, len(request.messages), request.messages[-1]]
+    return hashlib.sha256(json.dumps(turn, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def resume_response(key: str, http_request: Request, turn: str | None = None) -> StreamingResponse | None:
+    """
+    请求带有 Last-Event-ID 且该聊天的生成还在缓冲区中时，只发送错过的事件；
+    请求体是新的一轮，或者 Last-Event-ID 之后已经没有可续传的事件时返回 None，由调用方开始新的生成
+    """
+    last_id = parse_event_id(http_request.headers.get('last-event-id'))
+    if last_id is None:
+        return None
+    frames = replay_registry.resume(key, last_id, turn)
+    if frames is None:
+        return None
+    return StreamingResponse(until_disconnected(http_request, frames), media_type="text/event-stream")
+
+def replayable_response(key: str, http_request: Request, frames: AsyncGenerator[bytes, None], turn: str | None = None) -> StreamingResponse:
+    """在后台开始生成，响应只订阅回放缓冲区，连接断开不会中断生成"""
+    stream = replay_registry.start(key, frames, turn)
+    return StreamingResponse(until_disconnected(http_request, stream.subscribe()), media_type="text/event-stream")
 
 @router.post('/api/chat')
 async def chat(
     request: ChatRequest,
+    http_request: Request,
     config: Config = Depends(get_config),
     llm_adapter = Depends(get_llm_adapter),
-    tts_server = Depends(get_tts_server)
+    tts_engine: TtsEngine | None = Depends(get_tts_engine)
 ):
-    """流式聊天接口"""
-    return StreamingResponse(
-        stream_chat_response(request, config, llm_adapter, tts_server),
-        media_type="text/event-stream"
-    )
+    """
+    流式聊天接口
+
+    每个事件带有递增的 id，断线后带上 Last-Event-ID 重新请求时只返回错过的事件，不会重新生成，
+    请求体是新的一轮或者已经收到了全部事件时开始新的生成；
+    客户端在 sse.resumeGrace 秒内没有重新连接时停止大模型、工具调用和语音合成
+    """
+    key = stream_key(request.chat_id)
+    turn = turn_key(request)
+    response = resume_response(key, http_request, turn)
+    if response is not None:
+        return response
+    return replayable_response(key, http_request, stream_chat_response(request, config, llm_adapter, tts_engine), turn)
+
+@router.get('/api/chat/{chat_id}/events')
+async def chat_events_resume(chat_id: str, http_request: Request, agentic: bool = False):
+    """
+    续传聊天的事件流，可以直接用 EventSource 订阅，断线后浏览器会自动带上 Last-Event-ID
+    """
+    key = stream_key(chat_id, agentic)
+    response = resume_response(key, http_request)
+    if response is not None:
+        return response
+    last_id = parse_event_id(http_request.headers.get('last-event-id'))
+    stream = replay_registry.get(key)
+    if last_id is not None and stream is not None and last_id >= stream.start_id - 1:
+        # 已经收到了全部事件，204 让 EventSource 不再重连
+        return Response(status_code=204)
+    frames = replay_registry.resume(key, None)
+    if frames is None:
+        raise HTTPException(status_code=404, detail=f"没有正在进行或可以回放的生成: {chat_id}")
+    return StreamingResponse(until_disconnected(http_request, frames), media_type="text/event-stream")
+
+@router.websocket('/api/ws/chat')
+async def chat_ws(websocket: WebSocket, window: int = DEFAULT_AUDIO_WINDOW):
+    '''
+    WebSocket 聊天接口
+
+    客户端消息：
+    - {"type": "chat", ...ChatRequest}: 开始一次对话，会取消该连接上尚未结束的对话
+    - {"type": "ack", "seq": n}: 确认已收到序号不大于 n 的音频帧
+    - {"type": "cancel"}: 取消当前对话
+    无法解析或缺少字段的消息返回 error 事件，连接保持不变
+    服务端消息与 /api/chat 的事件相同，其中音频以二进制帧发送，口型包络随音频放在同一帧中
+    '''
+    await websocket.accept()
+    flow_control = AudioFlowControl(window)
+    task: asyncio.Task | None = None
+
+    async def run(request: ChatRequest):
+        async for event in chat_events(request, get_config(), get_tts_engine()):
+            if event['type'] in AUDIO_EVENTS:
+                kind = AUDIO_KIND_STREAM if event['type'] == 'audio_stream' else AUDIO_KIND_WAV
+                seq = await flow_control.acquire(len(event['content']))
+                await websocket.send_bytes(pack_audio_frame(seq, kind, event['content'], event.get('mouth', b'')))
+            else:
+                await websocket.send_json(event)
+
+    async def stop():
+        '''
+        取消尚未结束的对话，并等待它退出，避免与下一次对话同时向连接写入
+        '''
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+            cancel_stats.add('requests')
+        await asyncio.gather(task, return_exceptions=True)
+
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError):
+                # 不是 JSON 文本消息
+                await websocket.send_json({'type': 'error', 'content': 'invalid message: expected a JSON object'})
+                continue
+            if not isinstance(message, dict):
+                await websocket.send_json({'type': 'error', 'content': 'invalid message: expected a JSON object'})
+                continue
+            message_type = message.get('type')
+            if message_type == 'ack':
+                seq = message.get('seq')
+                if not isinstance(seq, int) or isinstance(seq, bool):
+                    await websocket.send_json({'type': 'error', 'content': 'invalid ack: seq must be an integer'})
+                    continue
+                await flow_control.ack(seq)
+            elif message_type == 'cancel':
+                await stop()
+            elif message_type == 'chat':
+                await stop()
+                await flow_control.reset()
+                try:
+                    request = ChatRequest.model_validate(message)
+                except ValueError as e:
+                    await websocket.send_json({'type': 'error', 'content': str(e)})
+                    continue
+                task = asyncio.create_task(run(request))
+            else:
+                await websocket.send_json({'type': 'error', 'content': f'unknown message type: {message_type}'})
+    except WebSocketDisconnect:
+        logger.info("chat websocket disconnected")
+    finally:
+        await stop()
 
 @router.post('/api/agentic/chat')
 async def agentic_chat(
-    request: ChatRequest
+    request: ChatRequest,
+    http_request: Request
 ):
-    """Agent 入口"""
+    """Agent 入口，与 /api/chat 一样支持 Last-Event-ID 续传"""
+    key = stream_key(request.chat_id, agentic=True)
+    turn = turn_key(request)
+    response = resume_response(key, http_request, turn)
+    if response is not None:
+        return response
     mcp_client = get_mcp_client()
     # from langchain_community.tools.searx_search.tool import SearxSearchRun
     # from langchain_community.utilities import SearxSearchWrapper
@@ -193,16 +451,14 @@ async def agentic_chat(
         )
         cache_tool_calls = {}
         async for s in stream:
-            logger.info('-'*100)
-            logger.info(s)
-            logger.info('-'*100)
+            logger.debug(s)
             agent, message_chunk = s
             message_chunk, _ = message_chunk
             if isinstance(message_chunk, ToolMessage):
                 continue
             if hasattr(message_chunk, 'tool_call_chunks') and len(message_chunk.tool_call_chunks) > 0:
                 tool_call_chunk = message_chunk.tool_call_chunks[0]
-                logger.info(f"agentic_chat: {message_chunk.tool_call_chunks}")
+                logger.debug(f"agentic_chat: {message_chunk.tool_call_chunks}")
                 index = tool_call_chunk.get('index', 0)
                 if not index:
                     index = 0
@@ -233,24 +489,162 @@ async def agentic_chat(
                 #     tc = next(c for c in call if c['name'] == 'request_user_input')
                 #     yield f"data: {json.dumps({'type': 'text', 'content': tc['arguments']['prompt']})}\n\n"
                 #     break
-                yield f"data: {json.dumps({'type': 'tool_calls', 'content': call})}\n\n"
+                yield {'type': 'tool_calls', 'content': call}
             else:
-                yield f"data: {json.dumps({'type': 'text', 'content': message_chunk.content})}\n\n" 
+                yield {'type': 'text', 'content': message_chunk.content}
     
-    return StreamingResponse(
-        process(),
-        media_type="text/event-stream",
-    )
+    return replayable_response(key, http_request, sse_writer(get_config()).stream(process()), turn)
+
+async def tts_response(request: TTSRequest, http_request: Request, config: Config) -> Response:
+    '''
+    生成TTS响应，WAV格式边合成边输出，压缩格式在合成完成后一次性编码
+
+    只有完整的结果（压缩格式编码完成，或所有句子都已缓存）才允许长期缓存；
+    边合成边输出时中途失败只能中断响应，这种响应不能被浏览器或代理缓存
+    '''
+    tts_engine = init_tts_if_needed(config)
+    if tts_engine is None:
+        raise HTTPException(status_code=503, detail="TTS未启用")
+    if request.voice and request.voice not in tts_engine.voice_identities:
+        raise HTTPException(status_code=400, detail=f"Unknown voice: {request.voice}")
+    etag = tts_engine.etag(request.text, request.voice, request.format)
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={config.server.tts.httpCacheMaxAge}, immutable',
+    }
+    if etag in http_request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    if request.format in COMPRESSED_FORMATS:
+        try:
+            data = await tts_engine.encode(request.text, request.voice, request.format)
+        except RuntimeError as e:
+            raise HTTPException(status_code=503, detail=f"TTS failed: {e}")
+        return Response(content=data, media_type=COMPRESSED_FORMATS[request.format][1], headers=headers)
+
+    # 长文本切分成句子后并行合成，按顺序输出，第一项为WAV头；任一句合成失败时中断输出
+    tts_pipeline = TtsPipeline(tts_engine, request.voice, stream=True, lookahead=config.server.tts.lookahead, strict=True)
+    tts_pipeline.feed(request.text)
+    tts_pipeline.flush()
+    if not all(tts_engine.is_cached(sentence, request.voice) for sentence in tts_pipeline.sentences):
+        headers = {'Cache-Control': 'no-store'}
+    frames = tts_pipeline.drain()
+    try:
+        # 等到第一段音频再发送响应头，开始阶段的失败可以返回错误状态码
+        first = await anext(frames, None)
+    except Exception as e:
+        tts_pipeline.cancel()
+        raise HTTPException(status_code=503, detail=f"TTS failed: {e}")
+
+    async def generate():
+        try:
+            if first is None:
+                return
+            yield first[0]
+            async for data, _ in frames:
+                yield data
+        finally:
+            tts_pipeline.cancel()
+
+    return StreamingResponse(until_disconnected(http_request, generate()), media_type="audio/wav", headers=headers)
 
 @router.post('/api/tts')
 async def text_to_speech(
     request: TTSRequest,
+    http_request: Request,
+    config: Config = Depends(get_config),
+):
+    '''
+    TTS接口，返回音频数据，默认为边合成边输出的WAV流，format 为 opus 时返回 OGG/Opus
+    '''
+    return await tts_response(request, http_request, config)
+
+@router.get('/api/tts')
+async def text_to_speech_get(
+    http_request: Request,
+    text: str,
+    voice: Optional[str] = None,
+    format: Literal['wav', 'opus'] = 'wav',
+    config: Config = Depends(get_config),
+):
+    '''
+    GET 形式的TTS接口，便于浏览器和代理按URL缓存
+    '''
+    return await tts_response(TTSRequest(text=text, voice=voice, format=format), http_request, config)
+
+@router.post('/api/tts/stream')
+async def text_to_speech_stream(
+    request: TTSRequest,
+    http_request: Request,
     config: Config = Depends(get_config),
-    tts_server = Depends(get_tts_server)
 ):
-    tts_server = init_tts_if_needed(config, tts_server)
-    wav_data = tts_server.tts(request.text)
-    return wav_data
+    '''
+    流式TTS接口，返回一个长度未知的WAV流，模型产生语音后即开始输出
+    '''
+    return await tts_response(request.model_copy(update={'format': 'wav'}), http_request, config)
+
+@router.get('/api/tts/stats')
+async def tts_stats():
+    '''
+    获取TTS引擎和缓存的统计信息
+    '''
+    if tts_engine is None:
+        return {'status': 'disabled'}
+    return tts_engine.stats()
+
+@router.get('/api/cancel/stats')
+async def cancellation_stats():
+    '''
+    获取因客户端断开而取消的工作的统计信息
+    '''
+    return cancel_stats.stats()
+
+@router.get('/api/context/stats')
+async def context_stats():
+    '''
+    获取历史消息压缩和长期记忆的统计信息
+    '''
+    return {
+        'compaction': compaction.history_compactor.stats(),
+        'memory': memory.conversation_memory.stats() if memory.conversation_memory is not None else {'status': 'disabled'},
+    }
+
+@router.get('/api/conversations/{chat_id}')
+async def get_conversation(chat_id: str):
+    '''
+    获取服务端保存的会话消息
+    '''
+    store = conversation.conversation_store
+    if store is None:
+        raise HTTPException(status_code=404, detail="会话存储未启用")
+    return {'chat_id': chat_id, 'messages': await store.history(chat_id)}
+
+@router.delete('/api/conversations/{chat_id}')
+async def delete_conversation(chat_id: str):
+    '''
+    删除服务端保存的会话消息
+    '''
+    store = conversation.conversation_store
+    if store is None:
+        raise HTTPException(status_code=404, detail="会话存储未启用")
+    await store.delete(chat_id)
+    return {'status': 'success'}
+
+@router.get('/api/stream/stats')
+async def stream_stats():
+    '''
+    获取回放缓冲区和断线续传的统计信息
+    '''
+    return replay_registry.stats()
+
+@router.get('/api/retrieval/stats')
+async def retrieval_stats():
+    '''
+    获取搜索词构建方式和网页正文缓存的统计信息
+    '''
+    return {
+        'query': query_stats.stats(),
+        'pages': fetcher.page_fetcher.stats(),
+    }
 
 @router.get('/api/tags')
 async def tags(config: Config = Depends(get_config)):
@@ -273,6 +667,13 @@ async def set_settings(request: Request):
     request_data = MCPClientConfig.model_validate_json(json_data)
     await init_mcp_client(request_data)
 
+@router.get('/api/mcp_servers')
+async def get_mcp_connections():
+    '''
+    获取所有MCP服务器的连接状态和连接耗时
+    '''
+    return get_mcp_client().connection_report()
+
 @router.get('/api/mcp_servers/{name}/status')
 async def get_mcp_servers(name: str, config: Config = Depends(get_config)):
     '''
@@ -0,0 +1,186 @@
+"""网页正文提取
+
+使用标准库的流式 HTMLParser 逐个标签处理，不构建DOM树：
+跳过脚本、导航、页眉页脚和类名像广告/评论/侧边栏的元素，按块级元素切分文本，
+存在 <article>/<main> 且内容足够时只保留其中的文本，再去掉链接占比过高的块（导航、推荐列表），
+最后按token预算截断。
+"""
+
+import re
+from dataclasses import dataclass
+from html.parser import HTMLParser
+
+from live2d_server.tokens import estimate_tokens, truncate_to_tokens
+
+SKIP_TAGS = {
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe", "object",
+    "nav", "header", "footer", "aside", "form", "button", "select", "textarea", "head",
+}
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "li", "ul", "ol", "dl", "dt", "dd",
+    "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "table", "tr", "td", "th",
+    "figcaption", "br", "hr",
+}
+MAIN_TAGS = {"article", "main"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+
+# class/id 命中这些词的元素视为非正文
+_BOILERPLATE = re.compile(
+    r"(?:^|[\s_-])(?:comments?|sidebar|footer|nav|navbar|menu|breadcrumbs?|share|social|related|recommend\w*|"
+    r"ads?|advert\w*|banner|cookie|popup|modal|subscribe|toolbar)(?:$|[\s_-])",
+    re.IGNORECASE,
+)
+_SPACES = re.compile(r"[ \t\r\f\v\u00a0\u3000]+")
+
+# main/article 中的文本少于该长度时不认为它是正文容器
+MIN_MAIN_CHARS = 200
+
+
+@dataclass
+class Block:
+    text: str
+    link_chars: int
+    in_main: bool
+    heading: int = 0
+    pre: bool = False
+
+
+@dataclass
+class ReadablePage:
+    title: str
+    text: str
+    tokens: int
+    truncated: bool = False
+
+
+class ReadableParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: list[Block] = []
+        self.title = ""
+        # 打开的标签栈：(标签名, 是否跳过)
+        self._stack: list[tuple[str, bool]] = []
+        self._skip = 0
+        self._main = 0
+        self._link = 0
+        self._pre = 0
+        self._heading = 0
+        self._in_title = False
+        self._parts: list[str] = []
+        self._link_chars = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+            return
+        if tag in BLOCK_TAGS:
+            self._flush()
+        if tag in VOID_TAGS:
+            return
+        skip = tag in SKIP_TAGS or self._is_boilerplate(attrs)
+        self._stack.append((tag, skip))
+        self._enter(tag, skip, 1)
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+            return
+        if tag in BLOCK_TAGS:
+            self._flush()
+        # 没有闭合的标签（如 <p>、<li>）在遇到外层的结束标签时一起关闭
+        if not any(name == tag for name, _ in self._stack):
+            return
+        while self._stack:
+            name, skip = self._stack.pop()
+            self._enter(name, skip, -1)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+            return
+        if self._skip:
+            return
+        if not self._pre:
+            data = _SPACES.sub(" ", data.replace("\n", " "))
+        self._parts.append(data)
+        if self._link:
+            self._link_chars += len(data.strip())
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def _enter(self, tag: str, skip: bool, delta: int):
+        if skip:
+            self._skip += delta
+        if tag in MAIN_TAGS:
+            self._main += delta
+        elif tag == "a":
+            self._link += delta
+        elif tag == "pre":
+            self._pre += delta
+        elif tag in HEADINGS:
+            self._heading = HEADINGS[tag] if delta > 0 else 0
+
+    def _flush(self):
+        text = "".join(self._parts)
+        text = text.strip("\n") if self._pre else text.strip()
+        if text:
+            self.blocks.append(Block(text, self._link_chars, self._main > 0, self._heading, self._pre > 0))
+        self._parts = []
+        self._link_chars = 0
+
+    @staticmethod
+    def _is_boilerplate(attrs) -> bool:
+        for name, value in attrs:
+            if name in ("class", "id", "role") and value and _BOILERPLATE.search(value):
+                return True
+            if name == "role" and value in ("navigation", "banner", "contentinfo", "complementary"):
+                return True
+            if name == "hidden" or (name == "aria-hidden" and value == "true"):
+                return True
+        return False
+
+
+def visible_text(html: str) -> str:
+    '''
+    页面中所有不属于脚本、导航等的文本
+    '''
+    parser = ReadableParser()
+    parser.feed(html)
+    parser.close()
+    return "\n".join(block.text for block in parser.blocks)
+
+
+def extract_readable(html: str, max_tokens: int = 0) -> ReadablePage:
+    '''
+    提取正文，max_tokens 大于0时按token预算截断
+    '''
+    parser = ReadableParser()
+    parser.feed(html)
+    parser.close()
+    blocks = parser.blocks
+    main_blocks = [block for block in blocks if block.in_main]
+    if sum(len(block.text) for block in main_blocks) >= MIN_MAIN_CHARS:
+        blocks = main_blocks
+    lines = []
+    for block in blocks:
+        if not block.heading and not block.pre and block.link_chars > len(block.text) * 0.5:
+            # 链接占比过高，多半是导航或推荐列表
+            continue
+        line = "#" * block.heading + " " + block.text if block.heading else block.text
+        if lines and lines[-1] == line:
+            continue
+        lines.append(line)
+    text = "\n".join(lines)
+    title = _SPACES.sub(" ", parser.title).strip()
+    truncated = False
+    if max_tokens > 0:
+        limited = truncate_to_tokens(text, max_tokens)
+        truncated = len(limited) < len(text)
+        text = limited
+    return ReadablePage(title=title, text=text, tokens=estimate_tokens(text), truncated=truncated)
@@ -0,0 +1,279 @@
+"""网页抓取
+
+先用普通的异步HTTP请求获取页面，只有请求失败或页面需要执行JavaScript才能看到内容时，
+才交给预热好的无头浏览器池渲染。浏览器实例在多次抓取之间复用，多个页面可以在不同的实例上同时渲染。
+read() 返回提取后的正文，按URL缓存在内存和磁盘中，过期后带 ETag/Last-Modified 发起条件请求，未修改时直接续期。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass
+
+import httpx
+
+from live2d_server.configuration import FetchConfig
+from live2d_server.search.extract import extract_readable, visible_text
+from live2d_server.tokens import estimate_tokens, truncate_to_tokens
+from live2d_server.blob_cache import BlobCache
+
+logger = logging.getLogger(__name__)
+
+# 提示需要开启JavaScript的页面
+_JS_REQUIRED = re.compile(r"enable javascript|javascript is (?:disabled|required)|启用\s*javascript|开启\s*javascript", re.IGNORECASE)
+
+
+@dataclass
+class FetchResult:
+    url: str
+    html: str
+    status: int
+    content_type: str
+    via: str # http / browser
+    elapsed: float # 秒
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+@dataclass
+class PageContent:
+    url: str
+    title: str
+    text: str
+    tokens: int
+    truncated: bool
+    cached: bool # 是否没有重新下载页面（缓存未过期或服务器返回304）
+
+    def to_dict(self) -> dict:
+        return {"url": self.url, "title": self.title, "content": self.text, "truncated": self.truncated}
+
+
+class BrowserPool:
+    """复用的无头浏览器实例池，实例在第一次使用时创建，之后一直保持运行"""
+
+    def __init__(self, size: int, wait_time: float, idle_time: float):
+        self.size = size
+        self.wait_time = wait_time
+        self.idle_time = idle_time
+        # 同时使用的实例数不超过 size，拿到许可时要么有空闲实例，要么可以新建一个
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+
+    async def fetch(self, url: str) -> str | None:
+        async with self._slots:
+            manager = self._idle.pop() if self._idle else await asyncio.to_thread(self._create)
+            healthy = True
+            try:
+                html = await asyncio.to_thread(manager.get_page_content, url, self.wait_time, 2, self.idle_time)
+                if html is None:
+                    healthy = await asyncio.to_thread(self._alive, manager)
+                return html
+            finally:
+                if healthy:
+                    self._idle.append(manager)
+                else:
+                    # 浏览器已经崩溃，丢弃该实例，下次使用时重新创建
+                    await asyncio.to_thread(manager.close_webdriver)
+
+    async def warm_up(self):
+        '''
+        预先启动所有浏览器实例
+        '''
+        managers = await asyncio.gather(*[asyncio.to_thread(self._create) for _ in range(self.size - len(self._idle))], return_exceptions=True)
+        for manager in managers:
+            if isinstance(manager, BaseException):
+                logger.warning(f"browser warm up failed: {manager}")
+            else:
+                self._idle.append(manager)
+
+    def _create(self):
+        # 只有需要渲染页面时才导入selenium
+        from utils.selenium import WebDriverManager
+        manager = WebDriverManager()
+        manager.driver = manager.create_webdriver()
+        if manager.driver is None:
+            raise RuntimeError("没有可用的浏览器")
+        # driver.get() 本身也要受限，否则卡住的页面会按 Selenium 默认的 300 秒占用一个实例
+        manager.driver.set_page_load_timeout(self.wait_time)
+        return manager
+
+    @staticmethod
+    def _alive(manager) -> bool:
+        try:
+            manager.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    async def close(self):
+        managers, self._idle = self._idle, []
+        await asyncio.gather(*[asyncio.to_thread(manager.close_webdriver) for manager in managers])
+
+
+class PageFetcher:
+
+    def __init__(self, config: FetchConfig):
+        self.config = config
+        self._client: httpx.AsyncClient | None = None
+        self.browser_pool = BrowserPool(config.browserPoolSize, config.browserTimeout, config.networkIdle) if config.browserPoolSize > 0 else None
+        self.cache = BlobCache(config.cacheMemoryBytes, config.cacheDir or None, config.cacheDiskBytes) if config.cacheTtl > 0 else None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                headers={"User-Agent": self.config.userAgent},
+                limits=httpx.Limits(max_connections=self.config.maxConnections, max_keepalive_connections=self.config.maxConnections),
+            )
+        return self._client
+
+    async def fetch(self, url: str, headers: dict | None = None) -> FetchResult:
+        '''
+        headers 用于条件请求，服务器返回304时 html 为空
+        '''
+        start = time.perf_counter()
+        result = None
+        try:
+            response = await asyncio.wait_for(self._http().get(url, headers=headers, timeout=self.config.httpTimeout), self.config.httpTimeout)
+            result = FetchResult(
+                url=str(response.url),
+                html=response.text,
+                status=response.status_code,
+                content_type=response.headers.get("content-type", ""),
+                via="http",
+                elapsed=time.perf_counter() - start,
+                etag=response.headers.get("etag"),
+                last_modified=response.headers.get("last-modified"),
+            )
+            # 解析HTML比较耗时，放到线程中执行，避免阻塞事件循环
+            if result.status == 304 or not await asyncio.to_thread(self.needs_browser, result):
+                return result
+        except Exception as e:
+            logger.info(f"http fetch {url} failed: {e!r}")
+        if self.browser_pool is None:
+            if result is None:
+                raise RuntimeError(f"无法获取页面: {url}")
+            return result
+        try:
+            html = await self.browser_pool.fetch(url)
+        except Exception as e:
+            logger.warning(f"browser fetch {url} failed: {e!r}")
+            html = None
+        if html is None:
+            if result is None:
+                raise RuntimeError(f"无法获取页面: {url}")
+            return result
+        logger.info(f"browser fetch {url} in {time.perf_counter() - start:.3f}s")
+        return FetchResult(url=url, html=html, status=200, content_type="text/html", via="browser", elapsed=time.perf_counter() - start)
+
+    async def fetch_many(self, urls: list[str]) -> list[FetchResult | BaseException]:
+        '''
+        并发抓取多个页面，需要浏览器渲染的页面分布到池中的不同实例上
+        '''
+        return await asyncio.gather(*[self.fetch(url) for url in urls], return_exceptions=True)
+
+    def needs_browser(self, result: FetchResult) -> bool:
+        '''
+        请求失败、被拦截，或者HTML中几乎没有可见文本（内容由JavaScript生成）时需要浏览器渲染
+        '''
+        if result.status >= 400:
+            return True
+        if "html" not in result.content_type:
+            return False
+        text = visible_text(result.html)
+        return len(text) < self.config.minTextChars or bool(_JS_REQUIRED.search(text))
+
+    async def read(self, url: str) -> PageContent:
+        '''
+        获取页面正文，优先使用缓存
+        '''
+        key = hashlib.sha256(f"{url}\x00{self.config.maxTokens}".encode("utf-8")).hexdigest()
+        cached = await self.cache.get(key) if self.cache is not None else None
+        meta = json.loads(cached[0]) if cached else None
+        if meta is not None and meta["expires"] > time.time():
+            return self._content(meta, cached[1], cached=True)
+        headers = {}
+        if meta is not None and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta is not None and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        result = await self.fetch(url, headers or None)
+        if result.status == 304 and meta is not None:
+            meta["expires"] = time.time() + self.config.cacheTtl
+            await self._store(key, meta, cached[1])
+            return self._content(meta, cached[1], cached=True)
+        if result.status >= 400:
+            raise RuntimeError(f"无法获取页面: {url}，状态码 {result.status}")
+        if "html" in result.content_type or not result.content_type:
+            page = await asyncio.to_thread(extract_readable, result.html, self.config.maxTokens)
+            title, text, truncated = page.title, page.text, page.truncated
+        else:
+            text = truncate_to_tokens(result.html, self.config.maxTokens)
+            title, truncated = "", len(text) < len(result.html)
+        meta = {
+            "url": result.url,
+            "title": title,
+            "truncated": truncated,
+            "etag": result.etag,
+            "last_modified": result.last_modified,
+            "expires": time.time() + self.config.cacheTtl,
+        }
+        data = text.encode("utf-8")
+        await self._store(key, meta, data)
+        return self._content(meta, data, cached=False)
+
+    async def read_many(self, urls: list[str]) -> list[PageContent | BaseException]:
+        return await asyncio.gather(*[self.read(url) for url in urls], return_exceptions=True)
+
+    async def _store(self, key: str, meta: dict, data: bytes):
+        if self.cache is None:
+            return
+        # 条目内容会更新，先删除旧条目，避免磁盘上保留旧版本
+        await self.cache.delete(key)
+        await self.cache.put(key, [json.dumps(meta).encode("utf-8"), data])
+
+    @staticmethod
+    def _content(meta: dict, data: bytes, cached: bool) -> PageContent:
+        text = data.decode("utf-8")
+        return PageContent(url=meta["url"], title=meta["title"], text=text, tokens=estimate_tokens(text), truncated=meta["truncated"], cached=cached)
+
+    def stats(self) -> dict:
+        return self.cache.stats() if self.cache is not None else {}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self.browser_pool is not None:
+            await self.browser_pool.close()
+
+
+page_fetcher = PageFetcher(FetchConfig())
+
+
+def configure(config: FetchConfig):
+    '''
+    使用新的配置替换全局抓取器，旧的连接池和浏览器在后台关闭
+    '''
+    global page_fetcher
+    if config == page_fetcher.config:
+        return
+    old_fetcher = page_fetcher
+    page_fetcher = PageFetcher(config)
+    try:
+        asyncio.get_running_loop().create_task(old_fetcher.aclose())
+    except RuntimeError:
+        # 没有运行中的事件循环时无法异步关闭，交给垃圾回收
+        pass
+
+
+async def warm_up():
+    if page_fetcher.browser_pool is not None and page_fetcher.config.browserWarmUp:
+        await page_fetcher.browser_pool.warm_up()
+
+
+async def shutdown():
+    await page_fetcher.aclose()
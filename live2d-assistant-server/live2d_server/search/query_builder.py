@@ -0,0 +1,152 @@
+"""搜索词构建
+
+默认在本地用 jieba 分词并提取关键词（TF-IDF 或 TextRank），不需要等待一次大模型调用；
+只有当问题有歧义（包含代词、追问过短等）需要结合上下文理解时，才交给大模型改写。
+"""
+
+import logging
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+import jieba
+import jieba.analyse
+
+from live2d_server.configuration import RetrievalConfig
+from live2d_server.openai_adapter import OpenAIAdapter
+
+logger = logging.getLogger(__name__)
+
+_LATIN_WORD = re.compile(r"[A-Za-z]+")
+
+
+@dataclass
+class BuiltQuery:
+    query: str
+    path: str # keywords / llm
+    elapsed: float # 构建搜索词的耗时，单位秒
+    saved: float | None = None # 相比大模型改写节省的时间，没有大模型耗时的样本时为 None
+
+
+class QueryStats:
+    """统计两种方式的使用次数，并用大模型改写耗时的滑动平均估算本地提取节省的时间"""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.counts = {"keywords": 0, "llm": 0}
+        self.llm_latency: float | None = None
+        self.saved_total = 0.0
+
+    def record(self, built: BuiltQuery):
+        self.counts[built.path] += 1
+        if built.path == "llm":
+            if self.llm_latency is None:
+                self.llm_latency = built.elapsed
+            else:
+                self.llm_latency += self.alpha * (built.elapsed - self.llm_latency)
+        elif self.llm_latency is not None:
+            built.saved = max(0.0, self.llm_latency - built.elapsed)
+            self.saved_total += built.saved
+
+    def stats(self) -> dict:
+        return {
+            **self.counts,
+            "llm_latency_ms": None if self.llm_latency is None else round(self.llm_latency * 1000),
+            "saved_ms_total": round(self.saved_total * 1000),
+        }
+
+
+query_stats = QueryStats()
+
+
+def warm_up():
+    '''
+    预先加载 jieba 词典，避免第一次提取关键词时等待
+    '''
+    jieba.initialize()
+
+
+class QueryBuilder:
+    """根据配置选择本地关键词提取或大模型改写"""
+
+    def __init__(self, llm_adapter: OpenAIAdapter, model: str, config: RetrievalConfig):
+        self.llm_adapter = llm_adapter
+        self.model = model
+        self.config = config
+
+    async def build(self, prompt: str, messages: list[dict]) -> BuiltQuery:
+        '''
+        prompt 为大模型改写时使用的提示词模板，包含 question/history/now 三个占位符
+        '''
+        mode = self.config.queryBuilder
+        if mode == "llm" or (mode == "auto" and self.is_ambiguous(messages)):
+            built = await self._llm_query(prompt, messages)
+        else:
+            built = self._keyword_query(messages)
+            if not built.query:
+                # 没有提取到关键词（如纯表情、纯标点），退回大模型改写
+                built = await self._llm_query(prompt, messages)
+        query_stats.record(built)
+        logger.info(f"search query ({built.path}, {built.elapsed * 1000:.1f}ms): {built.query}")
+        return built
+
+    def is_ambiguous(self, messages: list[dict]) -> bool:
+        '''
+        有对话历史，且最后一个问题过短或包含指代词时，认为需要结合上下文改写
+        '''
+        if len(self._history(messages)) == 0:
+            return False
+        question = _text(messages[-1]).strip()
+        if len(question) < self.config.ambiguousMinChars:
+            return True
+        lowered = question.lower()
+        for word in self.config.ambiguousWords:
+            if _LATIN_WORD.fullmatch(word):
+                if re.search(rf"\b{re.escape(word)}\b", lowered):
+                    return True
+            elif word in question:
+                return True
+        return False
+
+    def _keyword_query(self, messages: list[dict]) -> BuiltQuery:
+        start = time.perf_counter()
+        top_k = self.config.keywordTopK
+        keywords = self._extract(_text(messages[-1]), top_k)
+        history = " ".join(_text(message) for message in self._history(messages)[-self.config.keywordHistoryTurns:])
+        if history and len(keywords) < top_k:
+            for word in self._extract(history, top_k):
+                if word not in keywords:
+                    keywords.append(word)
+                if len(keywords) >= top_k:
+                    break
+        return BuiltQuery(query=" ".join(keywords), path="keywords", elapsed=time.perf_counter() - start)
+
+    def _extract(self, text: str, top_k: int) -> list[str]:
+        if not text:
+            return []
+        if self.config.keywordMethod == "textrank":
+            words = jieba.analyse.textrank(text, topK=top_k)
+        else:
+            words = jieba.analyse.extract_tags(text, topK=top_k)
+        # 按在原文中出现的顺序排列，更接近自然的搜索词
+        return sorted(words, key=text.find)
+
+    async def _llm_query(self, prompt: str, messages: list[dict]) -> BuiltQuery:
+        start = time.perf_counter()
+        query = await self.llm_adapter.generate(model=self.model, prompt=prompt.format(
+            question=messages[-1]['content'],
+            history=messages[1:],
+            now=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        ))
+        return BuiltQuery(query=query, path="llm", elapsed=time.perf_counter() - start)
+
+    @staticmethod
+    def _history(messages: list[dict]) -> list[dict]:
+        # 最后一条是当前问题，系统提示词不算作对话历史
+        return [message for message in messages[:-1] if message.get('role') in ('user', 'assistant')]
+
+
+def _text(message: dict) -> str:
+    content = message.get('content')
+    return content if isinstance(content, str) else ""
@@ -1,6 +1,162 @@
-from langchain_community.utilities.searx_search import SearxSearchWrapper
+"""SearxNG 异步搜索客户端
 
-searx_search_wrapper = SearxSearchWrapper(searx_host="http://localhost:8080", k=5)
+复用同一个 httpx 连接池，每个搜索引擎单独发起请求并各自超时，
+结果按URL去重后用倒数排名融合（RRF）排序，被多个引擎同时返回的结果排在前面。
+相同的查询在TTL内直接返回缓存，并发的相同查询只请求一次。
+"""
 
-def search(query: str) -> str:
-    return searx_search_wrapper.run(query, engines=["bing", "duckduckgo", "baidu"])
\ No newline at end of file
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import httpx
+
+from live2d_server.configuration import SearchConfig
+
+logger = logging.getLogger(__name__)
+
+# RRF 的平滑常数
+RRF_K = 60
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+@dataclass
+class SearchResult:
+    title: str
+    url: str
+    content: str
+    engines: list[str] = field(default_factory=list)
+    score: float = 0.0
+
+    def to_dict(self) -> dict:
+        # 与 langchain 的 SearxSearchResults 返回的字段保持一致
+        return {"title": self.title, "link": self.url, "snippet": self.content, "engines": self.engines}
+
+
+def normalize_query(query: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", query)).strip().lower()
+
+
+def url_key(url: str) -> str:
+    '''
+    用于去重的URL：忽略协议、www前缀、末尾的斜杠和锚点
+    '''
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    path = parts.path.rstrip("/")
+    return f"{host}{path}?{parts.query}" if parts.query else f"{host}{path}"
+
+
+class SearxClient:
+
+    def __init__(self, config: SearchConfig):
+        self.config = config
+        self._client: httpx.AsyncClient | None = None
+        self._cache: OrderedDict[str, tuple[float, list[SearchResult]]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.config.searxHost,
+                limits=httpx.Limits(max_connections=self.config.maxConnections, max_keepalive_connections=self.config.maxConnections),
+            )
+        return self._client
+
+    async def search(self, query: str, engines: list[str] | None = None) -> list[SearchResult]:
+        engines = engines or self.config.engines
+        key = f"{normalize_query(query)}|{','.join(sorted(engines))}"
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            return cached[1]
+        task = self._inflight.get(key)
+        if task is None:
+            # 搜索在独立的任务中进行，某个调用方超时取消时不影响其他等待者，结果仍会写入缓存
+            task = asyncio.create_task(self._search(key, query, engines))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _search(self, key: str, query: str, engines: list[str]) -> list[SearchResult]:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[self._search_engine(query, engine) for engine in engines])
+        merged: dict[str, SearchResult] = {}
+        for engine, results in zip(engines, responses):
+            for rank, item in enumerate(results or []):
+                url = item.get("url")
+                if not url:
+                    continue
+                result = merged.setdefault(url_key(url), SearchResult(title=item.get("title", ""), url=url, content=""))
+                if len(item.get("content") or "") > len(result.content):
+                    result.content = item["content"]
+                if engine not in result.engines:
+                    result.engines.append(engine)
+                result.score += 1 / (RRF_K + rank + 1)
+        ranked = sorted(merged.values(), key=lambda r: r.score, reverse=True)[:self.config.resultCount]
+        logger.info(f"searx: {len(ranked)} results from {sum(r is not None for r in responses)}/{len(engines)} engines in {time.perf_counter() - start:.3f}s")
+        if any(r is not None for r in responses):
+            # 所有引擎都失败时不缓存，下次重新请求
+            self._cache[key] = (time.monotonic() + self.config.cacheTtl, ranked)
+            while len(self._cache) > self.config.cacheSize:
+                self._cache.popitem(last=False)
+        return ranked
+
+    async def _search_engine(self, query: str, engine: str) -> list[dict] | None:
+        '''
+        请求单个引擎，失败或超时返回 None
+        '''
+        try:
+            # httpx 的超时针对单次读写，外层再限制整个请求的耗时
+            response = await asyncio.wait_for(self._http().get(
+                "/search",
+                params={"q": query, "format": "json", "engines": engine},
+                timeout=self.config.engineTimeout,
+            ), self.config.engineTimeout)
+            response.raise_for_status()
+            return response.json().get("results", [])
+        except Exception as e:
+            logger.warning(f"searx engine {engine} failed: {e!r}")
+            return None
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+searx_client = SearxClient(SearchConfig())
+
+
+def configure(config: SearchConfig):
+    '''
+    使用新的配置替换全局客户端，旧的连接池在后台关闭
+    '''
+    global searx_client
+    if config == searx_client.config:
+        return
+    old_client = searx_client
+    searx_client = SearxClient(config)
+    try:
+        asyncio.get_running_loop().create_task(old_client.aclose())
+    except RuntimeError:
+        # 没有运行中的事件循环时无法异步关闭，交给垃圾回收
+        pass
+
+
+async def shutdown():
+    await searx_client.aclose()
+
+
+def format_results(results: list[SearchResult]) -> str:
+    return "\n\n".join(f"{result.title}\n{result.content}\n{result.url}" for result in results)
+
+
+async def search(query: str) -> str:
+    return format_results(await searx_client.search(query))
@@ -0,0 +1,109 @@
+"""SSE 输出
+
+大模型每输出一个token就是一个文本事件，逐个编码发送时帧数多、CPU开销大。
+SseWriter 把一个小时间窗口或字节数内连续的文本事件合并成一帧，遇到其他类型的事件
+（工具调用、音频、完成等）时先发出已合并的文本再立即发出该事件，保证顺序不变。
+推理模型的 <think>、</think> 标签总是单独作为一个文本事件发送，前端按事件内容识别思考过程。
+安装了 orjson 时使用 orjson 编码，否则使用标准库 json。
+"""
+
+import asyncio
+import json
+import re
+import time
+from typing import AsyncGenerator, AsyncIterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_event(event: dict) -> bytes:
+    if orjson is not None:
+        payload = orjson.dumps(event)
+    else:
+        payload = json.dumps(event, ensure_ascii=False).encode("utf-8")
+    return b"data: " + payload + b"\n\n"
+
+
+_THINK_TAG = re.compile(r"(</?think>)")
+
+
+async def _next(iterator: AsyncIterator[dict]) -> dict:
+    return await anext(iterator)
+
+
+class SseWriter:
+
+    def __init__(self, window: float = 0.015, max_bytes: int = 256):
+        '''
+        window: 合并文本事件的最长等待时间，单位秒，0表示不合并
+        max_bytes: 合并的文本超过该字节数时立即发送
+        '''
+        self.window = window
+        self.max_bytes = max_bytes
+        self.events = 0
+        self.frames = 0
+
+    async def stream(self, events: AsyncIterator[dict]) -> AsyncGenerator[bytes, None]:
+        iterator = aiter(events)
+        texts: list[str] = []
+        size = 0
+        deadline = 0.0
+        pending: asyncio.Task | None = None
+        try:
+            while True:
+                try:
+                    if texts:
+                        # 有待发送的文本时最多等到窗口结束，超时后先发送文本，继续等待同一个事件
+                        if pending is None:
+                            pending = asyncio.create_task(_next(iterator))
+                        done, _ = await asyncio.wait({pending}, timeout=max(0.0, deadline - time.monotonic()))
+                        if not done:
+                            yield self._frame({'type': 'text', 'content': ''.join(texts)})
+                            texts, size = [], 0
+                            continue
+                    if pending is not None:
+                        task, pending = pending, None
+                        event = await task
+                    else:
+                        event = await anext(iterator)
+                except StopAsyncIteration:
+                    break
+                self.events += 1
+                if event.get('type') == 'text' and isinstance(event.get('content'), str) and self.window > 0:
+                    for part in _THINK_TAG.split(event['content']):
+                        if _THINK_TAG.fullmatch(part):
+                            if texts:
+                                yield self._frame({'type': 'text', 'content': ''.join(texts)})
+                                texts, size = [], 0
+                            yield self._frame({'type': 'text', 'content': part})
+                            continue
+                        if not part:
+                            continue
+                        if not texts:
+                            deadline = time.monotonic() + self.window
+                        texts.append(part)
+                        size += len(part.encode('utf-8'))
+                        if size >= self.max_bytes:
+                            yield self._frame({'type': 'text', 'content': ''.join(texts)})
+                            texts, size = [], 0
+                    continue
+                if texts:
+                    yield self._frame({'type': 'text', 'content': ''.join(texts)})
+                    texts, size = [], 0
+                yield self._frame(event)
+            if texts:
+                yield self._frame({'type': 'text', 'content': ''.join(texts)})
+        finally:
+            if pending is not None:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+            if hasattr(iterator, 'aclose'):
+                # 客户端断开时关闭上游的生成器，执行其中的清理逻辑
+                await iterator.aclose()
+
+    def _frame(self, event: dict) -> bytes:
+        self.frames += 1
+        return encode_event(event)
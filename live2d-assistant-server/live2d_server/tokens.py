@@ -0,0 +1,34 @@
+"""token 数量估算
+
+不依赖具体模型的分词器：中日韩字符大约每个字一个token，其余文本大约每4个字符一个token。
+只用于控制上下文长度的预算，不需要精确。
+"""
+
+import re
+
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    '''
+    截断文本使其不超过 max_tokens，尽量在换行处截断
+    '''
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 二分查找满足预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    cut = text.rfind("\n", 0, low)
+    return text[:cut if cut > low // 2 else low]
@@ -3,8 +3,26 @@ import os
 import torchaudio
 import torch
 import io
+import logging
+from dataclasses import dataclass
+from typing import Generator
+from live2d_server.tts_cache import file_digest
 
-def tts_init(install_path: str, model_path: str, prompt_path: str, sample_rate: int, prompt_text: str):
+logger = logging.getLogger(__name__)
+
+def tts_init(install_path: str, model_path: str, backend: str = 'eager', intra_op_threads: int = 0):
+    '''
+    加载CosyVoice2模型
+
+    backend:
+        eager: 原始的PyTorch模型
+        jit: 使用TorchScript导出的flow encoder
+        onnx: 在jit的基础上，前端的说话人/语音token提取使用多线程、全图优化的ONNX Runtime CPU会话
+        int8: 对LLM和flow中的Linear层做动态int8量化
+    intra_op_threads: PyTorch和ONNX Runtime的算子内线程数，0表示使用默认值
+    '''
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
     # Convert to absolute paths
     install_path = os.path.abspath(install_path)
     cosyvoice_path = os.path.join(install_path)
@@ -13,25 +31,109 @@ def tts_init(install_path: str, model_path: str, prompt_path: str, sample_rate:
     # Add to sys.path
     sys.path.append(cosyvoice_path)
     sys.path.append(matcha_tts_path)
-    print("Current sys.path:", sys.path)    
+    print("Current sys.path:", sys.path)
     # Now import the modules
     from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
-    from cosyvoice.utils.file_utils import load_wav
 
-    cosyvoice = CosyVoice2(model_path, load_jit=False, load_trt=False, fp16=False)
+    cosyvoice = CosyVoice2(model_path, load_jit=backend in ('jit', 'onnx'), load_trt=False, fp16=False)
+    if backend == 'onnx':
+        _configure_onnx_frontend(cosyvoice, intra_op_threads)
+    elif backend == 'int8':
+        _quantize_int8(cosyvoice)
+    logger.info(f"CosyVoice2 loaded with backend {backend}, threads {torch.get_num_threads()}")
+    return cosyvoice
+
+def _configure_onnx_frontend(cosyvoice, intra_op_threads: int):
+    import onnxruntime
+    option = onnxruntime.SessionOptions()
+    option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    option.intra_op_num_threads = intra_op_threads or os.cpu_count()
+    providers = ["CPUExecutionProvider"]
+    frontend = cosyvoice.frontend
+    frontend.campplus_session = onnxruntime.InferenceSession(
+        os.path.join(cosyvoice.model_dir, 'campplus.onnx'), sess_options=option, providers=providers)
+    frontend.speech_tokenizer_session = onnxruntime.InferenceSession(
+        os.path.join(cosyvoice.model_dir, 'speech_tokenizer_v2.onnx'), sess_options=option, providers=providers)
+
+def _quantize_int8(cosyvoice):
+    model = cosyvoice.model
+    model.llm = torch.ao.quantization.quantize_dynamic(model.llm, {torch.nn.Linear}, dtype=torch.qint8)
+    model.flow = torch.ao.quantization.quantize_dynamic(model.flow, {torch.nn.Linear}, dtype=torch.qint8)
+
+@dataclass
+class Voice:
+    name: str
+    prompt_text: str
+    prompt_speech: torch.Tensor | None = None # 未能预先提取特征时使用原始提示音频
+    spk_id: str = '' # 预先提取的说话人特征在 cosyvoice.frontend.spk2info 中的键
+
+def voice_sidecar_path(prompt_path: str) -> str:
+    return os.path.splitext(prompt_path)[0] + '.spk.pt'
+
+def load_voice(cosyvoice, name: str, prompt_path: str, prompt_text: str, sample_rate: int, model_path: str) -> Voice:
+    '''
+    加载一个音色，提示音频的说话人特征只提取一次，并保存到提示音频旁边的文件中，
+    提示音频或提示文本变化后会重新提取
+    '''
+    from cosyvoice.utils.file_utils import load_wav
+    if not hasattr(cosyvoice, 'add_zero_shot_spk'):
+        # 旧版本的CosyVoice不支持预先提取特征
+        return Voice(name=name, prompt_text=prompt_text, prompt_speech=load_wav(prompt_path, sample_rate))
+    spk_id = f'voice:{name}'
+    fingerprint = '\x00'.join([file_digest(prompt_path), prompt_text, str(sample_rate), model_path])
+    sidecar = voice_sidecar_path(prompt_path)
+    if os.path.exists(sidecar):
+        try:
+            saved = torch.load(sidecar, map_location='cpu')
+            if saved.get('fingerprint') == fingerprint:
+                cosyvoice.frontend.spk2info[spk_id] = saved['spk_info']
+                logger.info(f"Loaded voice {name} from {sidecar}")
+                return Voice(name=name, prompt_text=prompt_text, spk_id=spk_id)
+        except Exception as e:
+            logger.warning(f"Failed to load voice sidecar {sidecar}: {e}")
     prompt_speech_16k = load_wav(prompt_path, sample_rate)
-    return cosyvoice, prompt_speech_16k
+    cosyvoice.add_zero_shot_spk(prompt_text, prompt_speech_16k, spk_id)
+    try:
+        torch.save({'fingerprint': fingerprint, 'spk_info': cosyvoice.frontend.spk2info[spk_id]}, sidecar)
+        logger.info(f"Saved voice {name} to {sidecar}")
+    except OSError as e:
+        logger.warning(f"Failed to save voice sidecar {sidecar}: {e}")
+    return Voice(name=name, prompt_text=prompt_text, spk_id=spk_id)
 
 class TtsServer:
-    def __init__(self, cosyvoice, prompt_speech: torch.Tensor, prompt_text: str):
+    def __init__(self, cosyvoice, voices: dict[str, Voice], default_voice: str):
         self.cosyvoice = cosyvoice
-        self.prompt_speech = prompt_speech
-        self.prompt_text = prompt_text
+        self.voices = voices
+        self.default_voice = default_voice
 
-    def tts(self, text: str):
+    def _inference(self, text: str, voice: str | None, stream: bool):
+        v = self.voices[voice or self.default_voice]
+        if v.spk_id:
+            # 使用预先提取的说话人特征，不再传入提示音频
+            return self.cosyvoice.inference_zero_shot(text, v.prompt_text, '', zero_shot_spk_id=v.spk_id, stream=stream)
+        return self.cosyvoice.inference_zero_shot(text, v.prompt_text, v.prompt_speech, stream=stream)
+
+    def tts(self, text: str, voice: str | None = None):
         audios = []
-        for i, j in enumerate(self.cosyvoice.inference_zero_shot(text, self.prompt_text, self.prompt_speech, stream=False)):
+        for i, j in enumerate(self._inference(text, voice, stream=False)):
             audio_bytes = io.BytesIO()
-            torchaudio.save(audio_bytes, j['tts_speech'], self.cosyvoice.sample_rate, format='wav')
+            torchaudio.save(audio_bytes, j['tts_speech'], self.cosyvoice.sample_rate, format='wav', encoding='PCM_S', bits_per_sample=16)
             audios.append(audio_bytes.getvalue())
-        return audios
\ No newline at end of file
+        return audios
+
+    def tts_stream(self, text: str, voice: str | None = None, frame_size: int = 2400) -> Generator[bytes, None, None]:
+        '''
+        流式合成，模型每产生一段语音就切分成 frame_size 个采样点的16位PCM帧输出
+        '''
+        frame_bytes = frame_size * 2
+        buffer = b''
+        for j in self._inference(text, voice, stream=True):
+            buffer += pcm16(j['tts_speech'])
+            while len(buffer) >= frame_bytes:
+                yield buffer[:frame_bytes]
+                buffer = buffer[frame_bytes:]
+        if buffer:
+            yield buffer
+
+def pcm16(speech: torch.Tensor) -> bytes:
+    return (speech.clamp(-1, 1) * 32767).to(torch.int16).cpu().numpy().tobytes()
@@ -0,0 +1,157 @@
+"""TTS性能测试
+
+对比原有的逐句串行合成（TtsServer.tts 处理整段文本）与多进程并行合成流水线，
+输出首段音频延迟（time-to-first-audio）和实时率（RTF = 合成耗时 / 音频时长）。
+指定 --backends 时，改为在同一组文本上逐个比较推理后端。
+
+用法：
+    python -m live2d_server.tts_benchmark --config config.json --workers 2 --lookahead 4
+    python -m live2d_server.tts_benchmark --config config.json --backends eager,jit,onnx,int8 --threads 4
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from live2d_server.audio import wav_to_pcm
+from live2d_server.configuration import Config, TTSConfig
+from live2d_server.tts_engine import TtsEngine
+from live2d_server.tts_pipeline import TtsPipeline
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEXTS = [
+    "你好，我是你的桌面助手。今天有什么可以帮你的吗？",
+    "今天北京晴，最高气温26℃，最低气温15℃，空气质量良好。适合外出散步，但是早晚温差较大，记得带一件外套。",
+    "这个问题可以分三步来解决。首先，确认网络连接是否正常；其次，检查配置文件里的地址和端口；最后，重启服务并观察日志中是否还有报错。如果问题依然存在，请把日志发给我。",
+]
+
+
+def audio_seconds(wav_data: list[bytes]) -> float:
+    seconds = 0.0
+    for data in wav_data:
+        pcm, sample_rate = wav_to_pcm(data)
+        seconds += len(pcm) / 2 / sample_rate
+    return seconds
+
+
+def bench_sequential(config: TTSConfig, texts: list[str]) -> list[dict]:
+    '''
+    在当前进程中加载模型，用 TtsServer.tts 一次合成整段文本
+    '''
+    from live2d_server.tts import tts_init, load_voice, TtsServer
+    cosyvoice = tts_init(config.cosyvoiceInstallPath, config.modulePath, config.backend, config.intraOpThreads)
+    voices = {
+        voice.name: load_voice(cosyvoice, voice.name, voice.promptPath, voice.promptText, config.sampleRate, config.modulePath)
+        for voice in config.all_voices()
+    }
+    tts_server = TtsServer(cosyvoice, voices, config.defaultVoice)
+    results = []
+    for text in texts:
+        start = time.perf_counter()
+        wav_data = tts_server.tts(text)
+        elapsed = time.perf_counter() - start
+        # 串行合成要等整段文本合成完才有音频
+        results.append({"ttfa": elapsed, "elapsed": elapsed, "audio": audio_seconds(wav_data)})
+    return results
+
+
+async def bench_pipeline(config: TTSConfig, texts: list[str], lookahead: int, stream: bool) -> list[dict]:
+    '''
+    使用多进程引擎和分句流水线合成，记录第一段音频到达的时间
+    '''
+    tts_engine = TtsEngine(config)
+    tts_engine.start()
+    try:
+        await tts_engine.wait_ready()
+        results = []
+        for text in texts:
+            start = time.perf_counter()
+            tts_pipeline = TtsPipeline(tts_engine, stream=stream, lookahead=lookahead)
+            tts_pipeline.feed(text)
+            tts_pipeline.flush()
+            ttfa = None
+            items = []
+            async for data, _ in tts_pipeline.drain():
+                if ttfa is None:
+                    ttfa = time.perf_counter() - start
+                items.append(data)
+            elapsed = time.perf_counter() - start
+            if stream:
+                # 第一项是WAV头，后面是PCM帧
+                seconds = sum(len(frame) for frame in items[1:]) / 2 / tts_engine.sample_rate
+            else:
+                seconds = audio_seconds(items)
+            results.append({"ttfa": ttfa or elapsed, "elapsed": elapsed, "audio": seconds})
+        return results
+    finally:
+        await tts_engine.shutdown()
+
+
+async def bench_backends(config: TTSConfig, texts: list[str], backends: list[str]) -> dict[str, list[dict]]:
+    '''
+    每个后端在独立的单个工作进程中加载，逐句合成，互不影响线程数等全局设置
+    '''
+    results = {}
+    for backend in backends:
+        backend_config = config.model_copy(update={'backend': backend, 'workers': 1})
+        start = time.perf_counter()
+        results[backend] = await bench_pipeline(backend_config, texts, lookahead=1, stream=False)
+        logger.warning(f"backend {backend} finished in {time.perf_counter() - start:.1f}s")
+    return results
+
+
+def report(name: str, results: list[dict]):
+    total_elapsed = sum(r["elapsed"] for r in results)
+    total_audio = sum(r["audio"] for r in results)
+    print(f"[{name}]")
+    for i, r in enumerate(results):
+        rtf = r["elapsed"] / r["audio"] if r["audio"] else float("inf")
+        print(f"  text {i}: ttfa={r['ttfa']:.3f}s elapsed={r['elapsed']:.3f}s audio={r['audio']:.2f}s rtf={rtf:.3f}")
+    rtf = total_elapsed / total_audio if total_audio else float("inf")
+    mean_ttfa = sum(r["ttfa"] for r in results) / len(results)
+    print(f"  total: mean_ttfa={mean_ttfa:.3f}s rtf={rtf:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TTS性能测试")
+    parser.add_argument('--config', type=str, required=True, help='配置文件路径，格式与 Config 相同')
+    parser.add_argument('--texts', type=str, default=None, help='测试文本文件，每行一段，默认使用内置文本')
+    parser.add_argument('--workers', type=int, default=None, help='并行合成的工作进程数，默认使用配置')
+    parser.add_argument('--lookahead', type=int, default=None, help='每段文本同时合成的句子数，默认使用配置')
+    parser.add_argument('--stream', action='store_true', help='流水线使用流式合成')
+    parser.add_argument('--skip-sequential', action='store_true', help='不测试串行合成')
+    parser.add_argument('--backends', type=str, default=None, help='逗号分隔的推理后端列表，如 eager,jit,onnx,int8')
+    parser.add_argument('--threads', type=int, default=None, help='算子内线程数，默认使用配置')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = Config.model_validate_json(f.read()).server.tts
+    # 测试时关闭缓存，避免重复文本命中缓存
+    config = config.model_copy(update={'cacheEnabled': False})
+    if args.workers is not None:
+        config = config.model_copy(update={'workers': args.workers})
+    if args.threads is not None:
+        config = config.model_copy(update={'intraOpThreads': args.threads})
+    lookahead = args.lookahead if args.lookahead is not None else config.lookahead
+    texts = DEFAULT_TEXTS
+    if args.texts:
+        with open(args.texts, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    if args.backends:
+        backends = [b.strip() for b in args.backends.split(',') if b.strip()]
+        for backend, results in asyncio.run(bench_backends(config, texts, backends)).items():
+            report(f"backend={backend} threads={config.intraOpThreads or 'default'}", results)
+        return
+
+    if not args.skip_sequential:
+        report("sequential", bench_sequential(config, texts))
+    name = f"pipeline workers={config.workers} lookahead={lookahead}{' stream' if args.stream else ''}"
+    report(name, asyncio.run(bench_pipeline(config, texts, lookahead, args.stream)))
+
+
+if __name__ == '__main__':
+    main()
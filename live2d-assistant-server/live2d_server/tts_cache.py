@@ -0,0 +1,46 @@
+"""TTS音频缓存
+
+以 hash(规范化文本, 提示音色, 采样率, 模型路径, 推理后端) 作为键缓存合成结果，存储使用 BlobCache。
+"""
+
+import hashlib
+import os
+import re
+import unicodedata
+
+from live2d_server.blob_cache import BlobCache
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    '''
+    规范化待合成文本，使全角/半角、多余空白不同的文本命中同一条缓存
+    '''
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def file_digest(path: str) -> str:
+    '''
+    计算文件内容的摘要，文件不存在时退化为路径本身
+    '''
+    if not path or not os.path.exists(path):
+        return hashlib.sha256(path.encode("utf-8")).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TtsCache(BlobCache):
+    """两级TTS音频缓存"""
+
+    @staticmethod
+    def make_key(text: str, prompt_identity: str, sample_rate: int, model_path: str, backend: str = "eager") -> str:
+        '''
+        所有影响合成结果的设置都要参与计算，例如 int8 量化的输出与其他后端不同
+        '''
+        raw = "\x00".join([normalize_text(text), prompt_identity, str(sample_rate), model_path, backend])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
@@ -0,0 +1,320 @@
+"""多进程TTS引擎
+
+CosyVoice 的推理是同步且耗时的，直接在协程中调用会阻塞整个事件循环。
+TtsEngine 在独立的工作进程中加载模型并执行合成，对外提供异步的 submit/stream 接口，
+待合成的任务放在有界队列中，队列满时提交任务会等待，以此实现背压。
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from typing import AsyncGenerator
+
+
+from live2d_server.audio import encode_audio, pcm_to_wav, split_frames, wav_to_pcm
+from live2d_server.cancellation import cancel_stats
+from live2d_server.configuration import TTSConfig
+from live2d_server.tts_cache import TtsCache, file_digest
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TtsJob:
+    text: str
+    voice: str
+    frame_size: int # 大于0时流式合成，每帧包含的采样点数
+    output: asyncio.Queue = field(default_factory=asyncio.Queue)
+    cancelled: bool = False
+
+
+def _worker_main(config: dict, conn: Connection):
+    '''
+    工作进程入口，加载模型后循环处理父进程发送的合成任务
+    '''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    from live2d_server.tts import tts_init, load_voice, TtsServer
+    try:
+        cosyvoice = tts_init(config['cosyvoiceInstallPath'], config['modulePath'], config['backend'], config['intraOpThreads'])
+        # 启动时提取所有音色的说话人特征，之后的每次合成都直接复用
+        voices = {
+            voice['name']: load_voice(cosyvoice, voice['name'], voice['promptPath'], voice['promptText'], config['sampleRate'], config['modulePath'])
+            for voice in config['voices']
+        }
+        tts_server = TtsServer(cosyvoice, voices, config['defaultVoice'])
+    except Exception as e:
+        logger.error(f"Failed to init tts worker: {e}")
+        conn.send(('error', str(e)))
+        return
+    conn.send(('ready', cosyvoice.sample_rate))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        text, voice, frame_size = job
+        try:
+            if frame_size > 0:
+                output = tts_server.tts_stream(text, voice, frame_size)
+            else:
+                output = tts_server.tts(text, voice)
+            for data in output:
+                conn.send(('data', data))
+            conn.send(('done', None))
+        except Exception as e:
+            logger.error(f"tts failed: {e}")
+            conn.send(('error', str(e)))
+
+
+class TtsEngine:
+    """TTS工作进程池"""
+
+    def __init__(self, config: TTSConfig):
+        self.config = config
+        self._jobs: asyncio.Queue[TtsJob] | None = None
+        self._processes: list[multiprocessing.Process] = []
+        self._conns: list[Connection] = []
+        self._dispatchers: list[asyncio.Task] = []
+        self.sample_rate: int | None = None # 模型输出的采样率，工作进程就绪后才能确定
+        self._ready = asyncio.Event()
+        self._alive = 0 # 正在加载或已经就绪的工作进程数量
+        self._error: str | None = None # 所有工作进程都已退出时的原因，之后提交的任务直接失败
+        self._stopped = asyncio.Event()
+        self.cache: TtsCache | None = None
+        if config.cacheEnabled:
+            self.cache = TtsCache(config.cacheMemoryBytes, config.cacheDir or None, config.cacheDiskBytes)
+        # 提示音频内容和提示文本共同决定了音色
+        self.voice_identities = {
+            voice.name: file_digest(voice.promptPath) + voice.promptText
+            for voice in config.all_voices()
+        }
+
+    def start(self):
+        '''
+        启动工作进程，模型在工作进程中异步加载，加载完成前提交的任务会在队列中等待
+        '''
+        self._jobs = asyncio.Queue(maxsize=self.config.queueSize)
+        self._error = None
+        self._stopped = asyncio.Event()
+        ctx = multiprocessing.get_context('spawn')
+        for i in range(max(1, self.config.workers)):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker_main,
+                args=(self.config.model_dump() | {'voices': [v.model_dump() for v in self.config.all_voices()]}, child_conn),
+                name=f"tts-worker-{i}",
+                daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._conns.append(parent_conn)
+            self._alive += 1
+            self._dispatchers.append(asyncio.create_task(self._dispatch(parent_conn, process.name)))
+        logger.info(f"TtsEngine started with {len(self._processes)} workers")
+
+    async def wait_ready(self):
+        '''
+        等待至少一个工作进程加载完模型，所有工作进程都启动失败时抛出 RuntimeError
+        '''
+        ready = asyncio.create_task(self._ready.wait())
+        stopped = asyncio.create_task(self._stopped.wait())
+        try:
+            await asyncio.wait({ready, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+            stopped.cancel()
+        if not self._ready.is_set():
+            raise RuntimeError(self._error)
+
+    async def submit(self, text: str, voice: str | None = None) -> list[bytes]:
+        '''
+        提交一个合成任务并等待结果，返回每段语音的WAV数据
+        '''
+        voice, key = self._resolve(text, voice)
+        if key is not None:
+            wav_data = await self.cache.get(key)
+            if wav_data is not None:
+                return wav_data
+        wav_data = [data async for data in self._run(TtsJob(text=text, voice=voice, frame_size=0))]
+        if key is not None and wav_data:
+            await self.cache.put(key, wav_data)
+        return wav_data
+
+    async def stream(self, text: str, voice: str | None = None) -> AsyncGenerator[bytes, None]:
+        '''
+        流式合成，逐帧返回16位单声道PCM数据，采样率为 self.sample_rate
+        '''
+        voice, key = self._resolve(text, voice)
+        frame_size = self.config.streamFrameSize
+        if key is not None:
+            wav_data = await self.cache.get(key)
+            if wav_data is not None:
+                for data in wav_data:
+                    pcm, sample_rate = wav_to_pcm(data)
+                    self.sample_rate = self.sample_rate or sample_rate
+                    for frame in split_frames(pcm, frame_size * 2):
+                        yield frame
+                return
+        frames = []
+        async for frame in self._run(TtsJob(text=text, voice=voice, frame_size=frame_size)):
+            frames.append(frame)
+            yield frame
+        if key is not None and frames:
+            await self.cache.put(key, [pcm_to_wav(b''.join(frames), self.sample_rate)])
+
+    async def encode(self, text: str, voice: str | None, audio_format: str) -> bytes:
+        '''
+        合成并编码为压缩格式，编码结果同样会被缓存
+        '''
+        voice, key = self._resolve(text, voice)
+        if key is not None:
+            key = hashlib.sha256(f"{key}:{audio_format}".encode()).hexdigest()
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return cached[0]
+        pcm = b''.join([frame async for frame in self.stream(text, voice)])
+        data = await asyncio.to_thread(encode_audio, pcm, self.sample_rate, audio_format)
+        if key is not None:
+            await self.cache.put(key, [data])
+        return data
+
+    def is_cached(self, text: str, voice: str | None) -> bool:
+        '''
+        合成结果是否已经在缓存中
+        '''
+        _, key = self._resolve(text, voice)
+        return key is not None and self.cache.contains(key)
+
+    def etag(self, text: str, voice: str | None, audio_format: str) -> str:
+        '''
+        合成结果只取决于文本、音色、采样率、模型和推理后端，据此生成HTTP缓存使用的ETag
+        '''
+        voice = voice or self.config.defaultVoice
+        key = self._make_key(text, self.voice_identities.get(voice, voice))
+        return f'"{key[:32]}-{audio_format}"'
+
+    def _resolve(self, text: str, voice: str | None) -> tuple[str, str | None]:
+        voice = voice or self.config.defaultVoice
+        if voice not in self.voice_identities:
+            raise ValueError(f"Unknown voice: {voice}")
+        key = None
+        if self.cache is not None:
+            key = self._make_key(text, self.voice_identities[voice])
+        return voice, key
+
+    def _make_key(self, text: str, voice_identity: str) -> str:
+        return TtsCache.make_key(text, voice_identity, self.config.sampleRate, self.config.modulePath, self.config.backend)
+
+    async def _run(self, job: TtsJob) -> AsyncGenerator[bytes, None]:
+        '''
+        将任务放入队列，并依次返回工作进程产生的数据，队列已满时会一直等待到有空位
+        '''
+        if self._error is not None:
+            raise RuntimeError(self._error)
+        await self._jobs.put(job)
+        if self._error is not None:
+            # 等待空位期间所有工作进程都退出了，队列不会再被处理
+            job.cancelled = True
+            raise RuntimeError(self._error)
+        try:
+            while True:
+                kind, payload = await job.output.get()
+                if kind == 'data':
+                    yield payload
+                elif kind == 'done':
+                    return
+                else:
+                    raise RuntimeError(payload)
+        finally:
+            # 等待者提前退出时，尚未开始的任务不再合成
+            job.cancelled = True
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._processes),
+            "alive": self._alive,
+            "error": self._error,
+            "voices": list(self.voice_identities.keys()),
+            "queued": self._jobs.qsize() if self._jobs is not None else 0,
+            "cache": self.cache.stats() if self.cache is not None else None,
+        }
+
+    async def _dispatch(self, conn: Connection, name: str):
+        '''
+        从任务队列中取出任务交给对应的工作进程，并把结果转交给等待者
+        '''
+        job = None
+        reason = f"{name} stopped"
+        try:
+            kind, payload = await asyncio.to_thread(conn.recv)
+            if kind != 'ready':
+                logger.error(f"{name} failed to start: {payload}")
+                reason = f"{name} failed to start: {payload}"
+                return
+            self.sample_rate = payload
+            self._ready.set()
+            logger.info(f"{name} is ready")
+            while True:
+                job = await self._jobs.get()
+                if job.cancelled:
+                    cancel_stats.add("tts_jobs")
+                    job = None
+                    continue
+                conn.send((job.text, job.voice, job.frame_size))
+                while True:
+                    kind, payload = await asyncio.to_thread(conn.recv)
+                    job.output.put_nowait((kind, payload))
+                    if kind != 'data':
+                        break
+                job = None
+        except (EOFError, OSError) as e:
+            logger.error(f"{name} exited unexpectedly: {e}")
+            reason = f"{name} exited unexpectedly"
+        finally:
+            if job is not None:
+                job.output.put_nowait(('error', f"{name} stopped"))
+            self._alive -= 1
+            if self._alive == 0:
+                self._fail(f"No TTS worker available: {reason}")
+
+    def _fail(self, error: str):
+        '''
+        没有可用的工作进程，让排队中的任务失败返回，之后提交的任务直接失败
+        '''
+        if self._error is None:
+            self._error = error
+            logger.error(error)
+        self._stopped.set()
+        if self._jobs is not None:
+            while not self._jobs.empty():
+                self._jobs.get_nowait().output.put_nowait(('error', self._error))
+
+    async def shutdown(self, timeout: float = 5):
+        '''
+        停止所有工作进程，并让尚未完成的任务失败返回
+        '''
+        self._error = "TtsEngine is shut down"
+        for task in self._dispatchers:
+            task.cancel()
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns:
+            conn.close()
+        self._fail(self._error)
+        self._processes = []
+        self._conns = []
+        self._dispatchers = []
+        logger.info("TtsEngine shut down")
@@ -0,0 +1,104 @@
+"""TTS文本规范化
+
+把数字、百分比、温度和常见符号改写成中文读法，英文保持原样交给模型处理。
+"""
+
+import re
+
+DIGITS = "零一二三四五六七八九"
+UNITS = ["", "十", "百", "千"]
+SECTIONS = ["", "万", "亿"]
+
+_THOUSANDS = re.compile(r"(?<=\d),(?=\d{3}(?!\d))")
+_PERCENT = re.compile(r"(-?\d+(?:\.\d+)?)[%％]")
+_TEMPERATURE = re.compile(r"(-?\d+(?:\.\d+)?)\s*(?:℃|°C)")
+_DEGREE = re.compile(r"(\d+(?:\.\d+)?)\s*°")
+_RANGE = re.compile(r"(\d)\s*[~～]\s*(?=\d)")
+_YEAR = re.compile(r"(\d{4})(?=年)")
+_NUMBER = re.compile(r"(?<![A-Za-z0-9.])(-?)(\d+)(?:\.(\d+))?")
+_SYMBOLS = {
+    "+": "加",
+    "=": "等于",
+    "&": "和",
+    "×": "乘",
+    "÷": "除以",
+    "#": "",
+    "*": "",
+}
+
+
+def read_digits(digits: str) -> str:
+    '''
+    逐位读出数字，用于年份、编号和小数部分
+    '''
+    return "".join(DIGITS[int(d)] for d in digits)
+
+
+def read_integer(digits: str) -> str:
+    '''
+    按中文读法读出一个整数，超过万亿或以0开头的数字逐位读出
+    '''
+    if len(digits) > 12 or (len(digits) > 1 and digits.startswith("0")):
+        return read_digits(digits)
+    number = int(digits)
+    if number == 0:
+        return DIGITS[0]
+    sections = []
+    while number > 0:
+        sections.append(number % 10000)
+        number //= 10000
+    result = ""
+    need_zero = False
+    for index in range(len(sections) - 1, -1, -1):
+        section = sections[index]
+        if section == 0:
+            need_zero = bool(result)
+            continue
+        if result and (need_zero or section < 1000):
+            result += DIGITS[0]
+        result += _read_section(section) + SECTIONS[index]
+        need_zero = False
+    if result.startswith("一十"):
+        # 十到十九读作“十X”
+        result = result[1:]
+    return result
+
+
+def _read_section(section: int) -> str:
+    result = ""
+    zero = False
+    for position in range(3, -1, -1):
+        digit = section // (10 ** position) % 10
+        if digit == 0:
+            zero = bool(result)
+            continue
+        if zero:
+            result += DIGITS[0]
+            zero = False
+        result += DIGITS[digit] + UNITS[position]
+    return result
+
+
+def read_number(sign: str, integer: str, fraction: str | None) -> str:
+    text = ("负" if sign else "") + read_integer(integer)
+    if fraction:
+        text += "点" + read_digits(fraction)
+    return text
+
+
+def normalize_for_tts(text: str) -> str:
+    text = _THOUSANDS.sub("", text)
+    text = _YEAR.sub(lambda m: read_digits(m.group(1)), text)
+    text = _PERCENT.sub(lambda m: "百分之" + _number(m.group(1)), text)
+    text = _TEMPERATURE.sub(lambda m: _number(m.group(1)) + "摄氏度", text)
+    text = _DEGREE.sub(lambda m: _number(m.group(1)) + "度", text)
+    text = _RANGE.sub(r"\1到", text)
+    text = _NUMBER.sub(lambda m: read_number(m.group(1), m.group(2), m.group(3)), text)
+    for symbol, word in _SYMBOLS.items():
+        text = text.replace(symbol, word)
+    return text
+
+
+def _number(value: str) -> str:
+    match = _NUMBER.fullmatch(value)
+    return read_number(match.group(1), match.group(2), match.group(3))
@@ -0,0 +1,254 @@
+"""流式TTS流水线
+
+将LLM输出的文本增量切分成句子，每得到一个完整的句子就立即提交合成，
+合成结果按句子顺序输出，使首段语音的延迟只取决于第一句话的长度。
+"""
+
+import asyncio
+import logging
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncGenerator
+
+from live2d_server.audio import mouth_envelope, wav_header, wav_to_pcm
+from live2d_server.cancellation import cancel_stats
+from live2d_server.tts_engine import TtsEngine
+from live2d_server.tts_normalize import normalize_for_tts
+
+logger = logging.getLogger(__name__)
+
+# 句末标点（中英文），遇到即认为一句话结束
+SENTENCE_END = "。！？!?；;…\n"
+# 句末标点之后可能紧跟的闭合符号，应归属于当前句子
+CLOSING = "”’」』）)】》\"'"
+# 句子过长时用于切分的次级标点
+SOFT_BREAK = "，,、：:"
+# 不需要朗读的markdown符号
+MARKDOWN_SYMBOLS = re.compile(r"[*#`>~|]+")
+SPEAKABLE = re.compile(r"[\w一-鿿]")
+
+
+class SentenceSegmenter:
+    """增量句子切分器
+
+    通过 feed 不断输入文本增量，返回其中已经完整的句子；
+    流结束时调用 flush 取出剩余的文本。
+    """
+
+    def __init__(self, min_chars: int = 2, max_chars: int = 80):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> list[str]:
+        if not text:
+            return []
+        self._buffer += text
+        sentences = []
+        start = 0
+        i = 0
+        n = len(self._buffer)
+        while i < n:
+            ch = self._buffer[i]
+            if ch in SENTENCE_END or ch == ".":
+                j = i + 1
+                while j < n and (self._buffer[j] in SENTENCE_END or self._buffer[j] in CLOSING):
+                    j += 1
+                if j == n:
+                    # 标点位于末尾，后续增量可能还有省略号或引号，等待下一段文本
+                    break
+                if ch == "." and not self._buffer[j].isspace():
+                    # 英文句点只有后面跟空白时才算句末，避免切开小数和网址
+                    i = j
+                    continue
+                sentence = self._buffer[start:j]
+                if len(sentence.strip()) >= self.min_chars:
+                    sentences.append(sentence)
+                    start = j
+                i = j
+                continue
+            i += 1
+        self._buffer = self._buffer[start:]
+        while len(self._buffer) > self.max_chars:
+            # 长时间没有句末标点，在最后一个次级标点处切分，避免首句语音等待过久
+            cut = max(self._buffer.rfind(p, 0, self.max_chars) for p in SOFT_BREAK)
+            if cut <= 0:
+                cut = self.max_chars - 1
+            sentences.append(self._buffer[:cut + 1])
+            self._buffer = self._buffer[cut + 1:]
+        return [s for s in (self._clean(s) for s in sentences) if s]
+
+    def flush(self) -> list[str]:
+        rest = self._clean(self._buffer)
+        self._buffer = ""
+        return [rest] if rest else []
+
+    @staticmethod
+    def _clean(sentence: str) -> str:
+        sentence = MARKDOWN_SYMBOLS.sub("", sentence).strip()
+        if not SPEAKABLE.search(sentence):
+            return ""
+        return sentence
+
+
+class ThinkFilter:
+    """去掉推理模型输出的思考过程
+
+    <think> 与 </think> 之间的文本不朗读；标签可能被拆分到相邻的几个增量中，
+    末尾可能是标签开头的部分先留在缓冲区，等下一段增量再判断。
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self):
+        self.thinking = False
+        self._buffer = ""
+
+    def feed(self, text: str) -> str:
+        self._buffer += text
+        spoken = []
+        while True:
+            tag = self.CLOSE if self.thinking else self.OPEN
+            index = self._buffer.find(tag)
+            if index < 0:
+                break
+            if not self.thinking:
+                spoken.append(self._buffer[:index])
+            self._buffer = self._buffer[index + len(tag):]
+            self.thinking = not self.thinking
+        keep = next((k for k in range(len(tag) - 1, 0, -1) if self._buffer.endswith(tag[:k])), 0)
+        rest, self._buffer = self._buffer[:len(self._buffer) - keep], self._buffer[len(self._buffer) - keep:]
+        if not self.thinking:
+            spoken.append(rest)
+        return "".join(spoken)
+
+    def flush(self) -> str:
+        rest = "" if self.thinking else self._buffer
+        self.thinking = False
+        self._buffer = ""
+        return rest
+
+
+@dataclass
+class _Sentence:
+    output: asyncio.Queue # 合成结果，以 None 结尾
+    task: asyncio.Task
+
+
+class TtsPipeline:
+    """逐句合成语音，并按句子顺序返回合成结果
+
+    最多同时合成 lookahead 句（已开始合成但尚未被取走的句子数），多个句子分散到不同的工作进程并行合成，
+    队首句子被取走后再开始合成后面的句子，保证播放时总有预先合成好的音频。
+    每一项为 (音频, 口型包络)。非流式模式下音频是一段完整的WAV数据；
+    流式模式下第一项是WAV流的头，之后是各句依次输出的PCM帧，拼接起来即是一个完整的WAV流。
+    mouth_fps 大于0时为每段音频计算口型包络，否则包络为空。
+    推理模型的思考过程（<think> 与 </think> 之间的文本）不会朗读。
+    drain 可以在输入文本的同时运行，flush 之后所有句子输出完毕才结束。
+    strict 为 False 时跳过合成失败的句子，为 True 时 drain 抛出该句的异常。
+    """
+
+    def __init__(self, tts_engine: TtsEngine, voice: str | None = None, stream: bool = False, mouth_fps: int = 0, lookahead: int = 4, segmenter: SentenceSegmenter | None = None, strict: bool = False):
+        self.tts_engine = tts_engine
+        self.voice = voice
+        self.stream = stream
+        self.mouth_fps = mouth_fps
+        self.lookahead = max(1, lookahead)
+        self.segmenter = segmenter or SentenceSegmenter()
+        self.strict = strict
+        self.sentences: list[str] = [] # 已提交合成的句子
+        self.think_filter = ThinkFilter()
+        self._pending: deque[_Sentence] = deque()
+        self._backlog: deque[str] = deque()
+        self._header_sent = False
+        self._flushed = False
+        # 有新的句子开始合成或输入结束时通知 drain
+        self._changed = asyncio.Event()
+
+    def feed(self, text: str):
+        for sentence in self.segmenter.feed(self.think_filter.feed(text)):
+            self._submit(sentence)
+
+    def flush(self):
+        for sentence in self.segmenter.feed(self.think_filter.flush()) + self.segmenter.flush():
+            self._submit(sentence)
+        self._flushed = True
+        self._changed.set()
+
+    def _submit(self, sentence: str):
+        sentence = normalize_for_tts(sentence)
+        logger.info(f"tts sentence: {sentence}")
+        self.sentences.append(sentence)
+        self._backlog.append(sentence)
+        self._schedule()
+
+    def _schedule(self):
+        while self._backlog and len(self._pending) < self.lookahead:
+            sentence = self._backlog.popleft()
+            output = asyncio.Queue()
+            self._pending.append(_Sentence(output=output, task=asyncio.create_task(self._synthesize(sentence, output))))
+            self._changed.set()
+
+    async def _synthesize(self, sentence: str, output: asyncio.Queue):
+        try:
+            if self.stream:
+                async for frame in self.tts_engine.stream(sentence, self.voice):
+                    output.put_nowait((frame, self._envelope(frame)))
+            else:
+                for data in await self.tts_engine.submit(sentence, self.voice):
+                    output.put_nowait((data, self._envelope(data, is_wav=True)))
+        except Exception as e:
+            logger.error(f"tts failed: {e}")
+            # 聊天时单句合成失败不影响文本输出，跳过该句语音
+            if self.strict:
+                output.put_nowait(e)
+        finally:
+            output.put_nowait(None)
+
+    def _envelope(self, data: bytes, is_wav: bool = False) -> bytes:
+        if self.mouth_fps <= 0:
+            return b''
+        if is_wav:
+            pcm, sample_rate = wav_to_pcm(data)
+        else:
+            pcm, sample_rate = data, self.tts_engine.sample_rate
+        return mouth_envelope(pcm, sample_rate, self.mouth_fps)
+
+    async def drain(self) -> AsyncGenerator[tuple[bytes, bytes], None]:
+        '''
+        按顺序输出各句的合成结果，在 flush 之前会等待后续的句子
+        '''
+        while True:
+            if not self._pending:
+                if self._flushed:
+                    return
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            data = await self._pending[0].output.get()
+            if isinstance(data, Exception):
+                raise data
+            if data is None:
+                self._pending.popleft()
+                self._schedule()
+                continue
+            for item in self._with_header([data]):
+                yield item
+
+    def cancel(self):
+        unfinished = len(self._backlog)
+        self._backlog.clear()
+        while self._pending:
+            sentence = self._pending.popleft()
+            if not sentence.task.done():
+                unfinished += 1
+            sentence.task.cancel()
+        cancel_stats.add("tts_sentences", unfinished)
+
+    def _with_header(self, items: list[tuple[bytes, bytes]]) -> list[tuple[bytes, bytes]]:
+        if self.stream and items and not self._header_sent:
+            self._header_sent = True
+            return [(wav_header(self.tts_engine.sample_rate), b'')] + items
+        return items
@@ -0,0 +1,59 @@
+"""WebSocket 聊天通道
+
+文本、工具调用和控制消息以JSON文本帧发送；音频以二进制帧发送，
+帧头为 4 字节大端序号 + 1 字节类型 + 2 字节口型包络长度，后面依次是口型包络和原始音频数据，
+避免了base64和JSON编码的开销。
+客户端收到音频后回复 {"type": "ack", "seq": n}，未确认的音频字节数超过窗口时服务端暂停发送。
+"""
+
+import asyncio
+import struct
+
+AUDIO_FRAME_HEADER = struct.Struct(">IBH")
+# 二进制帧类型
+AUDIO_KIND_WAV = 0 # 一段完整的WAV
+AUDIO_KIND_STREAM = 1 # WAV流的一部分，同一次回复中的所有此类帧拼接成一个WAV流
+
+# 默认的流控窗口，单位为字节
+DEFAULT_AUDIO_WINDOW = 1024 * 1024
+
+
+def pack_audio_frame(seq: int, kind: int, data: bytes, mouth: bytes = b'') -> bytes:
+    return AUDIO_FRAME_HEADER.pack(seq, kind, len(mouth)) + mouth + data
+
+
+class AudioFlowControl:
+    """基于确认的音频流控，每个连接一个实例"""
+
+    def __init__(self, window: int = DEFAULT_AUDIO_WINDOW):
+        self.window = window
+        self._seq = 0
+        self._unacked: dict[int, int] = {}
+        self._unacked_bytes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        '''
+        等待窗口中有足够的空间后分配一个序号，窗口为空时总是允许发送，避免单帧大于窗口时死锁
+        '''
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._unacked_bytes == 0 or self._unacked_bytes + size <= self.window)
+            self._seq += 1
+            self._unacked[self._seq] = size
+            self._unacked_bytes += size
+            return self._seq
+
+    async def ack(self, seq: int):
+        '''
+        确认序号不大于 seq 的所有音频帧
+        '''
+        async with self._condition:
+            for s in [s for s in self._unacked if s <= seq]:
+                self._unacked_bytes -= self._unacked.pop(s)
+            self._condition.notify_all()
+
+    async def reset(self):
+        async with self._condition:
+            self._unacked.clear()
+            self._unacked_bytes = 0
+            self._condition.notify_all()
@@ -2,9 +2,14 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import argparse
+import asyncio
 import logging
-from live2d_server.router import router
+from live2d_server.router import router, shutdown_tts, get_config
 from live2d_server.rag.router import router as rag_router
+from live2d_server.search.query_builder import warm_up as warm_up_query_builder
+from live2d_server.search import searx, fetcher
+from live2d_server.client import shutdown_mcp_client
+from live2d_server import conversation, memory
 from contextlib import asynccontextmanager
 import uvicorn
 
@@ -20,7 +25,18 @@ async def lifespan(app: FastAPI):
     app.include_router(rag_router)
     if static_path:
         app.mount("/", StaticFiles(directory=static_path, html=True), name="static")
+    await asyncio.to_thread(warm_up_query_builder)
+    conversation.configure(get_config().server.conversation)
+    memory.configure(get_config().server.memory)
+    # 浏览器启动较慢，在后台预热，不阻塞服务启动
+    browser_warm_up = asyncio.create_task(fetcher.warm_up())
     yield
+    browser_warm_up.cancel()
+    await shutdown_tts()
+    await searx.shutdown()
+    await fetcher.shutdown()
+    await shutdown_mcp_client()
+    conversation.shutdown()
 
 def main(app: FastAPI):
     parser = argparse.ArgumentParser(description="启动Web服务器")
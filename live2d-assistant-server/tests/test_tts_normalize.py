@@ -0,0 +1,24 @@
+from live2d_server.tts_normalize import normalize_for_tts, read_integer
+
+
+def test_read_integer():
+    assert read_integer("0") == "零"
+    assert read_integer("10") == "十"
+    assert read_integer("105") == "一百零五"
+    assert read_integer("20000") == "二万"
+
+
+def test_normalize_units():
+    assert normalize_for_tts("湿度85%") == "湿度百分之八十五"
+    assert normalize_for_tts("气温-3℃") == "气温负三摄氏度"
+    assert normalize_for_tts("2024年") == "二零二四年"
+
+
+def test_normalize_numbers():
+    assert normalize_for_tts("共1,234人") == "共一千二百三十四人"
+    assert normalize_for_tts("3.14") == "三点一四"
+    assert normalize_for_tts("1~3天") == "一到三天"
+
+
+def test_keep_words_with_digits():
+    assert normalize_for_tts("GPT4") == "GPT4"
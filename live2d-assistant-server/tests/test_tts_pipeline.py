@@ -0,0 +1,82 @@
+import asyncio
+
+from live2d_server.tts_pipeline import SentenceSegmenter, ThinkFilter, TtsPipeline
+
+
+def feed_all(segmenter: SentenceSegmenter, deltas: list[str]) -> list[str]:
+    sentences = []
+    for delta in deltas:
+        sentences += segmenter.feed(delta)
+    return sentences + segmenter.flush()
+
+
+def test_split_on_sentence_end():
+    sentences = feed_all(SentenceSegmenter(), ["你好", "。今天天气", "不错！", "我们出去走走吧"])
+    assert sentences == ["你好。", "今天天气不错！", "我们出去走走吧"]
+
+
+def test_wait_for_closing_quote():
+    segmenter = SentenceSegmenter()
+    assert segmenter.feed("他说：“走吧。") == []
+    assert segmenter.feed("”然后") == ["他说：“走吧。”"]
+
+
+def test_english_period_and_decimal():
+    assert feed_all(SentenceSegmenter(), ["Pi is 3.14. It is ", "irrational"]) == ["Pi is 3.14.", "It is irrational"]
+
+
+def test_long_text_split_by_max_chars():
+    segmenter = SentenceSegmenter(max_chars=80)
+    sentences = segmenter.feed("啊" * 300)
+    assert [len(sentence) for sentence in sentences] == [80, 80, 80]
+    assert segmenter.flush() == ["啊" * 60]
+
+
+def test_long_text_split_at_soft_break():
+    segmenter = SentenceSegmenter(max_chars=10)
+    assert segmenter.feed("一二三四五，六七八九十一二") == ["一二三四五，"]
+
+
+def test_skip_unspeakable():
+    assert feed_all(SentenceSegmenter(), ["**。", "好的。", "\n---"]) == ["好的。"]
+
+
+def test_think_filter():
+    think = ThinkFilter()
+    deltas = ["<think>", "\n", "嗯", "</think>", "你好"]
+    assert "".join(think.feed(delta) for delta in deltas) + think.flush() == "你好"
+
+
+def test_think_filter_split_tags():
+    think = ThinkFilter()
+    deltas = ["前<th", "ink>想一想</thi", "nk>后<", "b>"]
+    assert "".join(think.feed(delta) for delta in deltas) + think.flush() == "前后<b>"
+
+
+class FakeEngine:
+    sample_rate = 16000
+
+    async def submit(self, text, voice=None):
+        return [text.encode()]
+
+
+def test_drain_while_feeding():
+    async def run():
+        pipeline = TtsPipeline(FakeEngine())
+        received = []
+
+        async def consume():
+            async for data, _ in pipeline.drain():
+                received.append(data.decode())
+
+        task = asyncio.create_task(consume())
+        pipeline.feed("你好。今天")
+        await asyncio.sleep(0.01)
+        # 第一句在输入结束之前就已经输出
+        assert received == ["你好。"]
+        pipeline.feed("天气不错")
+        pipeline.flush()
+        await asyncio.wait_for(task, 1)
+        return received
+
+    assert asyncio.run(run()) == ["你好。", "今天天气不错"]
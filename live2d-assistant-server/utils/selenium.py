@@ -7,7 +7,7 @@ from selenium.webdriver.edge.service import Service as EdgeService
 from selenium.webdriver.edge.options import Options as EdgeOptions
 from selenium.webdriver.firefox.service import Service as FirefoxService
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from selenium.common.exceptions import WebDriverException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 import time
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -113,14 +113,15 @@ class WebDriverManager:
                     
         return None
 
-    def get_page_content(self, url, wait_time=5, max_retries=3):
+    def get_page_content(self, url, wait_time=5, max_retries=3, idle_time=0.5):
         """
         使用给定的WebDriver打开并获取网页内容
         
         参数:
             url: 要访问的网页URL
-            wait_time: 等待页面加载的时间（秒）
+            wait_time: 等待页面加载的最长时间（秒）
             max_retries: 最大重试次数
+            idle_time: 网络空闲判定时间（秒），在这段时间内没有新的资源请求即认为动态内容加载完成
             
         返回:
             str: 网页内容
@@ -132,22 +133,20 @@ class WebDriverManager:
             try:
                 # 访问URL
                 self.driver.get(url)
-                
-                # 先等待一小段时间让页面开始加载
-                time.sleep(1)
-                
-                # 等待页面加载完成
-                wait = WebDriverWait(self.driver, wait_time)
+                wait = WebDriverWait(self.driver, wait_time, poll_frequency=0.1)
+
+                # 等待DOM可用，图片等资源的加载由下面的网络空闲检测处理
                 wait.until(
-                    lambda driver: driver.execute_script('return document.readyState') == 'complete'
+                    lambda driver: driver.execute_script('return document.readyState') in ('interactive', 'complete')
                 )
+                wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+
+                # 等待网络空闲，而不是固定等待一段时间；超时后直接使用当前的内容
+                try:
+                    self.wait_network_idle(wait, idle_time)
+                except TimeoutException:
+                    pass
 
-                # 等待body元素出现并稳定
-                body = wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-                
-                # 再等待一小段时间确保动态内容加载完成
-                time.sleep(1)
-                
                 # 获取页面内容
                 page_content = self.driver.page_source
                 if page_content and len(page_content.strip()) > 0:
@@ -158,9 +157,25 @@ class WebDriverManager:
                 if attempt == max_retries - 1:  # 如果是最后一次尝试
                     print("已达到最大重试次数，获取页面内容失败")
                     return None
-                time.sleep(2)  # 在重试之前等待一段时间
                 
         return None
+
+    def wait_network_idle(self, wait, idle_time=0.5):
+        """
+        等待页面的资源请求数量在 idle_time 内不再变化
+        """
+        state = {"count": -1, "since": time.monotonic()}
+
+        def idle(driver):
+            count = driver.execute_script("return performance.getEntriesByType('resource').length")
+            now = time.monotonic()
+            if count != state["count"]:
+                state["count"] = count
+                state["since"] = now
+                return False
+            return now - state["since"] >= idle_time
+
+        wait.until(idle)
         
     def create_webdriver(self):
         """
@@ -183,6 +198,8 @@ class WebDriverManager:
             options.add_argument('--disable-gpu')
             options.add_argument('--no-sandbox')
             options.add_argument('--disable-dev-shm-usage')
+            # DOMContentLoaded 之后即返回，剩余的加载由 get_page_content 中的就绪检测处理
+            options.page_load_strategy = 'eager'
             
             # 创建WebDriver实例
             driver = driver_class(options=options)